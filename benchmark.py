@@ -0,0 +1,354 @@
+import pathlib
+import logging
+import json
+import time
+import shutil
+import tempfile
+import datetime
+import platform
+import subprocess
+import itertools
+import concurrent.futures
+import multiprocessing
+import numpy as np
+import xarray as xr
+from pipeline import setup_logger, save_dataset, open_output, era5_requests, field_requests, postprocessing, plot_frames, dir2movie, available_cores, peak_rss_mb, child_peak_rss_mb, subset_area, file_variable, NETCDF_LOCK
+
+def synthetic_field(n_times, shape, seed = 0, rng = None):
+    """
+    A (time, latitude, longitude) float32 field: a large scale pattern that drifts eastward by a degree per timestep, plus noise.
+    """
+    rng = rng or np.random.default_rng(seed)
+    lat_term = np.cos(np.deg2rad(np.linspace(90, -90, shape[0])))[None, :, None]
+    lon_rad = np.deg2rad(np.linspace(0, 360, shape[1], endpoint=False))[None, None, :]
+    drift = np.deg2rad(np.arange(n_times))[:, None, None]
+
+    return (10 * lat_term * np.sin(3 * (lon_rad - drift) + seed) + rng.normal(scale=0.5, size=(n_times, *shape))).astype(np.float32)
+
+def synthetic_dataset(n_times = 48, channels = ("t2m", "tcwv", "wind500", "wind850"), shape = (721, 1440), start = "2005-08-01"):
+    """
+    Make an ERA5-shaped dataset (time, latitude, longitude) of smooth float32 fields plus noise, so benchmarks
+    don't need a CDS download. The noise makes compression ratios pessimistic compared to real fields.
+
+    n_times: int - number of hourly timesteps
+    channels: tuple[str] - names of the variables to make
+    shape: tuple[int, int] - (latitude, longitude) size of the grid
+    start: str - first timestep
+    """
+    rng = np.random.default_rng(0)
+    lat = np.linspace(90, -90, shape[0])
+    lon = np.linspace(0, 360, shape[1], endpoint=False)
+    times = np.arange(np.datetime64(start, "h"), np.datetime64(start, "h") + n_times).astype("datetime64[ns]")
+
+    data_vars = {}
+    for channel_idx, channel in enumerate(channels):
+        data_vars[channel] = (("time", "latitude", "longitude"), synthetic_field(n_times, shape, channel_idx, rng))
+
+    return xr.Dataset(data_vars, coords=dict(time=times, latitude=lat, longitude=lon))
+
+def store_size(path):
+    """
+    Size on disk of a netcdf file or zarr store, in bytes.
+    """
+    path = pathlib.Path(path)
+    if path.is_dir():
+        return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
+
+    return path.stat().st_size
+
+def storage_benchmark(ds, bench_dir, time_chunk = 24, compressors = (dict(cname="zstd", clevel=3),), frames_read = 24):
+    """
+    Compare saving ds as netcdf (the default output) and as zarr stores with each compressor: write time, size on disk,
+    and read time per frame, both reading time_chunk frames at a time as plot_frames does, and reading single 
+    frames scattered over the dataset (where a zarr chunk is decompressed for one frame).
+
+    ds: xr.Dataset - dataset to save, e.g. from synthetic_dataset
+    bench_dir: pathlib.Path - where to write the files, removed afterwards
+    time_chunk: int - timesteps per zarr chunk, and per read when reading in blocks
+    compressors: tuple[dict] - Blosc options to try, see pipeline.zarr_encoding
+    frames_read: int - number of single frames to read back, spread over the dataset
+
+    Returns a list of dicts, one per format.
+    """
+    formats = [("netcdf", "bench.nc", None)] + [(f"zarr {compressor['cname']}:{compressor['clevel']}", f"bench_{idx}.zarr", compressor) for idx, compressor in enumerate(compressors)]
+    frame_idx = np.linspace(0, ds.sizes["time"] - 1, frames_read).astype(int)
+    channels = list(ds.data_vars)
+    n_frames = ds.sizes["time"] * len(channels)
+
+    results = []
+    for name, filename, compressor in formats:
+        path = bench_dir / filename
+        start = time.perf_counter()
+        save_dataset(ds, path, time_chunk, compressor)
+        write_s = time.perf_counter() - start
+
+        read_ds = open_output(path)
+        start = time.perf_counter()
+        for channel in channels: # every frame, a block at a time
+            for block_start in range(0, ds.sizes["time"], time_chunk):
+                read_ds[channel].isel(time=slice(block_start, block_start + time_chunk)).load()
+
+        block_s = time.perf_counter() - start
+        start = time.perf_counter()
+        for read_idx, t_idx in enumerate(frame_idx): # single frames
+            read_ds[channels[read_idx % len(channels)]].isel(time=t_idx).load()
+
+        single_s = time.perf_counter() - start
+        read_ds.close()
+
+        result = dict(
+            format=name, write_s=write_s, size_mb=store_size(path) / 1e6, 
+            block_read_ms_per_frame=1000 * block_s / n_frames, single_read_ms_per_frame=1000 * single_s / frames_read,
+        )
+        logging.info(f"{name}: wrote in {write_s:.2f}s, {result['size_mb']:.1f} MB, read {result['block_read_ms_per_frame']:.1f} ms per frame in blocks, {result['single_read_ms_per_frame']:.1f} ms per single frame")
+        results.append(result)
+        shutil.rmtree(path) if path.is_dir() else path.unlink()
+
+    return results
+
+class SyntheticClient:
+    """
+    Stands in for cdsapi.Client(): retrieve() writes a synthetic file shaped like the ERA5 download for the request,
+    so pull_data_range (as client_factory) and postprocessing can run without a CDS account.
+
+    Files have the structure of a CDS netcdf download: (time, latitude, longitude) or (time, level, latitude, longitude)
+    variables under their short names (see file_variable; without level for a single pressure level), latitude from 90 to -90 and longitude 
+    from 0, packed as int16 with scale_factor and add_offset. The request's area, if any, is cut out of the global grid
+    with subset_area, so areas across the Greenwich meridian work.
+
+    shape: tuple[int, int] - (latitude, longitude) size of the global grid, (721, 1440) for ERA5's 0.25 degrees
+    """
+    def __init__(self, shape = (721, 1440)):
+        self.shape = shape
+
+    def retrieve(self, name, request, target):
+        listed = lambda key: request[key] if isinstance(request[key], list) else [request[key]]
+        times = []
+        for year, month, day, hour in itertools.product(*(listed(key) for key in ("year", "month", "day", "time"))):
+            try:
+                times.append(datetime.datetime(int(year), int(month), int(day), int(hour[:2])))
+
+            except ValueError: # the cartesian product of a request can include e.g. the 31st of a 30 day month
+                continue
+
+        times = np.array(sorted(times), dtype="datetime64[ns]")
+        lat = np.linspace(90, -90, self.shape[0])
+        lon = np.linspace(0, 360, self.shape[1], endpoint=False)
+        coords = dict(time=times, latitude=lat, longitude=lon)
+        levels = [int(level) for level in listed("pressure_level")] if "pressure_level" in request else None
+        dims = ("time", "latitude", "longitude")
+        if levels:
+            coords["level"] = np.array(levels, dtype=np.int32)
+            dims = ("time", "level", "latitude", "longitude")
+
+        data_vars, encoding = {}, {}
+        for var_idx, variable in enumerate(request["variable"]):
+            short_name = file_variable(variable) or variable
+            rng = np.random.default_rng(var_idx)
+            if levels:
+                field = np.stack([synthetic_field(len(times), self.shape, var_idx + level_idx, rng) for level_idx in range(len(levels))], axis=1)
+
+            else:
+                field = synthetic_field(len(times), self.shape, var_idx, rng)
+
+            data_vars[short_name] = (dims, field)
+            lower, upper = float(field.min()), float(field.max())
+            encoding[short_name] = dict(dtype="int16", scale_factor=(upper - lower) / 65532 or 1.0, add_offset=(upper + lower) / 2, _FillValue=-32767)
+
+        ds = xr.Dataset(data_vars, coords=coords)
+        if levels and len(levels) == 1: # the CDS leaves out the level dimension for a single level
+            ds = ds.isel(level=0, drop=True)
+
+        if "area" in request:
+            ds = subset_area(ds, request["area"])
+
+        with NETCDF_LOCK: # shared with pipeline, whose threads also read and write netcdf files
+            ds.to_netcdf(target, encoding=encoding)
+
+def synthetic_download(bench_dir, n_times, shape, sfc_vars, pl_vars, pl_levels, start = "2005-08-01"):
+    """
+    Write the {sfc,pl}.nc files pull_data would download for n_times hourly timesteps from start, using SyntheticClient.
+    Like pull_data, the request is for a set of days and hours, so n_times over 24 is rounded up to whole days.
+
+    Returns the sfc and pl requests (see era5_requests), ready for postprocessing.
+    """
+    first_day = datetime.date.fromisoformat(start)
+    shared = {
+        'product_type': 'reanalysis',
+        'format': 'netcdf',
+        'year': f"{first_day.year}",
+        'month': f"{first_day.month:02}", # like pull_data, requests stay within one month
+        'day': [f"{first_day.day + i:02}" for i in range(-(-n_times // 24))],
+        'time': [f"{i:02}:00" for i in range(min(n_times, 24))],
+    }
+    sfc_request, pl_request = era5_requests(shared, sfc_vars, pl_vars, pl_levels, bench_dir, "bench")
+    client = SyntheticClient(shape)
+    for variables, request in ((sfc_vars, sfc_request), (pl_vars, pl_request)):
+        if variables:
+            client.retrieve(request["name"], request["request"], request["target"])
+
+    return sfc_request, pl_request
+
+def run_stage(stage, kwargs):
+    """
+    Run one pipeline stage and return its time and peak memory, see isolated.
+    """
+    start = time.perf_counter()
+    if stage == "postprocessing":
+        postprocessing(**kwargs).close()
+
+    elif stage == "plot_frames": # the dataset is opened here rather than pickled over
+        plot_frames(open_output(kwargs.pop("ds_path")), **kwargs)
+
+    seconds = time.perf_counter() - start
+
+    return dict(seconds=seconds, peak_rss_mb=peak_rss_mb(), child_peak_rss_mb=child_peak_rss_mb())
+
+def isolated(stage, **kwargs):
+    """
+    Run a pipeline stage ("postprocessing", or "plot_frames" of the dataset at ds_path) in a fresh process, so its 
+    peak memory isn't hidden by whatever ran before it in this one. Returns dict(seconds, peak_rss_mb, child_peak_rss_mb),
+    the latter being that of its largest render worker (0 without workers).
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(run_stage, stage, kwargs).result()
+
+def stage_benchmark(
+    bench_dir, n_times, shape, sfc_vars, pl_vars, pl_levels,
+    renderers = ("fast", "matplotlib"), workers = 1, time_chunk = 24, encode_params = None, derived_fields = ("wind",),
+    ):
+    """
+    Time each stage of the pipeline on synthetic downloads (see synthetic_download) of one size:
+    postprocessing (seconds, MB/s of downloaded data, peak memory), plot_frames with each renderer
+    (frames per second, peak memory) and dir2movie (encode frames per second).
+
+    bench_dir: pathlib.Path - where to write the files, removed afterwards
+    n_times: int - number of hourly timesteps
+    shape: tuple[int, int] - (latitude, longitude) size of the grid
+    renderers, workers - see plot_frames
+    time_chunk: int - see postprocessing and plot_frames, or None to process the data in memory
+    encode_params: dict - codec, preset, crf and threads, see dir2movie
+    derived_fields: list[str] - fields postprocessing derives, see DERIVED_FIELDS; their inputs are downloaded too
+
+    Returns a list of dicts, one per stage.
+    """
+    variables, drop_inputs = field_requests(dict(sfc_vars=sfc_vars, pl_vars=pl_vars, pl_levels=pl_levels), derived_fields)
+    sfc_request, pl_request = synthetic_download(bench_dir, n_times, shape, variables["sfc_vars"], variables["pl_vars"], variables["pl_levels"])
+    size = dict(n_times=len(sfc_request["request"]["day"]) * len(sfc_request["request"]["time"]), shape=list(shape))
+    input_mb = sum(request["target"].stat().st_size for request in (sfc_request, pl_request) if request["target"].exists()) / 1e6
+
+    results = []
+    output_path = bench_dir / "bench_merged.nc"
+    result = isolated("postprocessing", sfc_request=sfc_request, pl_request=pl_request, output_path=output_path, rm_originals=False, time_chunk=time_chunk, derived_fields=list(derived_fields), drop_inputs=drop_inputs)
+    results.append(dict(stage="postprocessing", **size, **result, input_mb=input_mb, mb_per_second=input_mb / result["seconds"]))
+    logging.info(f"postprocessing {size}: {result['seconds']:.2f}s ({input_mb / result['seconds']:.1f} MB/s), peak memory {result['peak_rss_mb']:.0f} MB")
+
+    ds = open_output(output_path)
+    n_frames = ds.sizes["time"] * len(ds.data_vars)
+    ds.close()
+    for renderer in renderers:
+        img_dir = bench_dir / f"frames_{renderer}"
+        result = isolated(
+            "plot_frames", ds_path=output_path, output_dir=img_dir, channel_metadata={}, border_color="black", plot_metadata=True,
+            metadata_pos="upper-right", renderer=renderer, workers=workers, time_chunk=time_chunk or 24,
+        )
+        results.append(dict(stage=f"plot_frames ({renderer})", **size, **result, frames=n_frames, frames_per_second=n_frames / result["seconds"]))
+        logging.info(f"plot_frames ({renderer}) {size}: {n_frames / result['seconds']:.1f} frames/s, peak memory {result['peak_rss_mb']:.0f} MB (workers {result['child_peak_rss_mb']:.0f} MB)")
+
+    # encode the frames of the last renderer, one channel at a time
+    encode_params = encode_params or {}
+    reports = [dir2movie(channel_dir, bench_dir / f"{channel_dir.name}.mp4", **encode_params) for channel_dir in sorted(img_dir.glob("var_*"))]
+    seconds = sum(report["seconds"] for report in reports)
+    results.append(dict(
+        stage="dir2movie", **size, seconds=seconds, frames=n_frames, frames_per_second=n_frames / seconds,
+        success=all(report["success"] for report in reports), size_mb=sum(report["size_mb"] or 0 for report in reports),
+    ))
+    logging.info(f"dir2movie {size}: {n_frames / seconds:.1f} frames/s")
+
+    for path in bench_dir.iterdir():
+        shutil.rmtree(path) if path.is_dir() else path.unlink()
+
+    return results
+
+def run_environment():
+    """
+    What a benchmark ran on and against, so results from different versions and machines can be told apart.
+    """
+    commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=pathlib.Path(__file__).parent)
+
+    return dict(
+        time=datetime.datetime.now().isoformat(timespec="seconds"),
+        commit=commit.stdout.strip() if commit.returncode == 0 else None,
+        python=platform.python_version(), numpy=np.__version__, xarray=xr.__version__,
+        platform=platform.platform(), cores=available_cores(),
+    )
+
+def compare_results(previous, current, tolerance = 0.1):
+    """
+    Log stages that got more than tolerance (a fraction) slower, or used more memory, than in a previous run of the same size.
+
+    previous, current: dict - results saved by this script (see __main__)
+
+    Returns a list of (stage, size, metric, previous value, current value) for each regression.
+    """
+    key = lambda result: (result["stage"], result["n_times"], tuple(result["shape"]))
+    before = {key(result): result for result in previous["stages"]}
+    regressions = []
+    for result in current["stages"]:
+        old = before.get(key(result))
+        if old is None:
+            continue
+
+        for metric in ("seconds", "peak_rss_mb", "child_peak_rss_mb"):
+            if metric in result and metric in old and result[metric] > old[metric] * (1 + tolerance):
+                regressions.append((result["stage"], (result["n_times"], result["shape"]), metric, old[metric], result[metric]))
+                logging.warning(f"{result['stage']} {key(result)[1:]}: {metric} went from {old[metric]:.2f} to {result[metric]:.2f} (commit {previous['environment']['commit']} -> {current['environment']['commit']})")
+
+    logging.info(f"{len(regressions)} regressions compared to the run of {previous['environment']['time']}")
+
+    return regressions
+
+if __name__ == "__main__":
+    working_dir = pathlib.Path.cwd() # results and log are saved here
+    setup_logger(log_loc = working_dir / "benchmark.log")
+
+    ds = synthetic_dataset(n_times = 48)
+    with tempfile.TemporaryDirectory(prefix="bench_", dir=working_dir) as bench_dir:
+        storage_results = storage_benchmark(
+            ds, pathlib.Path(bench_dir),
+            time_chunk = 24, # timesteps per zarr chunk
+            compressors = (dict(cname = "lz4", clevel = 5), dict(cname = "zstd", clevel = 3), dict(cname = "zstd", clevel = 7)), # Blosc options to compare
+        )
+
+    stage_results = []
+    for n_times, shape in (
+        (24, (181, 360)), # 1 degree grid
+        (24, (721, 1440)), # full ERA5 resolution
+        (48, (721, 1440)),
+    ):
+        with tempfile.TemporaryDirectory(prefix="bench_", dir=working_dir) as bench_dir:
+            stage_results += stage_benchmark(
+                pathlib.Path(bench_dir), n_times, shape,
+                sfc_vars = ["total_column_water_vapour"],
+                pl_vars = ["temperature"],
+                pl_levels = [500, 850],
+                renderers = ("fast", "matplotlib"), # plot_frames renderers to time
+                workers = 1, # render processes
+                time_chunk = 24, # None to process the data in memory
+                encode_params = dict(codec = "x264", preset = "medium"), # see dir2movie
+                derived_fields = ["wind"], # fields derived by postprocessing, from u and v
+            )
+
+    results = dict(environment = run_environment(), storage = storage_results, stages = stage_results)
+    results_path = working_dir / "benchmark_results.json"
+    results_path.write_text(json.dumps(results, indent=2))
+    logging.info(f"Saved results to {results_path}")
+
+    # one line per run, to track performance between versions
+    history_path = working_dir / "benchmark_history.jsonl"
+    history = [json.loads(line) for line in history_path.read_text().splitlines() if line] if history_path.exists() else []
+    if history:
+        compare_results(history[-1], results)
+
+    with open(history_path, "a") as history_file:
+        history_file.write(json.dumps(results) + "\n")
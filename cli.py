@@ -0,0 +1,186 @@
+"""
+Command line entry point, configured by a TOML file instead of editing the dicts in run_pipeline.py:
+
+    python cli.py plan config.toml      # print the requests, frames and disk usage of a run, without running it
+    python cli.py fetch config.toml     # download the data
+    python cli.py process config.toml   # merge the downloads and derive fields into output_ds_path
+    python cli.py render config.toml    # render frames (or streamed videos) from output_ds_path or use_ds
+    python cli.py encode config.toml    # encode the saved frames into videos
+    python cli.py run config.toml       # all of the above, like run_pipeline.py (--dry-run to only plan)
+
+The keys of the config file are the arguments of pipeline.main (see config.example.toml and the README).
+Anything left out takes the default below, or main's default. TOML has no None: use false instead, e.g. output_ds_path = false.
+Relative paths are relative to the config file.
+
+Only what a command needs is imported: plan never loads xarray, matplotlib or cdsapi (see pipeline.LazyModule).
+"""
+import argparse
+import inspect
+import json
+import pathlib
+import tomllib
+import pipeline
+
+# paths in the config file, resolved relative to it
+PATH_KEYS = ("working_dir", "img_dir", "vid_dir", "output_ds_path", "use_ds")
+
+# defaults of the arguments that main requires
+DEFAULTS = dict(
+    use_ds = False,
+    rm_originals = True,
+    rm_images = False,
+    channel_metadata = {},
+    border_color = "black",
+    fps = 24,
+    plot_metadata = True,
+    metadata_pos = "upper-right",
+    output_stem_explain = "",
+    derived_fields = None, # see pipeline.legacy_derived_fields
+)
+
+def default_output_stem(data_params):
+    """
+    The output stem run_pipeline.py would use for data_params, e.g. y2005_m08_da04_db30_ha00_hb23, or 20050804_20050830 for a date range.
+    """
+    if "start_date" in data_params:
+        start, stop = (date.replace("-", "").replace(":", "") for date in (data_params["start_date"], data_params["stop_date_inc"]))
+
+        return f"{start}_{stop}"
+
+    return f'y{data_params["year"]}_m{data_params["month"]}_da{data_params["start_day_inc"]}_db{data_params["stop_day_inc"]}_ha{data_params["start_hour_inc"]}_hb{data_params["stop_hour_inc"]}'
+
+def load_config(config_path):
+    """
+    Read a TOML config file into the keyword arguments of pipeline.main, filling in the defaults.
+    """
+    config_path = pathlib.Path(config_path)
+    with open(config_path, "rb") as f:
+        config = tomllib.load(f)
+
+    if "data_params" not in config or "working_dir" not in config:
+        raise SystemExit(f"{config_path} needs at least data_params and working_dir")
+
+    for key in PATH_KEYS:
+        if config.get(key): # false means not set
+            config[key] = config_path.parent / config[key] # absolute paths stay as they are
+
+    if (config.get("cache_params") or {}).get("cache_dir"):
+        config["cache_params"]["cache_dir"] = config_path.parent / config["cache_params"]["cache_dir"]
+
+    working_dir = config["working_dir"]
+    config.setdefault("output_stem", default_output_stem(config["data_params"]))
+    config.setdefault("output_ds_path", working_dir / f"{config['output_stem']}_merged.nc")
+    config.setdefault("img_dir", working_dir / "frames")
+    config.setdefault("vid_dir", working_dir / "videos")
+    for key, value in DEFAULTS.items():
+        config.setdefault(key, value)
+
+    unknown = set(config) - set(inspect.signature(pipeline.main).parameters)
+    if unknown:
+        raise SystemExit(f"Unknown settings in {config_path}: {sorted(unknown)}")
+
+    return config
+
+def arguments(function, config):
+    """
+    The entries of config that are arguments of function.
+    """
+    return {name: config[name] for name in inspect.signature(function).parameters if name in config}
+
+def output_dirs(config):
+    """
+    img_dir and vid_dir, under preview_x{factor}/ for previews, as in main.
+    """
+    if config.get("preview_factor"):
+        return config["img_dir"] / f"preview_x{config['preview_factor']}", config["vid_dir"] / f"preview_x{config['preview_factor']}"
+
+    return config["img_dir"], config["vid_dir"]
+
+def with_legacy_fields(config):
+    """
+    config with u and v in pl_vars turned into a wind channel if derived_fields isn't set, as main does 
+    (see pipeline.legacy_derived_fields). Used once the log is set up, so its warning goes there.
+    """
+    data_params, derived_fields = pipeline.legacy_derived_fields(config["data_params"], config["derived_fields"])
+
+    return dict(config, data_params=data_params, derived_fields=derived_fields)
+
+def plan(config):
+    print(json.dumps(pipeline.plan_run(**arguments(pipeline.plan_run, config)), indent=2))
+
+def fetch(config):
+    pipeline.fetch_data(**arguments(pipeline.fetch_data, config))
+
+def process(config):
+    if not config["output_ds_path"]:
+        raise SystemExit("process needs an output_ds_path to save the processed dataset to")
+
+    sfc_request, pl_request, time_range, drop_inputs = pipeline.fetch_data(**arguments(pipeline.fetch_data, config), download=False)
+    missing = [f"{request['target']}" for request in (sfc_request, pl_request) if request["request"]["variable"] and not request["target"].exists()]
+    if missing:
+        raise SystemExit(f"Missing downloads {missing} - run fetch first")
+
+    pipeline.postprocessing(
+        sfc_request, pl_request, config["output_ds_path"], config["rm_originals"],
+        time_chunk=config.get("time_chunk"), keep_levels=config.get("keep_levels", False), zarr_params=config.get("zarr_params"),
+        pyramid_factors=config.get("pyramid_factors"), time_range=time_range, derived_fields=config["derived_fields"], drop_inputs=drop_inputs,
+    ).close()
+
+def render(config, encode = False):
+    ds_path = config["use_ds"] or config["output_ds_path"]
+    if not ds_path or not ds_path.exists():
+        raise SystemExit(f"No dataset at {ds_path} - run process first, or set use_ds")
+
+    time_chunk = config.get("time_chunk")
+    ds = pipeline.open_output(ds_path, chunks={"time": time_chunk} if time_chunk else None)
+    color_stats = pipeline.read_channel_stats(pipeline.stats_path(ds_path))
+    if config.get("preview_factor"):
+        ds = pipeline.preview_dataset(ds, ds_path, config["preview_factor"], time_chunk)
+
+    if config["use_ds"] and config["data_params"].get("area"): # downloads are already cut to the area by the CDS
+        ds = pipeline.subset_area(ds, config["data_params"]["area"])
+
+    img_dir, vid_dir = output_dirs(config)
+    pipeline.render_dataset(ds, color_stats, **arguments(pipeline.render_dataset, dict(config, img_dir=img_dir, vid_dir=vid_dir)), encode=encode)
+    ds.close()
+
+def encode(config):
+    img_dir, vid_dir = output_dirs(config)
+    pipeline.encode_frames(img_dir, vid_dir, config["fps"], config.get("encode_params"))
+
+def run(config):
+    pipeline.main(**config)
+
+COMMANDS = dict(plan=plan, fetch=fetch, process=process, render=render, encode=encode, run=run)
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description="Download ERA5 data and turn it into videos, configured by a TOML file.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, help in (
+        ("plan", "print the requests, timesteps, frames and estimated disk usage of a run, without running anything"),
+        ("fetch", "download the data from the CDS"),
+        ("process", "merge the downloads, derive fields and save output_ds_path"),
+        ("render", "render frames from output_ds_path (or use_ds); streamed videos and dashboards are encoded too"),
+        ("encode", "encode the saved frames into videos"),
+        ("run", "do everything, like run_pipeline.py"),
+    ):
+        command = commands.add_parser(name, help=help)
+        command.add_argument("config", type=pathlib.Path, help="TOML config file, see config.example.toml")
+        if name == "run":
+            command.add_argument("--dry-run", action="store_true", help="only print the plan")
+
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    config = load_config(args.config)
+    if args.command == "plan" or getattr(args, "dry_run", False):
+        plan(with_legacy_fields(config))
+
+    else:
+        config["working_dir"].mkdir(parents=True, exist_ok=True)
+        pipeline.setup_logger(config["working_dir"] / "pipeline.log", filemode="w" if args.command == "run" else "a")
+        pipeline.reset_run_report()
+        COMMANDS[args.command](with_legacy_fields(config))
+        if args.command != "run": # main saves its own
+            pipeline.write_run_report(config["working_dir"], config.get("chrome_trace", False))
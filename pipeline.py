@@ -1,71 +1,286 @@
-import cdsapi
 import pathlib
 import logging
 import pprint
-import xarray as xr
-import matplotlib.pyplot as plt
+import json
+import datetime
+import threading
+import queue
+import hashlib
+import itertools
+import time
+import functools
+import contextlib
+import collections
+import concurrent.futures
+import multiprocessing
+import tempfile
+import importlib
+import numpy as np
 import subprocess
 import shutil
+import os
+import sys
+import resource
+import fcntl
 
-def setup_logger(log_loc: pathlib.Path):
+class LazyModule:
+    """
+    Stand-in for a module that is imported the first time one of its attributes is used, so a run that never 
+    downloads or draws a figure (e.g. cli.py plan, or encoding frames) doesn't wait for cdsapi, xarray and matplotlib.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+            
+        return getattr(self._module, attr)
+
+cdsapi = LazyModule("cdsapi")
+xr = LazyModule("xarray")
+matplotlib = LazyModule("matplotlib")
+plt = LazyModule("matplotlib.pyplot")
+
+CACHE_LOCK = threading.Lock() # guards the request cache index against concurrent downloads in this process, see cache_lock
+NETCDF_LOCK = threading.Lock() # the netCDF and HDF5 libraries crash when two threads use them at once, e.g. in run_pipelined
+
+def setup_logger(log_loc: pathlib.Path, filemode: str = 'w'):
     """
     Logger will be used instead of print statements, except by the Copericus API.
+    Use filemode='a' to add to an existing log, e.g. from a worker process (see run_shards).
     """
+    if filemode == 'w': # start a new log, but open it for appending, so lines from worker processes aren't overwritten
+        open(log_loc, 'w').close()
+        
     logging.basicConfig(filename=log_loc,
-                        filemode='w',
+                        filemode='a',
                         format='%(asctime)s - %(levelname)s\n%(message)s\n',
                         datefmt='%Y-%m-%d %H:%M:%S',
                         level=logging.INFO)
     print(f"Logging to {log_loc}")
 
-def pull_data(
-    year, month, start_day_inc, stop_day_inc, 
-    step_day, start_hour_inc, stop_hour_inc, 
-    step_hour, sfc_vars, pl_vars, pl_levels,
-    target_loc, output_stem, output_stem_explain
-    ):
+RUN_REPORT = {"started": None, "stages": [], "frame_latency": {}} # filled in by stage and record_frame_latencies, see write_run_report
+REPORT_LOCK = threading.Lock() # stages also run in download and encode threads
+OPEN_STAGES = [] # peak memory seen so far by each stage that is still running, see stage
+MAXRSS_SCALE = 1 if sys.platform == "darwin" else 1024 # ru_maxrss is in bytes on macOS, kB on Linux
+LATENCY_BINS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000] # upper edges of the frame latency histogram
+
+def reset_run_report():
     """
-    Using the cdsapi.Client() object, pull data from the ERA5 reanalysis dataset.
-    The cdsapi client expects a valid config file (.cdsapirc) to be present in the user's home directory.
-    
+    Start a new run report, dropping the stages and frame latencies recorded so far.
+    """
+    with REPORT_LOCK:
+        RUN_REPORT.update(started=time.time(), stages=[], frame_latency={})
+
+def resource_snapshot():
+    """
+    Wall and CPU time, peak memory and bytes read and written so far by this process.
     
-    Information on setting up the cdsapi.Client() object can be found here:
-        1. https://cds.climate.copernicus.eu/api-how-to
+    CPU time and peak memory of child processes (e.g. render workers, ffmpeg) are counted once they have finished. Bytes 
+    are those passed through read/write calls, including the pipes to ffmpeg, and are only known on Linux (None elsewhere).
+    """
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    snapshot = dict(
+        time=time.time(), wall=time.perf_counter(), cpu=time.process_time(), children_cpu=children.ru_utime + children.ru_stime, 
+        peak_rss_mb=peak_rss_mb(), child_peak_rss_mb=child_peak_rss_mb(), read_mb=None, written_mb=None,
+    )
+    io_path = pathlib.Path("/proc/self/io")
+    if io_path.exists():
+        counters = dict(line.split(": ") for line in io_path.read_text().splitlines())
+        snapshot.update(read_mb=int(counters["rchar"]) / 1e6, written_mb=int(counters["wchar"]) / 1e6)
+        
+    return snapshot
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process in MB.
     
-    Information on the ERA5 reanalysis dataset can be found here:
-        1. https://confluence.ecmwf.int/display/CKB/ERA5%3A+data+documentation#heading-Parameterlistings
-        2. https://cds.climate.copernicus.eu/cdsapp#!/dataset/reanalysis-era5-single-levels?tab=overview
+    On Linux the peak is read from /proc (VmHWM), since it can be reset (see reset_peak_rss) and, unlike ru_maxrss, 
+    doesn't carry over the peak of the process that spawned this one.
+    """
+    status = pathlib.Path("/proc/self/status")
+    if status.exists():
+        own = next(int(line.split()[1]) * 1024 for line in status.read_text().splitlines() if line.startswith("VmHWM:"))
+        
+    else:
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_SCALE
+        
+    return own / 1e6
+
+def child_peak_rss_mb():
+    """
+    Peak resident memory of the largest finished child process (e.g. a render worker or ffmpeg) in MB, 0 if none has finished.
     
-    year: str - year to pull data from
-    month: str - month to pull data from
-    start_day_inc: str - start day to pull data from (inclusive)
-    stop_day_inc: str - stop day to pull data from (inclusive)
-    step_day: int - step size for days
-    start_hour_inc: str - start hour to pull data from (inclusive)
-    stop_hour_inc: str - stop hour to pull data from (inclusive)
-    step_hour: int - step size for hours
-    sfc_vars: list[str] - list of surface variables to pull (if empty list / None / False, no surface data is pulled)
-    pl_vars: list[str] - list of pressure level variables to pull (if empty list / None / False, no pressure level data is pulled)
-    pl_levels: list[str] - list of pressure levels to pull (in hPa)
+    Unlike peak_rss_mb this can't be reset, so it only ever grows over a run, see stage.
     """
-    logging.info(f"Target directory: {target_loc}")
-    logging.info(f"Output fname format: {output_stem_explain}")
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * MAXRSS_SCALE / 1e6
 
+def reset_peak_rss():
+    """
+    Reset the peak memory of this process to its current memory, where the OS allows it (Linux), so a stage's peak isn't 
+    that of an earlier stage.
+    """
     try:
-        c = cdsapi.Client()
+        pathlib.Path("/proc/self/clear_refs").write_text("5")
+        
+    except OSError:
+        pass
 
-    except Exception as e:
-        logging.exception(e)
+@contextlib.contextmanager
+def stage(name, **details):
+    """
+    Record a stage of the run in RUN_REPORT: its wall time, CPU time (own and of finished child processes), peak memory 
+    and bytes read and written (see resource_snapshot). Stages can be nested and run in several threads at once.
+    
+    The peak memory of child processes is kept apart (child_peak_rss_mb), and only given to a stage if a child finished 
+    during it with more memory than any before it, since it can't be reset; otherwise it is None.
+    
+    Yields details, so the stage can add to them, e.g. the number of frames it rendered.
+    
+    name: str - name of the stage, e.g. the function it times (see instrumented)
+    details: JSON-serializable values to save with the stage, e.g. the channel
+    """
+    with REPORT_LOCK:
+        before = peak_rss_mb()
+        for running in OPEN_STAGES: # the peak memory is reset below, so stages already running keep the peak so far
+            running["peak_rss_mb"] = max(running["peak_rss_mb"], before)
+            
+        record = {"peak_rss_mb": 0.0}
+        OPEN_STAGES.append(record)
+        reset_peak_rss()
+        start = resource_snapshot()
+        
+    try:
+        yield details
+        
+    finally:
+        end = resource_snapshot()
+        with REPORT_LOCK:
+            OPEN_STAGES[:] = [running for running in OPEN_STAGES if running is not record]
+            RUN_REPORT["stages"].append(dict(
+                name=name, pid=os.getpid(), tid=threading.get_native_id(), thread=threading.current_thread().name, start=start["time"], 
+                wall_s=end["wall"] - start["wall"], cpu_s=end["cpu"] - start["cpu"], children_cpu_s=end["children_cpu"] - start["children_cpu"],
+                peak_rss_mb=max(record["peak_rss_mb"], end["peak_rss_mb"]),
+                child_peak_rss_mb=end["child_peak_rss_mb"] if end["child_peak_rss_mb"] > start["child_peak_rss_mb"] else None,
+                read_mb=end["read_mb"] - start["read_mb"] if start["read_mb"] is not None else None,
+                written_mb=end["written_mb"] - start["written_mb"] if start["written_mb"] is not None else None,
+                details=details,
+            ))
 
-    shared = {
-        'product_type': 'reanalysis',
-        'format': 'netcdf',
-        'year': year,
-        'month': month,
-        'day': [f"{i:02}" for i in range(int(start_day_inc), int(stop_day_inc) + 1, step_day)],
-        'time': [f"{i:02}:00" for i in range(int(start_hour_inc), int(stop_hour_inc) + 1, step_hour)], # 00:00, 01:00, ..., 23:00
+def instrumented(func):
+    """
+    Record every call of func as a stage named after it, see stage.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with stage(func.__name__):
+            return func(*args, **kwargs)
+        
+    return wrapper
+
+def record_frame_latencies(key, latencies):
+    """
+    Add the seconds each frame took to render (see render_chunk) to the frame latency histogram of key, e.g. the channel.
+    """
+    with REPORT_LOCK:
+        RUN_REPORT["frame_latency"].setdefault(key, []).extend(latencies)
+
+def latency_histogram(latencies):
+    """
+    Summarize frame latencies (seconds) as count, mean and percentiles in ms, and counts per bin of LATENCY_BINS_MS.
+    """
+    latencies_ms = 1000 * np.asarray(latencies)
+    if not latencies_ms.size:
+        return {"count": 0}
+    
+    counts = np.bincount(np.searchsorted(LATENCY_BINS_MS, latencies_ms), minlength=len(LATENCY_BINS_MS) + 1)
+    
+    return {
+        "count": int(latencies_ms.size), "mean_ms": float(latencies_ms.mean()), "total_s": float(latencies_ms.sum() / 1000),
+        **{f"p{q}_ms": float(np.percentile(latencies_ms, q)) for q in (50, 90, 99)}, "max_ms": float(latencies_ms.max()),
+        "bins": {f"<={edge}ms": int(count) for edge, count in zip(LATENCY_BINS_MS, counts)} | {f">{LATENCY_BINS_MS[-1]}ms": int(counts[-1])},
     }
 
+def run_report_part():
+    """
+    The stages and frame latencies recorded in this process, for a worker process to hand back to the parent (see merge_run_report).
+    """
+    with REPORT_LOCK:
+        return dict(stages=list(RUN_REPORT["stages"]), frame_latency={key: list(value) for key, value in RUN_REPORT["frame_latency"].items()})
+
+def merge_run_report(part):
+    """
+    Add the stages and frame latencies recorded by a worker process (see run_report_part) to this process's report.
+    """
+    with REPORT_LOCK:
+        RUN_REPORT["stages"].extend(part["stages"])
+        for key, latencies in part["frame_latency"].items():
+            RUN_REPORT["frame_latency"].setdefault(key, []).extend(latencies)
+
+def write_run_report(report_dir, chrome_trace = False):
+    """
+    Save the run report as report_dir/run_report.json and log a summary of where the time went.
+    
+    The report lists every stage (see stage) and, per stage name, the number of calls and the total wall time, 
+    CPU time and bytes read and written, plus a histogram of frame render latencies per channel (see latency_histogram).
+    Stages run by worker processes are included if they were handed back (see merge_run_report).
+    
+    If chrome_trace is set, the stages are also saved as report_dir/run_trace.json, in the Chrome trace event format
+    (open it in chrome://tracing or https://ui.perfetto.dev), with a row per process and thread.
+    """
+    with REPORT_LOCK:
+        stages = sorted(RUN_REPORT["stages"], key=lambda record: record["start"])
+        started = RUN_REPORT["started"] or min((record["start"] for record in stages), default=time.time())
+        frame_latency = {key: latency_histogram(latencies) for key, latencies in RUN_REPORT["frame_latency"].items()}
+        
+    totals = {}
+    for record in stages:
+        total = totals.setdefault(record["name"], dict(calls=0, wall_s=0.0, cpu_s=0.0, children_cpu_s=0.0, read_mb=0.0, written_mb=0.0, peak_rss_mb=0.0, child_peak_rss_mb=None))
+        total["calls"] += 1
+        total["peak_rss_mb"] = max(total["peak_rss_mb"], record["peak_rss_mb"])
+        if record["child_peak_rss_mb"] is not None:
+            total["child_peak_rss_mb"] = max(total["child_peak_rss_mb"] or 0.0, record["child_peak_rss_mb"])
+        for key in ("wall_s", "cpu_s", "children_cpu_s", "read_mb", "written_mb"):
+            total[key] += record[key] or 0.0
+            
+    report = dict(
+        started=datetime.datetime.fromtimestamp(started).isoformat(timespec="seconds"), wall_s=time.time() - started, 
+        peak_rss_mb=peak_rss_mb(), child_peak_rss_mb=child_peak_rss_mb(), cores=available_cores(), totals=totals, frame_latency=frame_latency, 
+        stages=[dict(record, start=record["start"] - started) for record in stages],
+    )
+    report_path = report_dir / "run_report.json"
+    report_path.write_text(json.dumps(report, indent=2, default=str))
+    summary = "\n".join(
+        f"\t{name}: {total['calls']}x, {total['wall_s']:.1f}s wall, {total['cpu_s'] + total['children_cpu_s']:.1f}s CPU, peak {total['peak_rss_mb']:.0f} MB"
+        + (f" (child processes {total['child_peak_rss_mb']:.0f} MB)" if total["child_peak_rss_mb"] is not None else "")
+        for name, total in sorted(totals.items(), key=lambda item: -item[1]["wall_s"])
+    )
+    logging.info(f"Run report saved to {report_path} ({report['wall_s']:.1f}s in all). Time per stage (nested stages are included in their parents):\n{summary}")
+    
+    if chrome_trace:
+        events = [
+            dict(
+                name=record["name"], cat="stage", ph="X", ts=record["start"] * 1e6, dur=record["wall_s"] * 1e6, pid=record["pid"], tid=record["tid"], 
+                args=dict(thread=record["thread"], cpu_s=record["cpu_s"], children_cpu_s=record["children_cpu_s"], peak_rss_mb=record["peak_rss_mb"], child_peak_rss_mb=record["child_peak_rss_mb"], read_mb=record["read_mb"], written_mb=record["written_mb"], **record["details"]),
+            )
+            for record in stages
+        ]
+        trace_path = report_dir / "run_trace.json"
+        trace_path.write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}, default=str))
+        logging.info(f"Chrome trace saved to {trace_path}")
+        
+    return report
+
+def era5_requests(shared, sfc_vars, pl_vars, pl_levels, target_loc, output_stem):
+    """
+    Build the single-level (sfc) and pressure-level (pl) requests for the cdsapi client.
+    
+    shared: dict - request keys common to both datasets (product_type, format, year, month, day, time)
+    
+    Returns two dicts with the "name", "request", and "target" arguments of cdsapi.Client().retrieve().
+    """
     sfc_request = {
         "name": "reanalysis-era5-single-levels",
         "request": {
@@ -84,243 +299,2774 @@ def pull_data(
         },
         "target": target_loc / f'{output_stem}_pl.nc'
     }
-
-    if sfc_vars:
-        logging.info(f"Starting download of {sfc_request['name']} data")
-        c.retrieve(**sfc_request)
-        logging.info(f"Completed download. Request info: \n{pprint.pformat(sfc_request)}")
-
-    if pl_vars:
-        logging.info(f"Starting download of {pl_request['name']} data")
-        c.retrieve(**pl_request)
-        logging.info(f"Completed download. Request info: \n{pprint.pformat(pl_request)}")
-        
-    logging.info(f"Completed all downloads.")
     
     return sfc_request, pl_request
 
-def postprocessing(sfc_request, pl_request, output_path, rm_originals, lookup_variables):
+def canonical_request(name, request):
     """
-    Merge pl and sfc data, convert to xarray ds, derive fields (e.g. wind speed, wind direction, etc.)
+    Normalize a cdsapi request so that equivalent requests compare (and hash) equal.
     
-    lookup table for variable names
-    see https://confluence.ecmwf.int/display/CKB/ERA5%3A+data+documentation#heading-Parameterlistings
-    if you need more variables
+    year/month/day/time are expanded into the sorted list of timestamps they cover, and all other lists (except area) are sorted,
+    so it doesn't matter how a request was written (e.g. "06" vs ["06"], or days in a different order).
     """
-    sfc_exists = sfc_request['target'].exists()
-    pl_exists = pl_request['target'].exists()
+    def as_list(value):
+        return [f"{v}" for v in value] if isinstance(value, (list, tuple)) else [f"{value}"]
     
-    if sfc_exists:
-        sfc_ds = xr.open_dataset(sfc_request['target'])
-    
-    if pl_exists:
-        pl_ds = xr.open_dataset(pl_request['target'])
-
-    # Merge the two datasets along the common dimensions (longitude, latitude, time)
-    if sfc_exists and pl_exists:
-        out_ds = xr.merge([sfc_ds, pl_ds], compat='override')
+    canonical = {"name": name}
+    for key, value in request.items():
+        if key == 'area': # [north, west, south, east], so order matters
+            canonical[key] = [float(v) for v in value]
+            
+        elif key not in ('year', 'month', 'day', 'time'):
+            canonical[key] = sorted(as_list(value)) if isinstance(value, (list, tuple)) else value
+            
+    datetimes = set()
+    for year, month, day, hour in itertools.product(as_list(request['year']), as_list(request['month']), as_list(request['day']), as_list(request['time'])):
+        try:
+            datetimes.add(datetime.datetime(int(year), int(month), int(day), int(hour.split(':')[0])).isoformat())
+        except ValueError: # e.g. day 31 of a 30 day month, which the CDS skips too
+            continue
         
-    else:
-        out_ds = sfc_ds if sfc_exists else pl_ds
+    canonical["datetimes"] = sorted(datetimes)
+    
+    return canonical
 
-    # Loop through pressure levels and create new data variables with updated names
-    if pl_exists:
-        # logging.info(f"PL: \n{pl_ds}")
-        windflag = False # winds are not always requested, but u and v terms need to be processed into wind speed if they are
-        if 'u_component_of_wind' in pl_request['request']['variable'] and 'v_component_of_wind' in pl_request['request']['variable']:
-            windflag = True
-            
-        pl_levels = pl_request['request']['pressure_level']
-        multi_level = len(pl_levels) > 1 # if there are multiple levels, we can't use the level dimension (not generated)
-
-        for level in pl_levels:
-            for var in pl_request['request']["variable"]:
-                short_var = lookup_variables[var]
-                if var in ('u_component_of_wind', 'v_component_of_wind'):
-                    continue # ignore, we'll process these later
-                
-                if multi_level:
-                    out_ds[f'{short_var}{level}'] = pl_ds[short_var].sel(level=int(level))
-                    
-                else: 
-                    out_ds[f'{short_var}{level}'] = pl_ds[short_var]
+def request_key(canonical):
+    """
+    Content address of a canonical request: the sha256 of its JSON representation.
+    """
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode()).hexdigest()
 
-            # Add the new data variables to the merged dataset
-            if windflag:
-                if multi_level:
-                    out_ds[f'wind{level}'] = (pl_ds.u.sel(level=level)**2 + pl_ds.v.sel(level=int(level))**2)**0.5
-                    
-                else:
-                    out_ds[f'wind{level}'] = (pl_ds.u**2 + pl_ds.v**2)**0.5
+def read_cache_index(cache_dir):
+    """
+    Index of a request cache: {key: {"request": canonical request, "size": bytes, "last_used": unix time}}
+    """
+    index_path = cache_dir / "index.json"
+    
+    return json.loads(index_path.read_text()) if index_path.exists() else {}
 
-    # Remove the original data variables from the merged dataset
-    if pl_exists:
-        for var in pl_request['request']["variable"]:
-            short_var = lookup_variables[var]
-            try:
-                out_ds = out_ds.drop_vars(short_var)
-            except ValueError as e:
-                logging.warning(f"Variable {short_var} not in dataset - skipping")
-                logging.exception(e)
+def write_cache_index(cache_dir, index):
+    """
+    Atomically replace the index of a request cache, so a crash never leaves it half-written.
+    """
+    with tempfile.NamedTemporaryFile("w", dir=cache_dir, prefix="index.", suffix=".json.part", delete=False) as partial:
+        partial.write(json.dumps(index, indent=2))
+        
+    pathlib.Path(partial.name).replace(cache_dir / "index.json")
 
-        if multi_level:
-            out_ds = out_ds.drop_dims('level')
+@contextlib.contextmanager
+def cache_lock(cache_dir):
+    """
+    Exclusive access to a request cache, between the download threads of this process (CACHE_LOCK) and between 
+    processes sharing the cache directory, e.g. the shards of run_shards (an flock on index.lock).
+    """
+    with CACHE_LOCK, open(cache_dir / "index.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX) # released when the file is closed
+        yield
 
-    # Print the resulting dataset
-    logging.info(f"Resulting dataset: \n{out_ds}")
+def find_cached_superset(index, canonical):
+    """
+    Find a cache entry that contains everything a request asks for (same dataset, and a superset of its timestamps, 
+    levels, variables and area), or None.
+    
+    Extra variables must have a known short name (see file_variable), so they can be dropped when subsetting.
+    Among several candidates, the smallest file is used.
+    """
+    subset_keys = ("variable", "pressure_level", "datetimes")
+    candidates = []
+    for key, entry in index.items():
+        cached = entry["request"]
+        if any(cached.get(k) != v for k, v in canonical.items() if k not in subset_keys + ("area",)):
+            continue
+        
+        if set(cached) - {"area"} != set(canonical) - {"area"} or not all(set(canonical[k]) <= set(cached[k]) for k in subset_keys if k in canonical):
+            continue
+        
+        if not area_contains(cached.get("area"), canonical.get("area")):
+            continue
+        
+        extra_vars = set(cached["variable"]) - set(canonical["variable"])
+        if not all(file_variable(var) for var in extra_vars):
+            continue
+        
+        candidates.append((entry["size"], key))
+        
+    return min(candidates)[1] if candidates else None
 
-    # Save the resulting dataset if desired
-    if output_path: # if output_path is not None, save the dataset
-        out_ds.to_netcdf(output_path)
-        logging.info(f"Saving dataset to {output_path}")
+def subset_cached(cached_path, cached, canonical, target):
+    """
+    Write the part of a cached superset file that a request asks for to target, formatted like the CDS would return it.
+    """
+    with NETCDF_LOCK: # downloads run in threads
+        ds = xr.open_dataset(cached_path)
+        ds = ds.isel(time=ds.time.isin(np.array(canonical["datetimes"], dtype='datetime64[ns]')).values)
         
-    if rm_originals:
-        if sfc_exists:
-            sfc_request['target'].unlink()
-            logging.info(f"Deleted {sfc_request['target']}")
-            
-        if pl_exists:
-            pl_request['target'].unlink()
-            logging.info(f"Deleted {pl_request['target']}")
+        extra_vars = set(cached["variable"]) - set(canonical["variable"])
+        ds = ds.drop_vars([file_variable(var) for var in extra_vars])
+        
+        if "pressure_level" in canonical and "level" in ds.dims:
+            levels = [int(level) for level in canonical["pressure_level"]]
+            ds = ds.sel(level=levels)
+            if len(levels) == 1: # the CDS leaves out the level dimension for a single level
+                ds = ds.isel(level=0, drop=True)
+                
+        if canonical.get("area") and canonical["area"] != cached.get("area"):
+            ds = subset_area(ds, canonical["area"])
             
-    return out_ds
+        ds.to_netcdf(target)
+        ds.close()
 
-def fmt_time_str(t, fmt="%Y-%m-%d %Hz"): 
-    """For some reason, this works."""
-    return t.astype('datetime64[s]').item().strftime(fmt)
-    
-def plot_frames(ds, output_dir, channel_metadata, border_color, plot_metadata, metadata_pos, default_cmap_name = "viridis"):
+def area_contains(outer, inner):
     """
-    Plot frames of video for each channel and time.
+    Whether a CDS area [north, west, south, east] covers another one. None is the whole globe.
+    """
+    if outer is None:
+        return True
     
-    in channel_metadata, pref_cmap is the colormap to use for the channel. 
-    units is the units of the channel. In this program, units won't be used unless
-    you modify the program to show the cbar and label.
-    Set the pref_cmap to False to use the default colormap, which is viridis.
-    Here's a link to some colormaps: https://matplotlib.org/stable/tutorials/colors/colormaps.html
-    border_color is the color of the border above & below the image. Use plt colors.
+    if inner is None:
+        return False
     
-    output_dir: pathlib.Path - directory to save frames to
-    channel_metadata: dict - see above
-    border_color: str - color of border above & below image
-    plot_metadata: bool - whether to plot metadata (time, channel, etc.) on the image
-    default_cmap_name: str - default colormap to use if channel not in channel_metadata
-    metadata_pos: str - where to plot metadata (upper-right, upper-left, lower-right, lower-left)
-    """
-    # deriving some useful items
-    ds = ds.isel(latitude=slice(0, 720))
-    channels = list(ds.data_vars.keys())
-    times = ds.time.values
-    data_dims = (720, 1440)
-    img_size_in = (16, 10)
-    dpi = int(data_dims[1] / img_size_in[0])
-
-    for channel_idx, channel in enumerate(channels):
-        channel_dir = output_dir / f"var_{channel}"
-        channel_dir.mkdir(parents=True, exist_ok=True)
-        da = ds[channel] 
-        cbar_lower, cbar_upper = da.min(), da.max() # ensure colors are consistent across frames
-        logging.info(f"Generating frames for channel {channel} ({channel_idx+1}/{len(channels)})")
-        
-        if channel in channel_metadata:
-            cmap_name = channel_metadata[channel]["pref_cmap"] # if channel is not saved, can't plot until saved
-            
-        else: 
-            cmap_name = default_cmap_name
-            logging.warning(f"Channel {channel} not in channel_metadata - using default colormap {default_cmap_name}")
-        
-        for t_idx, t in enumerate(times):
-            t_path = channel_dir / f"{t_idx+1:04}.png" # output path for this frame
-            field = da.isel(time=t_idx)
-            fig, ax = plt.subplots(figsize=img_size_in) # create figure
-            ax.imshow(field, cmap=cmap_name, vmin=cbar_lower, vmax=cbar_upper) # plot field
-            
-            # clear axes and fill with black outside of data
-            ax.axis('off')
-            ax.set_position([0, 0.08, 1, 0.8]) # (left, bottom, width, height), could use [0, 0.1, 1, 0.8] for symmetry
-            
-            # plot metadata
-            metadata_pos_options = {
-                "upper-right" : {"time": (0.9, 1.03), "channel": (0.9, 1.08)},
-                "upper-left" : {"time": (0.1, 1.03), "channel": (0.1, 1.08)},
-                "lower-right" : {"time": (0.9, -0.03), "channel": (0.9, -0.08)},
-                "lower-left" : {"time": (0.1, -0.03), "channel": (0.1, -0.08)},
-            }
-            if plot_metadata:
-                ax.text(*metadata_pos_options[metadata_pos]["channel"], f"{channel}", transform=ax.transAxes, ha='center', va='center', fontsize=20, color='white' if border_color != 'white' else 'black')
-                ax.text(*metadata_pos_options[metadata_pos]["time"], f"{fmt_time_str(t)}", transform=ax.transAxes, ha='center', va='center', fontsize=20, color='white' if border_color != 'white' else 'black')
+    return outer[0] >= inner[0] and outer[1] <= inner[1] and outer[2] <= inner[2] and outer[3] >= inner[3]
 
-            fig.set_facecolor(border_color)
-            fig.savefig(t_path, dpi=dpi)
-            plt.close(fig)
-            
-    logging.info(f"Completed generating frames for all channels.")
+def subset_area(ds, area):
+    """
+    Select a bounding box from a dataset.
     
-def dir2movie(
-    input_dir: pathlib.Path,
-    output_path: pathlib.Path,
-    input_fmt: str = r'%04d.png',
-    fps: int = 24,
-    ):
+    area: list[float] - [north, west, south, east] in degrees, like the "area" of a CDS request. Longitudes can be
+        given as -180..180 or 0..360, whichever the dataset uses; a box across the dataset's longitude seam 
+        (e.g. the Greenwich meridian on a 0..360 grid) is stitched together so its longitudes keep increasing.
     """
-    Convert a directory of images to an mp4 movie.
+    north, west, south, east = (float(v) for v in area)
+    ds = ds.sel(latitude=slice(north, south) if ds.latitude[0] > ds.latitude[-1] else slice(south, north))
+    if east - west >= 360: # every longitude
+        return ds
     
-    If you are seeing all of your frames outputted properly,
-    but the movie is not being created, you may need to modify
-    the 'cmd = ...' below, which is run from the shell to create
-    the video out of the images. You may need to preface 'ffmpeg' 
-    with 'python -m' or 'python3 -m', depending on your system.
+    if ds.longitude.max() > 180: # 0..360 grid
+        west, east = west % 360, east % 360
+        
+    else:
+        west, east = (west + 180) % 360 - 180, (east + 180) % 360 - 180
+        
+    if west <= east:
+        return ds.sel(longitude=slice(west, east))
     
-    Output from this function will be printed to the terminal, not logged.
-    You can change this by passing an output stream to the subprocess.run() call.
-    """
-    cmd = f"ffmpeg -framerate {fps} -i '{input_fmt}' -c:v libx264 -pix_fmt yuv420p {output_path}"
-    logging.info(f"Using command: \n\t{cmd}")
-    subprocess.run(cmd, shell=True, cwd=input_dir)
-    logging.info(f"Probably saved movie to {output_path}")    
+    western, eastern = ds.sel(longitude=slice(west, None)), ds.sel(longitude=slice(None, east))
+    
+    return xr.concat([western.assign_coords(longitude=western.longitude - 360), eastern], dim="longitude")
 
-def main(
-    data_params, vid_dir, img_dir, use_ds, 
-    output_ds_path, rm_originals, rm_images, 
-    lookup_variables, channel_metadata, 
-    border_color, fps, plot_metadata, metadata_pos,
-    output_stem_explain, working_dir, output_stem
-    ):
-    # prepare home dir and output dirs
-    vid_dir.mkdir(parents=True, exist_ok=True)
-    img_dir.mkdir(parents=True, exist_ok=True)
+@instrumented
+def cached_retrieve(client, name, request, target, cache):
+    """
+    Drop-in replacement for client.retrieve(name, request, target) that consults a local, content-addressed cache first.
     
-    # load dataset
-    if use_ds: # use a pre-existing dataset
-        ds = xr.open_dataset(use_ds)
-        
-    else: # if not using a pre-existing dataset, pull data from cdsapi and process it
-        # pull data
-        sfc_request, pl_request = pull_data(**data_params, target_loc=working_dir, output_stem=output_stem, output_stem_explain=output_stem_explain)
+    Requests are keyed by request_key(canonical_request(...)). A request is served from the cache if the same request
+    was downloaded before, or by subsetting a cached request that covers it (see find_cached_superset). Otherwise it is
+    downloaded and added to the cache, and the least recently used entries are evicted to stay under the size cap.
+    Cached files are kept separate from target, so deleting target (e.g. rm_originals) doesn't empty the cache.
+    
+    cache: dict - cache_dir (pathlib.Path) and max_gb (float, or None for no cap); if None, the request is simply downloaded
+    """
+    if not cache:
+        return client.retrieve(name, request, f"{target}")
+    
+    cache_dir = pathlib.Path(cache["cache_dir"])
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    canonical = canonical_request(name, request)
+    key = request_key(canonical)
+    
+    with cache_lock(cache_dir): # held while reading a hit, so another download can't evict it meanwhile
+        index = read_cache_index(cache_dir)
+        n_entries = len(index)
+        hit = key if key in index else find_cached_superset(index, canonical)
+        while hit and not (cache_dir / f"{hit}.nc").exists(): # deleted by hand
+            logging.warning(f"Cached request {hit[:12]} is missing from {cache_dir} - dropping it from the index")
+            del index[hit]
+            hit = key if key in index else find_cached_superset(index, canonical)
+            
+        if hit:
+            index[hit]["last_used"] = time.time()
+            
+        if hit or len(index) < n_entries:
+            write_cache_index(cache_dir, index)
+            
+        if hit == key:
+            logging.info(f"Cache hit for {name} request {key[:12]}")
+            shutil.copyfile(cache_dir / f"{key}.nc", target)
+            return
+            
+        if hit:
+            logging.info(f"Cache hit for {name} request {key[:12]}, subsetting cached request {hit[:12]}")
+            subset_cached(cache_dir / f"{hit}.nc", index[hit]["request"], canonical, target)
+            return
+            
+    client.retrieve(name, request, f"{target}")
+    shutil.copyfile(target, cache_dir / f"{key}.nc")
+    
+    with cache_lock(cache_dir):
+        index = read_cache_index(cache_dir)
+        index[key] = {"request": canonical, "size": pathlib.Path(target).stat().st_size, "last_used": time.time()}
         
-        # post process data
-        ds = postprocessing(sfc_request, pl_request, output_ds_path, rm_originals, lookup_variables)
+        # evict least recently used entries until under the cap (the new entry goes last)
+        max_bytes = cache["max_gb"] * 1e9 if cache.get("max_gb") else float("inf")
+        for old_key in sorted(index, key=lambda k: (k == key, index[k]["last_used"])):
+            if sum(entry["size"] for entry in index.values()) <= max_bytes:
+                break
+            
+            (cache_dir / f"{old_key}.nc").unlink(missing_ok=True)
+            del index[old_key]
+            if old_key == key:
+                logging.warning(f"{name} request {key[:12]} is larger than the cache cap ({cache['max_gb']} GB) - not cached")
+                
+            else:
+                logging.info(f"Evicted {old_key[:12]} from cache {cache_dir}")
+            
+        write_cache_index(cache_dir, index)
         
-    # plot frames of video
-    plot_frames(ds, img_dir, channel_metadata, border_color, plot_metadata, metadata_pos=metadata_pos)
+    if key in index:
+        logging.info(f"Cached {name} request {key[:12]} in {cache_dir}")
+
+@instrumented
+def pull_data(
+    year, month, start_day_inc, stop_day_inc, 
+    step_day, start_hour_inc, stop_hour_inc, 
+    step_hour, sfc_vars, pl_vars, pl_levels,
+    target_loc, output_stem, output_stem_explain,
+    cache = None, area = None,
+    ):
+    """
+    Using the cdsapi.Client() object, pull data from the ERA5 reanalysis dataset.
+    The cdsapi client expects a valid config file (.cdsapirc) to be present in the user's home directory.
     
-    # create video
-    logging.info("Creating videos")
     
-    for dir in img_dir.glob("var_*"): # glob format set in plot_frames() above
-        logging.info(f"Creating video for {dir.name}")
-        varname = dir.name.split("_")[1]
-        vid_output_path = vid_dir / f"{varname}.mp4"
-        dir2movie(input_dir=dir, output_path=vid_output_path, fps=fps) # input_fmt set in plot_frames() above
+    Information on setting up the cdsapi.Client() object can be found here:
+        1. https://cds.climate.copernicus.eu/api-how-to
     
-    logging.info("Videos created (maybe)")
+    Information on the ERA5 reanalysis dataset can be found here:
+        1. https://confluence.ecmwf.int/display/CKB/ERA5%3A+data+documentation#heading-Parameterlistings
+        2. https://cds.climate.copernicus.eu/cdsapp#!/dataset/reanalysis-era5-single-levels?tab=overview
     
-    # delete images
-    if rm_images:
-        shutil.rmtree(img_dir)
-        logging.info("Deleted all frames")
-        
-    ds.close()
+    year: str - year to pull data from
+    month: str - month to pull data from
+    start_day_inc: str - start day to pull data from (inclusive)
+    stop_day_inc: str - stop day to pull data from (inclusive)
+    step_day: int - step size for days
+    start_hour_inc: str - start hour to pull data from (inclusive)
+    stop_hour_inc: str - stop hour to pull data from (inclusive)
+    step_hour: int - step size for hours
+    sfc_vars: list[str] - list of surface variables to pull (if empty list / None / False, no surface data is pulled)
+    pl_vars: list[str] - list of pressure level variables to pull (if empty list / None / False, no pressure level data is pulled)
+    pl_levels: list[str] - list of pressure levels to pull (in hPa)
+    cache: dict - settings for a local request cache that is checked before downloading (see cached_retrieve), or None
+    area: list[float] - [north, west, south, east] bounding box to download, in degrees, or None for the whole globe
+    """
+    logging.info(f"Target directory: {target_loc}")
+    logging.info(f"Output fname format: {output_stem_explain}")
+
+    try:
+        c = cdsapi.Client()
+
+    except Exception as e:
+        logging.exception(e)
+
+    sfc_request, pl_request = month_requests(year, month, start_day_inc, stop_day_inc, step_day, start_hour_inc, stop_hour_inc, step_hour, sfc_vars, pl_vars, pl_levels, target_loc, output_stem, area)
+
+    if sfc_vars:
+        logging.info(f"Starting download of {sfc_request['name']} data")
+        cached_retrieve(c, **sfc_request, cache=cache)
+        logging.info(f"Completed download. Request info: \n{pprint.pformat(sfc_request)}")
+
+    if pl_vars:
+        logging.info(f"Starting download of {pl_request['name']} data")
+        cached_retrieve(c, **pl_request, cache=cache)
+        logging.info(f"Completed download. Request info: \n{pprint.pformat(pl_request)}")
+        
+    logging.info("Completed all downloads.")
+    
+    return sfc_request, pl_request
+
+def month_requests(
+    year, month, start_day_inc, stop_day_inc, step_day, start_hour_inc, stop_hour_inc, step_hour, 
+    sfc_vars, pl_vars, pl_levels, target_loc, output_stem, area = None,
+    ):
+    """
+    The sfc and pl requests of pull_data (see era5_requests), without downloading anything.
+    """
+    shared = {
+        'product_type': 'reanalysis',
+        'format': 'netcdf',
+        'year': year,
+        'month': month,
+        'day': [f"{i:02}" for i in range(int(start_day_inc), int(stop_day_inc) + 1, step_day)],
+        'time': [f"{i:02}:00" for i in range(int(start_hour_inc), int(stop_hour_inc) + 1, step_hour)], # 00:00, 01:00, ..., 23:00
+    }
+    if area: # only download the bounding box
+        shared['area'] = list(area)
+        
+    return era5_requests(shared, sfc_vars, pl_vars, pl_levels, target_loc, output_stem)
+
+def split_request(request, chunk_by):
+    """
+    Split an sfc or pl request from era5_requests into sub-requests that the CDS can serve independently.
+    
+    Requests are always split by month, since the CDS takes the cartesian product of year, month and day.
+    
+    request: dict - the "request" of an sfc or pl request, plus a "dates" key listing the days (datetime.date) to pull
+    chunk_by: str or list[str] - further split each month by "day" and/or "variable"
+    
+    Returns a list of (chunk_id, request) pairs, where chunk_id is unique and stable across runs.
+    """
+    chunk_by = {chunk_by} if isinstance(chunk_by, str) else set(chunk_by)
+    request = dict(request)
+    dates = request.pop("dates")
+    
+    months = {}
+    for date in dates:
+        months.setdefault((date.year, date.month), []).append(date)
+        
+    date_groups = [[date] for date in dates] if "day" in chunk_by else list(months.values())
+    variable_groups = [[var] for var in request['variable']] if "variable" in chunk_by else [request['variable']]
+    
+    chunks = []
+    for group in date_groups:
+        for variables in variable_groups:
+            chunk_id = f"{group[0]:%Y%m%d}-{group[-1]:%Y%m%d}"
+            if "variable" in chunk_by:
+                chunk_id += f"_{variables[0]}"
+                
+            chunks.append((chunk_id, {
+                **request,
+                'variable': variables,
+                'year': f"{group[0].year}",
+                'month': f"{group[0].month:02}",
+                'day': [f"{date.day:02}" for date in group],
+            }))
+            
+    return chunks
+
+def retrieve_chunks(chunks, manifest_path, max_workers, client_factory, cache = None):
+    """
+    Download sub-requests concurrently with a bounded thread pool, recording each completed chunk in a manifest.
+    
+    chunks: list[dict] - each with "id", "name", "request" and "target" keys
+    manifest_path: pathlib.Path - JSON file of completed chunks, by id, with the key of the request each was downloaded 
+        with (see request_key); chunks listed there with the same request (and whose file still exists) are skipped, 
+        so an interrupted job resumes where it left off, but not with data from a run with other levels, hours or area
+    max_workers: int - maximum number of requests in flight at once
+    client_factory: callable - returns a cdsapi.Client()-like object with a retrieve(name, request, target) method;
+        each thread builds its own client
+    cache: dict - request cache settings, see cached_retrieve
+    """
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {"completed": {}}
+    keys = {chunk["id"]: request_key(canonical_request(chunk["name"], chunk["request"])) for chunk in chunks}
+    
+    def done(chunk):
+        entry = manifest["completed"].get(chunk["id"])
+        
+        return isinstance(entry, dict) and entry["request_key"] == keys[chunk["id"]] and chunk["target"].exists()
+    
+    todo = [chunk for chunk in chunks if not done(chunk)]
+    logging.info(f"{len(chunks) - len(todo)} of {len(chunks)} chunks already downloaded (manifest: {manifest_path})")
+    
+    lock = threading.Lock()
+    local = threading.local()
+    
+    def retrieve(chunk):
+        if not hasattr(local, "client"):
+            local.client = client_factory()
+            
+        # download to a temporary name, so a half-written file is never mistaken for a finished chunk
+        partial = chunk["target"].with_name(chunk["target"].name + ".part")
+        logging.info(f"Starting download of chunk {chunk['id']} ({chunk['name']})")
+        cached_retrieve(local.client, chunk["name"], chunk["request"], partial, cache)
+        partial.replace(chunk["target"])
+        
+        with lock:
+            manifest["completed"][chunk["id"]] = {"target": f"{chunk['target']}", "request_key": keys[chunk["id"]]}
+            manifest_path.write_text(json.dumps(manifest, indent=2))
+            
+        logging.info(f"Completed download of chunk {chunk['id']}")
+        
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for future in concurrent.futures.as_completed([pool.submit(retrieve, chunk) for chunk in todo]):
+            future.result() # re-raise download errors; completed chunks stay in the manifest for the next attempt
+
+def range_requests(
+    start_date, stop_date_inc, start_hour_inc, stop_hour_inc, step_hour, sfc_vars, pl_vars, pl_levels,
+    target_loc, output_stem, step_day = 1, chunk_by = "day", area = None,
+    ):
+    """
+    The sfc and pl requests of pull_data_range (see era5_requests), and the sub-requests they are downloaded as,
+    without downloading anything.
+    
+    Returns the sfc and pl requests, and a list of sub-requests: dicts with an "id" and the "name", "request" 
+    and "target" arguments of cdsapi.Client().retrieve().
+    """
+    start, stop = (datetime.datetime.fromisoformat(date).date() for date in (start_date, stop_date_inc))
+    dates = [start + datetime.timedelta(days=i) for i in range(0, (stop - start).days + 1, step_day)]
+    
+    shared = {
+        'product_type': 'reanalysis',
+        'format': 'netcdf',
+        'year': sorted({f"{date.year}" for date in dates}),
+        'month': sorted({f"{date.month:02}" for date in dates}),
+        'day': sorted({f"{date.day:02}" for date in dates}),
+        'time': [f"{i:02}:00" for i in range(int(start_hour_inc), int(stop_hour_inc) + 1, step_hour)], # 00:00, 01:00, ..., 23:00
+    }
+    if area: # only download the bounding box
+        shared['area'] = list(area)
+        
+    sfc_request, pl_request = era5_requests(shared, sfc_vars, pl_vars, pl_levels, target_loc, output_stem)
+    
+    chunks = []
+    for tag, full_request, variables in (("sfc", sfc_request, sfc_vars), ("pl", pl_request, pl_vars)):
+        if not variables:
+            continue
+        
+        for chunk_id, request in split_request({**full_request["request"], "dates": dates}, chunk_by):
+            chunks.append({
+                "id": f"{tag}_{chunk_id}",
+                "name": full_request["name"],
+                "request": request,
+                "target": target_loc / f"{output_stem}_{tag}_{chunk_id}.nc",
+            })
+            
+    return sfc_request, pl_request, chunks
+
+@instrumented
+def pull_data_range(
+    start_date, stop_date_inc, start_hour_inc, stop_hour_inc, 
+    step_hour, sfc_vars, pl_vars, pl_levels,
+    target_loc, output_stem, output_stem_explain,
+    step_day = 1, chunk_by = "day", max_workers = 4, client_factory = None, cache = None, area = None,
+    ):
+    """
+    Like pull_data, but for an arbitrary date range, downloaded as many small sub-requests at once.
+    
+    The range is split into sub-requests (see split_request) that run concurrently, each written to its own file.
+    Completed sub-requests are recorded in {output_stem}_manifest.json, so re-running an interrupted job only downloads
+    what is missing. Once everything is downloaded, the pieces are merged into the same {output_stem}_{sfc,pl}.nc files
+    that pull_data writes, and the pieces and manifest are removed.
+    
+    start_date: str - first day to pull data from, as YYYY-MM-DD (inclusive); a time (YYYY-MM-DDTHH:MM) is ignored here,
+        see the time_range of postprocessing
+    stop_date_inc: str - last day to pull data from, as YYYY-MM-DD (inclusive), or YYYY-MM-DDTHH:MM
+    step_day: int - step size for days
+    chunk_by: str or list[str] - "day" and/or "variable", how to split each month into sub-requests
+    max_workers: int - maximum number of sub-requests in flight at once
+    client_factory: callable - builds the client for each download thread, defaults to cdsapi.Client; 
+        pass a fake client to run without a CDS account
+    cache: dict - settings for a local request cache that is checked before each sub-request (see cached_retrieve), or None
+    
+    See pull_data for the remaining arguments.
+    """
+    logging.info(f"Target directory: {target_loc}")
+    logging.info(f"Output fname format: {output_stem_explain}")
+    
+    sfc_request, pl_request, chunks = range_requests(start_date, stop_date_inc, start_hour_inc, stop_hour_inc, step_hour, sfc_vars, pl_vars, pl_levels, target_loc, output_stem, step_day, chunk_by, area)
+    manifest_path = target_loc / f"{output_stem}_manifest.json"
+    retrieve_chunks(chunks, manifest_path, max_workers, client_factory or cdsapi.Client, cache)
+    
+    # merge the pieces of each dataset into the file postprocessing expects
+    for tag, full_request in (("sfc", sfc_request), ("pl", pl_request)):
+        paths = [chunk["target"] for chunk in chunks if chunk["id"].startswith(f"{tag}_")]
+        if not paths:
+            continue
+        
+        with NETCDF_LOCK: # run_pipelined processes the previous day at the same time
+            pieces = [xr.open_dataset(path) for path in paths]
+            xr.combine_by_coords(pieces, combine_attrs="override").to_netcdf(full_request["target"])
+            for piece in pieces:
+                piece.close()
+                
+        logging.info(f"Merged {len(paths)} chunks into {full_request['target']}. Request info: \n{pprint.pformat(full_request)}")
+        
+    for chunk in chunks:
+        chunk["target"].unlink()
+        
+    manifest_path.unlink()
+    logging.info("Completed all downloads.")
+    
+    return sfc_request, pl_request
+
+def data_requests(data_params, target_loc, output_stem, download_params = None):
+    """
+    The requests that pull_data or pull_data_range would send for data_params, without downloading anything.
+    
+    Returns the sfc and pl requests, and the list of requests that are actually retrieved (see range_requests).
+    """
+    if "start_date" in data_params:
+        chunk_by = (download_params or {}).get("chunk_by", "day")
+        
+        return range_requests(**data_params, target_loc=target_loc, output_stem=output_stem, chunk_by=chunk_by)
+    
+    sfc_request, pl_request = month_requests(**data_params, target_loc=target_loc, output_stem=output_stem)
+    chunks = [
+        {"id": tag, **request} for tag, request, variables in (("sfc", sfc_request, data_params["sfc_vars"]), ("pl", pl_request, data_params["pl_vars"]))
+        if variables
+    ]
+    
+    return sfc_request, pl_request, chunks
+
+def request_times(data_params):
+    """
+    The timestamps (datetime.datetime) that data_params covers, after the time_range of postprocessing, in order.
+    """
+    hours = range(int(data_params["start_hour_inc"]), int(data_params["stop_hour_inc"]) + 1, data_params.get("step_hour", 1))
+    if "start_date" not in data_params:
+        days = range(int(data_params["start_day_inc"]), int(data_params["stop_day_inc"]) + 1, data_params.get("step_day", 1))
+        times = []
+        for day, hour in itertools.product(days, hours):
+            try:
+                times.append(datetime.datetime(int(data_params["year"]), int(data_params["month"]), day, hour))
+            except ValueError: # e.g. day 31 of a 30 day month, which the CDS skips too
+                continue
+            
+        return times
+    
+    start, stop = (datetime.datetime.fromisoformat(date) for date in (data_params["start_date"], data_params["stop_date_inc"]))
+    if len(data_params["stop_date_inc"]) <= 10: # a date covers the whole day
+        stop += datetime.timedelta(hours=23)
+        
+    dates = [start.date() + datetime.timedelta(days=i) for i in range(0, (stop.date() - start.date()).days + 1, data_params.get("step_day", 1))]
+    
+    return [
+        time for date, hour in itertools.product(dates, hours)
+        for time in [datetime.datetime(date.year, date.month, date.day, hour)] if start <= time <= stop
+    ]
+
+def fetch_data(
+    data_params, working_dir, output_stem, output_stem_explain,
+    download_params = None, cache_params = None, derived_fields = None, download = True,
+    ):
+    """
+    Pull the data of data_params from cdsapi (see pull_data and pull_data_range), including the variables 
+    that derived_fields need (see field_requests).
+    
+    download: bool - False to only build the requests, for files that were already downloaded (e.g. by cli.py fetch)
+    
+    See main for the other arguments.
+    
+    Returns the sfc and pl requests, the time_range and the drop_inputs to process them with (see postprocessing).
+    """
+    time_range, drop_inputs = None, None
+    if derived_fields:
+        data_params, drop_inputs = field_requests(data_params, derived_fields)
+        
+    if "start_date" in data_params: # whole days are downloaded
+        time_range = (data_params["start_date"], data_params["stop_date_inc"])
+        
+    if not download:
+        sfc_request, pl_request, _ = data_requests(data_params, working_dir, output_stem, download_params)
+        
+    elif "start_date" in data_params: # date range, downloaded as concurrent sub-requests
+        sfc_request, pl_request = pull_data_range(**data_params, **(download_params or {}), target_loc=working_dir, output_stem=output_stem, output_stem_explain=output_stem_explain, cache=cache_params)
+        
+    else:
+        sfc_request, pl_request = pull_data(**data_params, target_loc=working_dir, output_stem=output_stem, output_stem_explain=output_stem_explain, cache=cache_params)
+        
+    return sfc_request, pl_request, time_range, drop_inputs
+
+# short name of each ERA5 variable in downloaded files -> (dataset, CDS variable name). Used to name the inputs of 
+# DERIVED_FIELDS, and to find a variable in a cached download (see file_variable)
+RAW_VARIABLES = {
+    "u": ("pl", "u_component_of_wind"),
+    "v": ("pl", "v_component_of_wind"),
+    "z": ("pl", "geopotential"),
+    "t": ("pl", "temperature"),
+    "q": ("pl", "specific_humidity"),
+    "w": ("pl", "vertical_velocity"),
+    "d": ("pl", "divergence"),
+    "r": ("pl", "relative_humidity"),
+    "vo": ("pl", "vorticity"),
+    "pv": ("pl", "potential_vorticity"),
+    "cc": ("pl", "fraction_of_cloud_cover"),
+    "o3": ("pl", "ozone_mass_mixing_ratio"),
+    "clwc": ("pl", "specific_cloud_liquid_water_content"),
+    "ciwc": ("pl", "specific_cloud_ice_water_content"),
+    "t2m": ("sfc", "2m_temperature"),
+    "d2m": ("sfc", "2m_dewpoint_temperature"),
+    "skt": ("sfc", "skin_temperature"),
+    "sst": ("sfc", "sea_surface_temperature"),
+    "u10": ("sfc", "10m_u_component_of_wind"),
+    "v10": ("sfc", "10m_v_component_of_wind"),
+    "u100": ("sfc", "100m_u_component_of_wind"),
+    "v100": ("sfc", "100m_v_component_of_wind"),
+    "sp": ("sfc", "surface_pressure"),
+    "msl": ("sfc", "mean_sea_level_pressure"),
+    "tcwv": ("sfc", "total_column_water_vapour"),
+    "tcw": ("sfc", "total_column_water"),
+    "tco3": ("sfc", "total_column_ozone"),
+    "tcc": ("sfc", "total_cloud_cover"),
+    "lcc": ("sfc", "low_cloud_cover"),
+    "mcc": ("sfc", "medium_cloud_cover"),
+    "hcc": ("sfc", "high_cloud_cover"),
+    "tp": ("sfc", "total_precipitation"),
+    "mtpr": ("sfc", "mean_total_precipitation_rate"),
+    "cape": ("sfc", "convective_available_potential_energy"),
+    "blh": ("sfc", "boundary_layer_height"),
+    "ssrd": ("sfc", "surface_solar_radiation_downwards"),
+    "sd": ("sfc", "snow_depth"),
+    "siconc": ("sfc", "sea_ice_cover"),
+    "lsm": ("sfc", "land_sea_mask"),
+}
+
+def file_variable(variable):
+    """
+    Short name of a CDS variable (e.g. 2m_temperature) in the files the CDS returns (t2m), see RAW_VARIABLES, 
+    or None if it isn't there.
+    """
+    short_names = {name: short_name for short_name, (_, name) in RAW_VARIABLES.items()}
+    
+    return short_names.get(variable)
+
+EARTH_RADIUS_M = 6371e3
+GRAVITY = 9.80665 # m/s^2
+
+def relative_vorticity(u, v):
+    """
+    Relative vorticity (1/s) of wind on a latitude/longitude grid: 1/(R cos(lat)) * (dv/dlon - d(u cos(lat))/dlat), 
+    from centred differences (one-sided at the edges of the grid). The pole rows, where cos(lat) is 0, copy their neighbours.
+    """
+    coslat = np.cos(np.deg2rad(u["latitude"]))
+    per_radian = 180 / np.pi # differentiate is per degree
+    vorticity = (v.differentiate("longitude") - (u * coslat).differentiate("latitude")) * per_radian / (EARTH_RADIUS_M * coslat.where(np.abs(u["latitude"]) < 90))
+    vorticity = vorticity.fillna(vorticity.shift(latitude=1)).fillna(vorticity.shift(latitude=-1))
+    
+    return vorticity.astype(np.float32)
+
+def thickness(z, lower = 1000, upper = 500):
+    """
+    Thickness (m) of the layer between two pressure levels (hPa), from geopotential.
+    """
+    return (z.sel(level=upper, drop=True) - z.sel(level=lower, drop=True)) / GRAVITY
+
+# fields that postprocessing can derive, by output name: the fields or RAW_VARIABLES they are computed from (in the order 
+# compute takes them), and the pressure levels they need. Fields work on whole DataArrays, so pressure level fields 
+# are computed for every level at once. Entries used by several fields (e.g. wind_speed_sq) are only computed once.
+DERIVED_FIELDS = {
+    "wind_speed_sq": dict(inputs=("u", "v"), compute=lambda u, v: u**2 + v**2, units="m^2/s^2"),
+    "wind": dict(inputs=("wind_speed_sq",), compute=np.sqrt, units="m/s"),
+    "wind_direction": dict(inputs=("u", "v"), compute=lambda u, v: (270 - np.degrees(np.arctan2(v, u))) % 360, units="degrees"), # where the wind blows from
+    "ke": dict(inputs=("wind_speed_sq",), compute=lambda speed_sq: 0.5 * speed_sq, units="J/kg"), # kinetic energy
+    "vort": dict(inputs=("u", "v"), compute=relative_vorticity, units="1/s"),
+    "thickness": dict(inputs=("z",), compute=thickness, units="m", levels=(500, 1000)),
+    "wind10_speed_sq": dict(inputs=("u10", "v10"), compute=lambda u, v: u**2 + v**2, units="m^2/s^2"),
+    "wind10": dict(inputs=("wind10_speed_sq",), compute=np.sqrt, units="m/s"),
+    "t2m_c": dict(inputs=("t2m",), compute=lambda t2m: t2m - 273.15, units="deg C"),
+    "t_c": dict(inputs=("t",), compute=lambda t: t - 273.15, units="deg C"),
+}
+
+def resolve_fields(outputs):
+    """
+    Resolve derived fields into the computation graph that produces them.
+    
+    outputs: list[str] - names of DERIVED_FIELDS to compute
+    
+    Returns the list of derived fields to compute, each once and after the fields it depends on, 
+    and the set of RAW_VARIABLES they read.
+    """
+    order, raw = [], set()
+    
+    def visit(name, path):
+        if name in path:
+            raise ValueError(f"Derived fields depend on each other in a cycle: {' -> '.join(path + (name,))}")
+        
+        if name in order or name in raw:
+            return
+        
+        if name in DERIVED_FIELDS:
+            for dependency in DERIVED_FIELDS[name]["inputs"]:
+                visit(dependency, path + (name,))
+                
+            order.append(name)
+            
+        elif name in RAW_VARIABLES:
+            raw.add(name)
+            
+        else:
+            raise ValueError(f"Unknown field {name} (derived fields: {list(DERIVED_FIELDS)}, variables: {list(RAW_VARIABLES)})")
+        
+    for name in outputs:
+        visit(name, ())
+        
+    return order, raw
+
+def field_requests(data_params, derived_fields):
+    """
+    Add the variables and pressure levels that derived_fields need (see resolve_fields) to the sfc_vars, pl_vars 
+    and pl_levels of data_params, so only what the chosen outputs need is requested from the CDS.
+    
+    Returns the new data_params, and the variables (short names) and levels that were added, which are only 
+    needed to derive the fields: dict(variables=[...], levels=[...]), see derive_fields.
+    """
+    order, raw = resolve_fields(derived_fields)
+    variables = {"sfc": list(data_params["sfc_vars"] or []), "pl": list(data_params["pl_vars"] or [])}
+    added = []
+    for name in sorted(raw):
+        kind, variable = RAW_VARIABLES[name]
+        if variable not in variables[kind]:
+            variables[kind].append(variable)
+            added.append(name)
+            
+    pl_levels = list(data_params["pl_levels"] or [])
+    added_levels = []
+    for field in order:
+        for level in DERIVED_FIELDS[field].get("levels", ()):
+            if int(level) not in {int(l) for l in pl_levels + added_levels}:
+                added_levels.append(level)
+                
+    if added or added_levels:
+        logging.info(f"Requesting variables {added} and levels {added_levels} for derived fields {list(derived_fields)}")
+        
+    return dict(data_params, sfc_vars=variables["sfc"], pl_vars=variables["pl"], pl_levels=pl_levels + added_levels), dict(variables=added, levels=added_levels)
+
+def legacy_derived_fields(data_params, derived_fields):
+    """
+    Keep configs from before derived_fields working as they did: if derived_fields isn't set (None, or false in a 
+    TOML config) and pl_vars has both wind components, the wind speed is derived and u and v are dropped, giving 
+    wind{level} channels rather than u{level} and v{level}. Set derived_fields = [] to keep u and v instead.
+    
+    Returns data_params (without u and v in pl_vars, so field_requests adds them as inputs to drop) and derived_fields.
+    """
+    components = [RAW_VARIABLES[name][1] for name in ("u", "v")]
+    if isinstance(derived_fields, (list, tuple)) or not set(components) <= set(data_params["pl_vars"] or []):
+        return data_params, derived_fields
+    
+    logging.warning(f"derived_fields isn't set and pl_vars has {components}: deriving wind and dropping u and v as before. Set derived_fields = [] to keep them")
+    
+    return dict(data_params, pl_vars=[var for var in data_params["pl_vars"] if var not in components]), ["wind"]
+
+def derive_fields(ds, outputs, drop_inputs = None):
+    """
+    Add derived fields (see DERIVED_FIELDS) to a dataset, in the order resolve_fields gives, so each field and 
+    shared intermediate is computed once. Works on lazy (dask) datasets too.
+    
+    outputs: list[str] - derived fields to add; intermediates not listed here are not kept
+    drop_inputs: dict - variables and levels to drop once the fields are derived, dict(variables=[...], levels=[...]) 
+        as returned by field_requests
+    """
+    order, raw = resolve_fields(outputs)
+    missing = sorted(raw - set(ds.data_vars))
+    if missing:
+        raise ValueError(f"Can't derive {list(outputs)}: variables {missing} are not in the dataset")
+    
+    values = {}
+    for name in order:
+        field = DERIVED_FIELDS[name]
+        args = [values[dependency] if dependency in values else ds[dependency] for dependency in field["inputs"]]
+        values[name] = field["compute"](*args).assign_attrs(units=field["units"])
+        
+    logging.info(f"Derived {list(outputs)} (computed {order} from {sorted(raw)})")
+    
+    drop_inputs = drop_inputs or {}
+    ds = ds.drop_vars(drop_inputs.get("variables", []), errors="ignore").assign({name: values[name] for name in outputs})
+    if drop_inputs.get("levels") and "level" in ds.dims:
+        ds = ds.drop_sel(level=[int(level) for level in drop_inputs["levels"]])
+        
+    return ds
+
+@instrumented
+def postprocessing(sfc_request, pl_request, output_path, rm_originals, time_chunk = None, keep_levels = False, zarr_params = None, pyramid_factors = None, time_range = None, derived_fields = None, drop_inputs = None):
+    """
+    Merge pl and sfc data, convert to xarray ds, derive fields (e.g. wind speed, wind direction, etc.)
+    
+    derived_fields (e.g. ["wind", "vort"]) are computed by derive_fields, for all pressure levels at once, 
+    and the variables and levels in drop_inputs (those only requested to derive them, see field_requests) are dropped.
+    
+    Variables keep the short names they have in the downloaded files (e.g. t2m, or t for temperature, see RAW_VARIABLES),
+    see https://confluence.ecmwf.int/display/CKB/ERA5%3A+data+documentation#heading-Parameterlistings
+    for the short names of other variables.
+    
+    If time_chunk is given, both files are opened as dask arrays chunked along time, so nothing is loaded here: 
+    derived fields stay lazy, saving streams one chunk at a time, and the returned dataset is read chunk by chunk
+    as frames are plotted. This needs dask to be installed.
+    
+    Pressure level variables are split into one variable per level (e.g. t500, wind850, see flatten_levels), unless 
+    keep_levels is set, in which case they keep their level dimension (e.g. t, wind).
+    
+    If output_path ends in .zarr, the dataset is saved as a chunked, compressed zarr store instead of netcdf (see save_dataset), 
+    configured by zarr_params: dict(compressor=dict(cname="zstd", clevel=3), append=True). With append, timesteps 
+    newer than those already in the store are appended to it, and the whole store is returned.
+    
+    If pyramid_factors (e.g. (2, 4, 8)) is given, coarsened copies of the saved dataset are saved next to it 
+    for previews, see build_pyramid.
+    
+    If time_range (start, stop) is given, only timesteps between them (inclusive) are kept, e.g. ("2023-06-15T06", "2023-07-02")
+    to drop the hours before 06z of the first downloaded day. Partial dates cover the whole day (or hour).
+    
+    When the dataset is saved, per-channel statistics (min, max and a quantile sketch, see channel_stats) are computed
+    in the same pass and written next to it (see stats_path), so plot_frames doesn't need another pass for colour limits.
+    """
+    sfc_exists = sfc_request['target'].exists()
+    pl_exists = pl_request['target'].exists()
+    chunks = {"time": time_chunk} if time_chunk else None
+    
+    if sfc_exists:
+        sfc_ds = xr.open_dataset(sfc_request['target'], chunks=chunks)
+    
+    if pl_exists:
+        pl_ds = xr.open_dataset(pl_request['target'], chunks=chunks)
+
+    # Merge with the surface data, keeping the level dimension so fields are derived over all levels at once
+    if pl_exists:
+        # logging.info(f"PL: \n{pl_ds}")
+        level_ds = pl_ds
+        if "level" in level_ds.coords and "level" not in level_ds.dims: # a single level may come as a scalar coordinate
+            level_ds = level_ds.expand_dims("level")
+            
+        elif "level" not in level_ds.dims: # or with no level dimension at all (not generated)
+            level_ds = level_ds.expand_dims(level=[int(pl_request['request']['pressure_level'][0])])
+            
+    if sfc_exists and pl_exists:
+        out_ds = xr.merge([sfc_ds, level_ds], compat='override')
+        
+    else:
+        out_ds = sfc_ds if sfc_exists else level_ds
+        
+    if time_range:
+        out_ds = out_ds.sel(time=slice(*time_range))
+        if chunks: # realign the dask chunks with the time_chunk sized zarr chunks, see zarr_encoding
+            out_ds = out_ds.chunk(chunks)
+            
+    if derived_fields:
+        out_ds = derive_fields(out_ds, derived_fields, drop_inputs)
+        
+    if not keep_levels:
+        out_ds = flatten_levels(out_ds)
+
+    # Print the resulting dataset
+    logging.info(f"Resulting dataset: \n{out_ds}")
+
+    # Save the resulting dataset if desired
+    if output_path: # if output_path is not None, save the dataset
+        zarr_params = zarr_params or {}
+        append = is_zarr(output_path) and output_path.exists() and zarr_params.get("append", False)
+        previous = read_channel_stats(stats_path(output_path)) if append else None
+        
+        # for lazy data, write and gather statistics in one pass
+        written, write = save_dataset(out_ds, output_path, time_chunk, zarr_params.get("compressor"), append=append, compute=not chunks)
+        sketches = channel_stats(written, time_chunk or 24, also_compute=[write] if write is not None else ())
+        if previous: # statistics of the whole store, not just the appended part
+            sketches = {channel: merge_sketches([previous[channel], sketch]) if channel in previous else sketch for channel, sketch in sketches.items()}
+            
+        logging.info(f"Saving dataset to {output_path}")
+        write_channel_stats(sketches, stats_path(output_path))
+        
+        if pyramid_factors and written.sizes["time"]:
+            build_pyramid(output_path, pyramid_factors, written.time.values if append else None, time_chunk, zarr_params.get("compressor"), append=append)
+        
+        if chunks or append: # read from the saved dataset from now on, so the originals can go and derived fields aren't recomputed
+            out_ds = open_output(output_path, chunks=chunks)
+            
+    elif chunks and rm_originals: # a lazy dataset still reads from the originals
+        logging.warning("Not deleting original files: time_chunk is set but output_path is not, so the dataset still reads from them")
+        rm_originals = False
+        
+    if rm_originals:
+        if sfc_exists:
+            sfc_request['target'].unlink()
+            logging.info(f"Deleted {sfc_request['target']}")
+            
+        if pl_exists:
+            pl_request['target'].unlink()
+            logging.info(f"Deleted {pl_request['target']}")
+            
+    return out_ds
+
+def is_zarr(path):
+    """
+    Whether a dataset path is a zarr store (ends in .zarr) rather than a netcdf file.
+    """
+    return bool(path) and pathlib.Path(path).suffix == ".zarr"
+
+def open_output(path, chunks = None):
+    """
+    Open a dataset saved by save_dataset, whether it is netcdf or zarr. chunks is passed to xr.open_dataset.
+    """
+    return xr.open_dataset(path, chunks=chunks, engine="zarr" if is_zarr(path) else None)
+
+def zarr_encoding(ds, time_chunk, compressor = None):
+    """
+    Per-variable zarr encoding: each chunk holds time_chunk timesteps of one channel (one level, full latitude/longitude),
+    so rendering a chunk of frames reads exactly the chunks it needs, compressed with Blosc.
+    
+    compressor: dict - Blosc options, defaults to dict(cname="zstd", clevel=3)
+    """
+    import zarr # optional, only needed for zarr output
+    
+    compressor = dict(dict(cname="zstd", clevel=3), **(compressor or {}))
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        codec = {"compressors": [zarr.codecs.BloscCodec(**compressor, shuffle="shuffle")]}
+        
+    else:
+        import numcodecs
+        codec = {"compressor": numcodecs.Blosc(**compressor, shuffle=numcodecs.Blosc.SHUFFLE)}
+        
+    return {
+        name: dict(codec, chunks=tuple(time_chunk if dim == "time" else 1 if dim == "level" else size for dim, size in da.sizes.items()))
+        for name, da in ds.data_vars.items()
+    }
+
+@instrumented
+def save_dataset(ds, output_path, time_chunk = None, compressor = None, append = False, compute = True):
+    """
+    Save a dataset as netcdf, or as a chunked, compressed zarr store (see zarr_encoding) if output_path ends in .zarr.
+    
+    If append is set and the zarr store exists, only the timesteps after the last one already stored are written,
+    appended along time, so pulling a later date range extends the store instead of rewriting it.
+    
+    ds: xr.Dataset - dataset to save
+    output_path: pathlib.Path - netcdf file or zarr store to save to
+    time_chunk: int - timesteps per zarr chunk (default 24)
+    compressor: dict - Blosc options for zarr, see zarr_encoding
+    append: bool - append new timesteps to an existing zarr store instead of overwriting it
+    compute: bool - write now, or return the delayed write (for lazy datasets)
+    
+    Returns (written, write): the part of ds that was saved, and the delayed write if compute is False (otherwise None).
+    """
+    if not is_zarr(output_path):
+        return ds, ds.to_netcdf(output_path, compute=compute)
+    
+    if not (append and output_path.exists()):
+        return ds, ds.to_zarr(output_path, mode="w", encoding=zarr_encoding(ds, time_chunk or 24, compressor), compute=compute)
+    
+    stored = open_output(output_path)
+    written = ds.sel(time=ds.time > stored.time.values[-1])
+    logging.info(f"Appending {written.sizes['time']} new timesteps to {output_path} ({ds.sizes['time'] - written.sizes['time']} already stored)")
+    if not written.sizes["time"]:
+        return written, None
+    
+    if written.chunks: # line the dask chunks up with the store's chunks, starting with whatever is left of its last one
+        sample = stored[next(iter(stored.data_vars))]
+        store_chunk = sample.encoding["chunks"][sample.dims.index("time")]
+        sizes = [min(-stored.sizes["time"] % store_chunk or store_chunk, written.sizes["time"])]
+        while sum(sizes) < written.sizes["time"]:
+            sizes.append(min(store_chunk, written.sizes["time"] - sum(sizes)))
+            
+        written = written.chunk({"time": tuple(sizes)})
+        
+    return written, written.to_zarr(output_path, append_dim="time", compute=compute)
+
+def pyramid_path(ds_path, factor):
+    """
+    Location of a coarsened copy of a saved dataset, see build_pyramid.
+    """
+    ds_path = pathlib.Path(ds_path)
+    
+    return ds_path.with_name(f"{ds_path.stem}_x{factor}{ds_path.suffix}")
+
+def coarsen_dataset(ds, factor):
+    """
+    Average a dataset over blocks of factor x factor grid cells (trailing rows/columns that don't fill a block are dropped).
+    """
+    return ds.coarsen(latitude=factor, longitude=factor, boundary="trim").mean()
+
+@instrumented
+def build_pyramid(output_path, factors, times = None, time_chunk = None, compressor = None, append = False):
+    """
+    Save coarsened copies of a saved dataset (see pyramid_path), so previews can be rendered from a fraction of the data.
+    
+    Each level is built from the finest level already saved that it is a multiple of (e.g. 4x from 2x), so the
+    full resolution data is only read once.
+    
+    output_path: pathlib.Path - the saved dataset, netcdf or zarr (levels use the same format)
+    factors: list[int] - coarsening factors, e.g. (2, 4, 8)
+    times: np.ndarray - only coarsen these timesteps (the ones just appended), or None for all of them
+    time_chunk, compressor, append - see save_dataset
+    """
+    chunks = {"time": time_chunk} if time_chunk else None
+    saved = {1: output_path}
+    for factor in sorted(factors):
+        source_factor = max(level for level in saved if factor % level == 0)
+        source = open_output(saved[source_factor], chunks=chunks)
+        if times is not None:
+            source = source.sel(time=times)
+            
+        level_path = pyramid_path(output_path, factor)
+        save_dataset(coarsen_dataset(source, factor // source_factor), level_path, time_chunk, compressor, append=append)
+        source.close()
+        saved[factor] = level_path
+        logging.info(f"Saved {factor}x coarsened dataset to {level_path}")
+
+def flatten_levels(ds):
+    """
+    Split every variable with a level dimension into one variable per level, named {variable}{level} (e.g. t500), 
+    and drop the level dimension. Each new variable is a single-index view of the original (lazy for dask), 
+    and they are all added in one assign rather than one at a time.
+    """
+    if "level" not in ds.dims:
+        return ds
+    
+    flat = {
+        f"{name}{int(level)}": ds[name].isel(level=level_idx, drop=True)
+        for level_idx, level in enumerate(ds["level"].values)
+        for name in ds.data_vars if "level" in ds[name].dims
+    }
+    
+    return ds.drop_dims("level").assign(flat)
+
+def iter_channels(ds):
+    """
+    Yield (channel, DataArray) for every 2D field of a dataset, so datasets saved with or without keep_levels 
+    (see postprocessing) give the same channels. Variables with a level dimension are split per level without copying.
+    """
+    for name, da in ds.data_vars.items():
+        if "level" in da.dims:
+            for level_idx, level in enumerate(ds["level"].values):
+                yield f"{name}{int(level)}", da.isel(level=level_idx, drop=True)
+                
+        else:
+            yield name, da
+
+# quantiles kept by a channel sketch; enough to read off percentile colour limits to within 0.1%
+SKETCH_QUANTILES = np.linspace(0, 1, 1001)
+
+def block_sketch(block):
+    """
+    Summarize a block of values as {"min", "max", "count", "quantiles"}, where quantiles are taken at SKETCH_QUANTILES.
+    NaNs are ignored.
+    """
+    values = np.asarray(block, dtype=np.float64).ravel()
+    values = values[np.isfinite(values)]
+    if not values.size:
+        return {"min": np.inf, "max": -np.inf, "count": 0, "quantiles": np.full(SKETCH_QUANTILES.shape, np.nan)}
+    
+    return {"min": values.min(), "max": values.max(), "count": values.size, "quantiles": np.quantile(values, SKETCH_QUANTILES)}
+
+def merge_sketches(sketches):
+    """
+    Combine block sketches into a sketch of all their values, so statistics can be streamed over a dataset in one pass.
+    
+    Each block's quantiles stand in for count / len(SKETCH_QUANTILES) of its values, and the merged quantiles are read off
+    the weighted distribution of all of them. Min and max are exact; the quantiles are approximate.
+    """
+    sketches = [sketch for sketch in sketches if sketch["count"]]
+    if not sketches:
+        return block_sketch([])
+    
+    points = np.concatenate([sketch["quantiles"] for sketch in sketches])
+    weights = np.repeat([sketch["count"] / len(SKETCH_QUANTILES) for sketch in sketches], len(SKETCH_QUANTILES))
+    order = np.argsort(points)
+    cumulative = np.cumsum(weights[order])
+    position = (cumulative - weights[order] / 2) / cumulative[-1] # midpoint of each point's weight
+    
+    return {
+        "min": min(sketch["min"] for sketch in sketches),
+        "max": max(sketch["max"] for sketch in sketches),
+        "count": sum(sketch["count"] for sketch in sketches),
+        "quantiles": np.interp(SKETCH_QUANTILES, position, points[order]),
+    }
+
+def sketch_limits(sketch, percentiles = None):
+    """
+    Colour limits from a channel sketch: (min, max), or the given (lower, upper) percentiles, e.g. (1, 99).
+    """
+    if not percentiles:
+        return float(sketch["min"]), float(sketch["max"])
+    
+    lower, upper = np.interp(np.asarray(percentiles) / 100, SKETCH_QUANTILES, sketch["quantiles"])
+    
+    return float(lower), float(upper)
+
+@instrumented
+def channel_stats(ds, time_chunk = 24, also_compute = ()):
+    """
+    Sketch every channel of a dataset (see iter_channels) one time chunk at a time (see block_sketch/merge_sketches).
+    
+    For a lazy (dask) dataset, the sketches are built from its existing chunks and computed together with also_compute
+    (e.g. the delayed write from to_netcdf(compute=False)), so the data is read once for both. also_compute is ignored
+    for datasets that are already in memory.
+    
+    Returns {channel: sketch}.
+    """
+    lazy = any(ds[name].chunks for name in ds.data_vars)
+    if lazy:
+        import dask # only needed (and only required to be installed) for lazy datasets
+    
+    sketches = {}
+    for channel, da in iter_channels(ds):
+        if da.chunks: # merge per-chunk sketches inside the dask graph
+            blocks = [dask.delayed(block_sketch)(block) for block in da.data.to_delayed().ravel()]
+            sketches[channel] = dask.delayed(merge_sketches)(blocks)
+            
+        else:
+            sketches[channel] = merge_sketches([block_sketch(da.isel(time=slice(start, start + time_chunk)).values) for start in range(0, da.sizes["time"], time_chunk)])
+            
+    if lazy:
+        sketches, *_ = dask.compute(sketches, *also_compute)
+    
+    return sketches
+
+def stats_path(ds_path):
+    """
+    Location of the channel statistics sidecar written next to a saved dataset.
+    """
+    ds_path = pathlib.Path(ds_path)
+    
+    return ds_path.with_name(f"{ds_path.stem}.stats.json")
+
+def write_channel_stats(sketches, path):
+    """
+    Save channel sketches as a JSON sidecar, see stats_path.
+    """
+    path.write_text(json.dumps({
+        channel: {"min": float(sketch["min"]), "max": float(sketch["max"]), "count": int(sketch["count"]), "quantiles": [float(q) for q in sketch["quantiles"]]}
+        for channel, sketch in sketches.items()
+    }))
+    logging.info(f"Saved channel statistics to {path}")
+
+def read_channel_stats(path):
+    """
+    Load a sidecar written by write_channel_stats, or return None if there isn't one.
+    """
+    if not path.exists():
+        return None
+    
+    stats = json.loads(path.read_text())
+    for sketch in stats.values():
+        sketch["quantiles"] = np.asarray(sketch["quantiles"])
+        
+    return stats
+
+# every frame is FRAME_SIZE_IN inches at FRAME_DPI (1440x900 pixels); the field is scaled to fit, whatever its grid
+FRAME_SIZE_IN = (16, 10)
+FRAME_DPI = 90
+
+# where to plot metadata, in axes coordinates (0-1 spans the image, so >1 and <0 land in the border)
+METADATA_POS_OPTIONS = {
+    "upper-right" : {"time": (0.9, 1.03), "channel": (0.9, 1.08)},
+    "upper-left" : {"time": (0.1, 1.03), "channel": (0.1, 1.08)},
+    "lower-right" : {"time": (0.9, -0.03), "channel": (0.9, -0.08)},
+    "lower-left" : {"time": (0.1, -0.03), "channel": (0.1, -0.08)},
+}
+METADATA_FONTSIZE = 20
+
+def fmt_time_str(t, fmt="%Y-%m-%d %Hz"): 
+    """For some reason, this works."""
+    return t.astype('datetime64[s]').item().strftime(fmt)
+
+def frame_time_fmt(interp_steps = 0):
+    """
+    strftime format of the time label of frames, with minutes if frames are interpolated between the hours.
+    """
+    return "%Y-%m-%d %H:%Mz" if interp_steps else "%Y-%m-%d %Hz"
+
+def render_frame(field, channel, t, cmap_name, vmin, vmax, border_color, plot_metadata, metadata_pos, img_size_in, dpi, time_fmt = "%Y-%m-%d %Hz"):
+    """
+    Render a single frame with matplotlib and return it as an (height, width, 4) uint8 RGBA array.
+    
+    The layout is the one used for every frame of every video: the field fills the width of the figure,
+    with a band of border_color above and below it where the metadata is written. time_fmt is the strftime 
+    format of the time label.
+    """
+    fig, ax = plt.subplots(figsize=img_size_in, dpi=dpi) # create figure
+    ax.imshow(field, cmap=cmap_name, vmin=vmin, vmax=vmax) # plot field
+    
+    # clear axes and fill with black outside of data
+    ax.axis('off')
+    ax.set_position([0, 0.08, 1, 0.8]) # (left, bottom, width, height), could use [0, 0.1, 1, 0.8] for symmetry
+    
+    # plot metadata
+    if plot_metadata:
+        ax.text(*METADATA_POS_OPTIONS[metadata_pos]["channel"], f"{channel}", transform=ax.transAxes, ha='center', va='center', fontsize=METADATA_FONTSIZE, color='white' if border_color != 'white' else 'black')
+        ax.text(*METADATA_POS_OPTIONS[metadata_pos]["time"], f"{fmt_time_str(t, time_fmt)}", transform=ax.transAxes, ha='center', va='center', fontsize=METADATA_FONTSIZE, color='white' if border_color != 'white' else 'black')
+
+    fig.set_facecolor(border_color)
+    fig.canvas.draw()
+    frame = np.asarray(fig.canvas.buffer_rgba()).copy() # copy out of the canvas before closing
+    plt.close(fig)
+    
+    return frame
+
+@functools.lru_cache(maxsize=None)
+def colormap_lut(cmap_name):
+    """
+    256-entry RGBA lookup table (uint8, shape (256, 4)) for a matplotlib colormap.
+    """
+    cmap = matplotlib.colormaps[cmap_name].resampled(256)
+    return (cmap(np.arange(256)) * 255).astype(np.uint8)
+
+@functools.lru_cache(maxsize=None)
+def frame_layout(data_dims, img_size_in, dpi):
+    """
+    Pixel layout of a frame, matching the figure built by render_frame.
+    
+    Returns the frame size, the box the image is drawn into, and the source row/column of every image pixel
+    (nearest neighbour), so a field of data_dims can be placed into the frame with a single fancy index.
+    All positions are in pixels from the top-left corner of the frame.
+    """
+    frame_h, frame_w = img_size_in[1] * dpi, img_size_in[0] * dpi
+    
+    # axes occupy [0, 0.08, 1, 0.8] of the figure; imshow keeps the data aspect and centers the image in them
+    axes_h, axes_w = 0.8 * frame_h, frame_w
+    axes_bottom = 0.08 * frame_h
+    scale = min(axes_w / data_dims[1], axes_h / data_dims[0])
+    img_h, img_w = data_dims[0] * scale, data_dims[1] * scale
+    img_top = frame_h - axes_bottom - (axes_h + img_h) / 2
+    img_left = (axes_w - img_w) / 2
+    
+    top, left = int(round(img_top)), int(round(img_left))
+    bottom, right = int(round(img_top + img_h)), int(round(img_left + img_w))
+    rows = np.minimum(((np.arange(bottom - top) + 0.5) / scale).astype(int), data_dims[0] - 1)
+    cols = np.minimum(((np.arange(right - left) + 0.5) / scale).astype(int), data_dims[1] - 1)
+    
+    return dict(
+        frame_size=(frame_h, frame_w),
+        img_box=(top, bottom, left, right),
+        img_extent=(img_top, img_h, img_left, img_w), # unrounded, used to place text like transAxes
+        rows=rows,
+        cols=cols,
+    )
+
+@functools.lru_cache(maxsize=None)
+def frame_template(frame_size, border_color):
+    """
+    Blank (height, width, 4) uint8 RGBA frame filled with border_color, copied as the starting point of every rasterized frame.
+    """
+    frame = np.empty((*frame_size, 4), dtype=np.uint8)
+    frame[...] = np.round(np.asarray(matplotlib.colors.to_rgba(border_color)) * 255).astype(np.uint8)
+    return frame
+
+@functools.lru_cache(maxsize=None)
+def glyph_cache(fontsize, dpi):
+    """
+    Pre-rendered glyphs for the metadata labels, using the same font matplotlib would use for ax.text.
+    
+    Returns a dict that is filled lazily: char -> (coverage, descent, x_offset, advance), where coverage is
+    a float32 array in [0, 1], descent is how many pixels the bitmap extends below the baseline, x_offset is
+    where the bitmap starts relative to the pen position, and advance is how far the pen moves.
+    The font is kept under the "_font" key. It is a private FT2Font rather than matplotlib's cached one (get_font), 
+    which matplotlib resizes whenever it draws text, so glyphs would come out at the wrong size after a render_frame.
+    """
+    import matplotlib.font_manager # not imported by matplotlib itself
+    import matplotlib.ft2font
+    
+    font_path = matplotlib.font_manager.findfont(matplotlib.font_manager.FontProperties())
+    font = matplotlib.ft2font.FT2Font(font_path, hinting_factor=matplotlib.rcParams["text.hinting_factor"])
+    font.set_size(fontsize, dpi)
+    
+    return {"_font": font}
+
+def get_glyph(cache, char):
+    """
+    Look up a glyph in a glyph_cache, rendering it with FreeType the first time it is seen.
+    """
+    if char not in cache:
+        font = cache["_font"]
+        font.set_text(char, 0.0)
+        font.draw_glyphs_to_bitmap()
+        coverage = np.asarray(font.get_image(), dtype=np.float32) / 255
+        descent = font.get_descent() / 64
+        x_offset = font.get_bitmap_offset()[0] / 64
+        advance = font.load_char(ord(char)).horiAdvance / 64 / (matplotlib.rcParams.get("text.hinting_factor") or 1)
+        if char.isspace():
+            coverage = np.zeros((0, 0), dtype=np.float32)
+            
+        cache[char] = (coverage, descent, x_offset, advance)
+        
+    return cache[char]
+
+def draw_label(frame, text, center, color, fontsize, dpi):
+    """
+    Draw text into an RGBA frame in place, centered (horizontally and vertically, like ha/va='center') on
+    center=(row, col), using glyphs from glyph_cache.
+    """
+    cache = glyph_cache(fontsize, dpi)
+    glyphs = [get_glyph(cache, char) for char in text]
+    
+    # lay out the glyphs along a baseline at y=0, then measure the ink like matplotlib does
+    pens = np.cumsum([0] + [g[3] for g in glyphs[:-1]])
+    inked = [(g, pen) for g, pen in zip(glyphs, pens) if g[0].size]
+    if not inked:
+        return frame
+    
+    left = min(pen + g[2] for g, pen in inked)
+    right = max(pen + g[2] + g[0].shape[1] for g, pen in inked)
+    
+    # vertical extent includes "lp" so labels sit at the same height whatever characters they contain
+    ref = [get_glyph(cache, char) for char in "lp"] + [g for g, _ in inked]
+    ascent = max(g[0].shape[0] - g[1] for g in ref)
+    descent = max(g[1] for g in ref)
+    baseline = center[0] + (ascent + descent) / 2 - descent
+    x0 = center[1] - (right - left) / 2 - left
+    
+    color = np.asarray(color, dtype=np.float32)
+    for (coverage, g_descent, x_offset, _), pen in inked:
+        h, w = coverage.shape
+        top = int(round(baseline + g_descent - h))
+        col = int(round(x0 + pen + x_offset))
+        
+        # clip to the frame
+        r0, c0 = max(top, 0), max(col, 0)
+        r1, c1 = min(top + h, frame.shape[0]), min(col + w, frame.shape[1])
+        if r0 >= r1 or c0 >= c1:
+            continue
+        
+        alpha = coverage[r0 - top:r1 - top, c0 - col:c1 - col, None]
+        region = frame[r0:r1, c0:c1, :3]
+        region[...] = (region * (1 - alpha) + color * alpha + 0.5).astype(np.uint8)
+        
+    return frame
+
+def rasterize_frame(field, channel, t, cmap_name, vmin, vmax, border_color, plot_metadata, metadata_pos, img_size_in, dpi, time_fmt = "%Y-%m-%d %Hz"):
+    """
+    Render a single frame without building a matplotlib figure and return it as an (height, width, 4) uint8 RGBA array.
+    
+    Drop-in replacement for render_frame that produces the same layout: the field is normalized with vmin/vmax and
+    mapped through a 256-entry colormap LUT, placed between bands of border_color, and the labels are drawn from
+    pre-rendered glyphs. Output matches render_frame to within antialiasing and text hinting differences.
+    """
+    field = np.asarray(field)
+    layout = frame_layout(field.shape, tuple(img_size_in), dpi)
+    lut = colormap_lut(cmap_name).view(np.uint32).ravel() # one 4-byte item per color, so a single np.take maps a pixel
+    vmin, vmax = float(vmin), float(vmax)
+    
+    # same index computation as matplotlib.colors.Colormap: scale to [0, 256), clip under/over to the ends
+    scale = 256 / (vmax - vmin) if vmax > vmin else 0.0
+    norm = (field - np.float32(vmin)) * np.float32(scale)
+    np.clip(norm, 0, 255, out=norm)
+    nan = np.isnan(norm)
+    has_nan = nan.any()
+    idx = np.where(nan, 0, norm).astype(np.intp) if has_nan else norm.astype(np.intp)
+    
+    top, bottom, left, right = layout["img_box"]
+    rows, cols = layout["rows"], layout["cols"]
+    if len(rows) != field.shape[0] or len(cols) != field.shape[1]: # resample to fit the frame
+        idx = idx[rows[:, None], cols[None, :]]
+        nan = nan[rows[:, None], cols[None, :]]
+        
+    template = frame_template(layout["frame_size"], border_color)
+    frame = template.copy()
+    frame.view(np.uint32)[top:bottom, left:right, 0] = np.take(lut, idx)
+    if has_nan: # missing data is transparent in imshow, so the border shows through
+        frame[top:bottom, left:right][nan] = template[0, 0]
+    
+    if plot_metadata:
+        img_top, img_h, img_left, img_w = layout["img_extent"]
+        color = (255, 255, 255) if border_color != 'white' else (0, 0, 0)
+        for label, text in (("channel", f"{channel}"), ("time", f"{fmt_time_str(t, time_fmt)}")):
+            ax_x, ax_y = METADATA_POS_OPTIONS[metadata_pos][label]
+            center = (img_top + (1 - ax_y) * img_h, img_left + ax_x * img_w)
+            draw_label(frame, text, center, color, METADATA_FONTSIZE, dpi)
+            
+    return frame
+
+# rendering engines selectable in plot_frames; all take the same arguments and return an RGBA frame
+RENDERERS = {
+    "matplotlib": render_frame,
+    "fast": rasterize_frame,
+}
+
+# ffmpeg encoder, container and default quality for each codec option
+VIDEO_CODECS = {
+    "x264": dict(encoder="libx264", extension="mp4", default_crf=23),
+    "x265": dict(encoder="libx265", extension="mp4", default_crf=28),
+    "vp9": dict(encoder="libvpx-vp9", extension="webm", default_crf=31),
+}
+# vp9 has no presets, its speed is set with -cpu-used instead
+VP9_CPU_USED = {"ultrafast": 8, "superfast": 7, "veryfast": 6, "faster": 5, "fast": 4, "medium": 3, "slow": 2, "slower": 1, "veryslow": 0}
+
+def encoder_args(codec = "x264", preset = "medium", crf = None, threads = 0):
+    """
+    ffmpeg output options for encoding with one of VIDEO_CODECS.
+    
+    codec: str - "x264", "x265" or "vp9"
+    preset: str - speed/size trade-off, using the x264 preset names (ultrafast ... veryslow) for every codec
+    crf: int - constant quality, lower is better and bigger; None for the codec's default
+    threads: int - encoder threads, 0 to let the encoder decide
+    """
+    settings = VIDEO_CODECS[codec]
+    crf = settings["default_crf"] if crf is None else crf
+    args = ["-c:v", settings["encoder"], "-crf", f"{crf}", "-pix_fmt", "yuv420p", "-threads", f"{threads}"]
+    if codec == "vp9":
+        args += ["-b:v", "0", "-deadline", "good", "-cpu-used", f"{VP9_CPU_USED[preset]}", "-row-mt", "1"] # -b:v 0 for constant quality
+        
+    else:
+        args += ["-preset", preset]
+        
+    if codec == "x265":
+        args += ["-tag:v", "hvc1", "-x265-params", "log-level=error"] # hvc1 so QuickTime can play it
+        
+    return args
+
+def video_path(vid_dir, channel, codec = "x264"):
+    """
+    Where the video of a channel is saved, with the container extension of the codec.
+    """
+    return vid_dir / f"{channel}.{VIDEO_CODECS[codec]['extension']}"
+
+def open_frame_stream(output_path, frame_size, fps, codec = "x264", preset = "medium", crf = None, threads = 0, fragmented = False):
+    """
+    Start an ffmpeg process that encodes raw RGBA frames written to its stdin into a movie.
+    
+    Frames never touch the disk, and ffmpeg encodes in its own process while the next frame is rendered.
+    ffmpeg output is printed to the terminal, not logged. Write frames with write_frame, so close_frame_stream can
+    check they all made it into the movie.
+    
+    output_path: pathlib.Path - where to save the movie
+    frame_size: tuple[int, int] - (height, width) of every frame, in pixels
+    fps: int - framerate of the output movie
+    codec, preset, crf, threads - see encoder_args
+    fragmented: bool - write an mp4 as fragments, so it can be played up to the frames encoded so far while it is 
+        still being written (webm always can be)
+    """
+    height, width = frame_size
+    movflags = ["-movflags", "+frag_keyframe+empty_moov+default_base_moof"] if fragmented and output_path.suffix == ".mp4" else []
+    cmd = [
+        "ffmpeg", "-y", 
+        "-f", "rawvideo", "-pix_fmt", "rgba", "-s", f"{width}x{height}", "-framerate", f"{fps}", "-i", "-",
+        *encoder_args(codec, preset, crf, threads), *movflags, f"{output_path}",
+    ]
+    logging.info(f"Streaming frames to command: \n\t{' '.join(cmd)}")
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    proc.frames_written = 0
+    
+    return proc
+
+def stream_encode_args(encode_params = None):
+    """
+    The open_frame_stream arguments in encode_params (see main): everything set except max_jobs, since each stream 
+    is a single ffmpeg process.
+    """
+    return {key: value for key, value in (encode_params or {}).items() if key != "max_jobs" and value is not None}
+
+def write_frame(proc, frame):
+    """
+    Send one RGBA frame (a uint8 array or its bytes) to an ffmpeg process started by open_frame_stream.
+    """
+    proc.stdin.write(frame)
+    proc.frames_written += 1
+
+def close_frame_stream(proc, output_path):
+    """
+    Flush and close the stdin of an ffmpeg process started by open_frame_stream, wait for it to finish, and check 
+    the movie like dir2movie does: ffmpeg must exit with 0 and the movie must have every frame that was written 
+    (see probe_video). Raises RuntimeError otherwise, e.g. for a truncated movie.
+    """
+    proc.stdin.close()
+    returncode = proc.wait()
+    encoded_frames = probe_video(output_path) if returncode == 0 else None
+    if encoded_frames != proc.frames_written:
+        message = f"Streaming {output_path} failed (ffmpeg exit code {returncode}, {encoded_frames} of {proc.frames_written} frames in the movie)"
+        logging.error(message)
+        raise RuntimeError(message)
+        
+    logging.info(f"Saved movie to {output_path}: {encoded_frames} frames")
+    
+def render_chunk(block, times, frame_paths, style, latencies = None):
+    """
+    Render consecutive frames of one channel.
+    
+    block: np.ndarray - (time, latitude, longitude) data for these frames
+    times: np.ndarray - timestamp of each frame
+    frame_paths: list[pathlib.Path] - where to save each frame as a png, or None to return the raw frames instead
+    style: dict - keyword arguments for the renderer that are shared by every frame (see plot_frames)
+    latencies: list - if given, the seconds each frame took to render (and save) are appended to it
+    
+    Returns a list with the raw bytes of each frame if frame_paths is None, otherwise an empty list.
+    """
+    style = dict(style)
+    render = RENDERERS[style.pop("renderer")]
+    frames = []
+    for i, t in enumerate(times):
+        start = time.perf_counter()
+        frame = render(block[i], t=t, **style)
+        if frame_paths is None:
+            frames.append(frame.tobytes())
+            
+        else:
+            plt.imsave(frame_paths[i], frame, pil_kwargs={"compress_level": 1}) # frames are temporary, so favor write speed over size
+            
+        if latencies is not None:
+            latencies.append(time.perf_counter() - start)
+            
+    return frames
+
+def render_shared_chunk(block_path, start, stop, times, frame_paths, style):
+    """
+    Worker side of render_blocks: render frames [start, stop) of a block that the parent process saved as a .npy file.
+    
+    The block is memory-mapped rather than pickled, so every worker reads the same pages and only the frames it needs.
+    
+    Returns the result of render_chunk and the render latency of each frame.
+    """
+    block = np.load(block_path, mmap_mode='r')
+    latencies = []
+    frames = render_chunk(block[start:stop], times, frame_paths, style, latencies)
+    
+    return frames, latencies
+
+def render_blocks(blocks, style, pool=None, workers=1, tmp_dir=None, latencies=None):
+    """
+    Render blocks of frames of one channel, yielding the result of render_chunk for each block in order.
+    
+    blocks: iterable of (block, times, frame_paths) - see render_chunk
+    style: dict - see render_chunk
+    pool: concurrent.futures.ProcessPoolExecutor - if given, each block is split into `workers` pieces that are 
+        rendered in parallel; otherwise frames are rendered in this process
+    tmp_dir: pathlib.Path - where to put the memory-mapped copy of each block while the pool renders it
+    latencies: list - if given, the render latency of each frame is appended to it, see render_chunk
+    
+    With a pool, the next block is loaded and dispatched while the previous one is rendering, and results are still
+    yielded in order, so frame numbering and streamed videos are deterministic.
+    """
+    if pool is None:
+        for block, times, frame_paths in blocks:
+            yield render_chunk(block, times, frame_paths, style, latencies)
+            
+        return
+    
+    pending = collections.deque()
+    for block_idx, (block, times, frame_paths) in enumerate(blocks):
+        block_path = tmp_dir / f"block_{block_idx}.npy"
+        shared = np.lib.format.open_memmap(block_path, mode='w+', dtype=block.dtype, shape=block.shape)
+        shared[...] = block
+        shared.flush()
+        del shared
+        
+        step = -(-len(times) // workers) # ceil, so every worker gets a piece
+        futures = [
+            pool.submit(render_shared_chunk, block_path, lo, lo + step, times[lo:lo + step], frame_paths[lo:lo + step] if frame_paths else None, style)
+            for lo in range(0, len(times), step)
+        ]
+        pending.append((futures, block_path))
+        
+        if len(pending) > 1: # keep one block in flight while the next is dispatched
+            yield collect_block(*pending.popleft(), latencies)
+            
+    while pending:
+        yield collect_block(*pending.popleft(), latencies)
+
+def collect_block(futures, block_path, latencies = None):
+    """
+    Wait for the pieces of a block dispatched by render_blocks, then remove its memory-mapped copy.
+    The render latencies of the pieces' frames are appended to latencies, if given.
+    """
+    results = [future.result() for future in futures]
+    frames = [frame for piece_frames, _ in results for frame in piece_frames]
+    if latencies is not None:
+        latencies.extend(latency for _, piece_latencies in results for latency in piece_latencies)
+        
+    block_path.unlink()
+    
+    return frames
+
+def flow_interpolate(a, b, fractions):
+    """
+    Yield fields between a and b at each fraction (0-1) of the way from a to b, following the motion between them.
+    
+    Dense optical flow (OpenCV's Farneback) is estimated from a to b and from b to a on the fields scaled to 8 bits. 
+    Each intermediate field blends a and b, each warped part of the way along its flow, so features move between 
+    their positions instead of fading out in one place and in at another. Needs opencv (pip install opencv-python-headless).
+    Fields with more than 2 dimensions are treated as stacks of 2D fields.
+    """
+    import cv2 # optional, only needed for interp_method="flow"
+    
+    a, b = np.asarray(a, dtype=np.float32), np.asarray(b, dtype=np.float32)
+    if a.ndim > 2:
+        stacks = [flow_interpolate(a[idx], b[idx], fractions) for idx in np.ndindex(a.shape[:-2])]
+        for fields in zip(*stacks):
+            yield np.stack(fields).reshape(a.shape)
+            
+        return
+    
+    lower, upper = min(np.nanmin(a), np.nanmin(b)), max(np.nanmax(a), np.nanmax(b))
+    scale = 255 / (upper - lower) if upper > lower else 0.0
+    a8, b8 = (np.nan_to_num((field - lower) * scale).astype(np.uint8) for field in (a, b))
+    flow_ab = cv2.calcOpticalFlowFarneback(a8, b8, None, 0.5, 3, 15, 3, 5, 1.2, 0)
+    flow_ba = cv2.calcOpticalFlowFarneback(b8, a8, None, 0.5, 3, 15, 3, 5, 1.2, 0)
+    
+    rows, cols = np.indices(a.shape, dtype=np.float32)
+    for fraction in np.asarray(fractions, dtype=np.float32): # cv2.remap needs float32 maps
+        # sample each field where the flow says the content of every output pixel was, part of the way along
+        from_a = cv2.remap(a, cols - fraction * flow_ab[..., 0], rows - fraction * flow_ab[..., 1], cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        from_b = cv2.remap(b, cols - (1 - fraction) * flow_ba[..., 0], rows - (1 - fraction) * flow_ba[..., 1], cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        yield (1 - fraction) * from_a + fraction * from_b
+
+def interpolate_pair(a, t_a, b, t_b, steps, method = "linear"):
+    """
+    Yield (field, t) for `steps` evenly spaced frames strictly between two consecutive frames, one at a time.
+    
+    method: str - "linear" blends a and b; "flow" follows the motion between them, see flow_interpolate
+    """
+    fractions = np.arange(1, steps + 1) / (steps + 1)
+    times = [t_a + (t_b - t_a) * fraction for fraction in fractions]
+    if method == "flow":
+        fields = flow_interpolate(a, b, fractions)
+        
+    elif method == "linear":
+        delta = b - a
+        fields = (a + delta * np.float32(fraction) for fraction in fractions)
+        
+    else:
+        raise ValueError(f"Unknown interpolation method {method} - use 'linear' or 'flow'")
+    
+    yield from zip(fields, times)
+
+def frame_blocks(source_blocks, steps = 0, method = "linear", time_chunk = 24, skip = 0):
+    """
+    Insert `steps` interpolated frames between every pair of consecutive frames, e.g. to make smooth video from hourly data.
+    
+    Frames are produced pair by pair as the source is read, so only the current source block and two frames are held,
+    whatever the number of steps, and they are handed on in blocks of up to time_chunk frames. 
+    Interpolated timestamps fall between the hours, so label them with minutes (see fmt_time_str).
+    
+    source_blocks: iterable of (block, times) - consecutive blocks of data with time as their first axis, and their timestamps
+    steps: int - number of frames to insert between each pair of source frames (0 passes the blocks through)
+    method: str - see interpolate_pair
+    skip: int - number of output frames to drop from the start, e.g. a timestep that only leads in from the previous shard (see run_shards)
+    
+    Yields (block, times) of the output frames.
+    """
+    def interpolated():
+        if not steps:
+            yield from source_blocks
+            return
+        
+        fields, times = [], []
+        previous = None
+        for block, block_times in source_blocks:
+            for field, t in zip(block, block_times):
+                frames = interpolate_pair(*previous, field, t, steps, method) if previous is not None else []
+                for frame in itertools.chain(frames, [(field, t)]):
+                    fields.append(frame[0])
+                    times.append(frame[1])
+                    if len(fields) == time_chunk:
+                        yield np.stack(fields), np.array(times)
+                        fields, times = [], []
+                        
+                previous = (field, t)
+                
+        if fields:
+            yield np.stack(fields), np.array(times)
+            
+    for block, times in interpolated():
+        dropped = min(skip, len(block))
+        skip -= dropped
+        if dropped < len(block):
+            yield block[dropped:], times[dropped:]
+
+def interpolated_length(n_times, steps):
+    """
+    Number of frames frame_blocks makes from n_times source frames.
+    """
+    return n_times + max(n_times - 1, 0) * steps
+
+def interp_args(interpolation = None):
+    """
+    The interp_steps and interp_method arguments of plot_frames and plot_dashboard for the interpolation setting 
+    of main (e.g. dict(steps=3, method="linear")), or {} for no interpolation.
+    """
+    if not interpolation:
+        return {}
+    
+    return dict(interp_steps=interpolation.get("steps", 0), interp_method=interpolation.get("method", "linear"))
+
+def frame_fingerprint(field, t, style_key):
+    """
+    Hash of everything a frame depends on: its data, its timestamp and the rendering style (see render_stale_frames).
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.ascontiguousarray(field))
+    digest.update(f"{field.dtype}{field.shape}{t}{style_key}".encode())
+    
+    return digest.hexdigest()
+
+def render_stale_frames(blocks, n_frames, channel_dir, style, pool = None, workers = 1, tmp_dir = None, frame_offset = 0, latencies = None):
+    """
+    Render the png frames of one channel that are missing or stale, and remove frames beyond the end of the data.
+    
+    channel_dir/manifest.json records the fingerprint (see frame_fingerprint) of every frame that has been saved. 
+    A frame is re-rendered only if its file is missing or its fingerprint changed, i.e. its source slice or 
+    any rendering parameter (cmap, vmin/vmax, border_color, metadata_pos, dpi, renderer, ...) is different.
+    The manifest is updated after every block, so an interrupted run picks up where it left off.
+    
+    blocks: iterable of (block, times) - consecutive (time, latitude, longitude) blocks of the channel and their timestamps,
+        see frame_blocks
+    n_frames: int - total number of frames in blocks
+    channel_dir: pathlib.Path - directory of the channel's frames
+    style: dict - see render_chunk
+    pool, workers, tmp_dir, latencies - see render_blocks
+    frame_offset: int - number of the first frame minus one, see plot_frames
+    
+    Returns True if any frame was rendered or removed.
+    """
+    manifest_path = channel_dir / "manifest.json"
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {"frames": {}}
+    style_key = json.dumps(style, sort_keys=True, default=str)
+    frame_paths = [channel_dir / f"{frame_offset+t_idx+1:04}.png" for t_idx in range(n_frames)] # output path for each frame
+    rendering = collections.deque() # fingerprints of the blocks handed to render_blocks, in order
+    
+    def stale_blocks():
+        start = 0
+        for block, times in blocks:
+            fingerprints = {
+                frame_paths[start + i].name: frame_fingerprint(block[i], times[i], style_key) 
+                for i in range(len(block))
+            }
+            stale = [
+                i for i, (name, fingerprint) in enumerate(fingerprints.items())
+                if manifest["frames"].get(name) != fingerprint or not frame_paths[start + i].exists()
+            ]
+            if stale:
+                rendering.append({frame_paths[start + i].name: fingerprints[frame_paths[start + i].name] for i in stale})
+                yield block[stale], times[stale], [frame_paths[start + i] for i in stale]
+                
+            start += len(block)
+    
+    n_rendered = 0
+    for _ in render_blocks(stale_blocks(), style, pool=pool, workers=workers, tmp_dir=tmp_dir, latencies=latencies):
+        rendered = rendering.popleft()
+        manifest["frames"].update(rendered)
+        manifest_path.write_text(json.dumps(manifest, indent=2))
+        n_rendered += len(rendered)
+        
+    # frames from a longer dataset would otherwise end up in the video
+    current = {path.name for path in frame_paths}
+    removed = [path for path in channel_dir.glob("*.png") if path.name not in current]
+    for path in removed:
+        path.unlink()
+        manifest["frames"].pop(path.name, None)
+        
+    if removed:
+        manifest_path.write_text(json.dumps(manifest, indent=2))
+        
+    logging.info(f"Rendered {n_rendered} of {n_frames} frames in {channel_dir} ({n_frames - n_rendered} unchanged, {len(removed)} removed)")
+    
+    return bool(n_rendered or removed)
+
+def drop_pole_row(ds):
+    """
+    Drop the last (south pole) row of a global grid, e.g. 721 x 1440, so the field is exactly twice as wide as tall.
+    """
+    if ds.sizes["latitude"] == ds.sizes["longitude"] // 2 + 1:
+        return ds.isel(latitude=slice(0, -1))
+    
+    return ds
+
+def channel_limits(channel, da, color_stats = None, color_percentiles = None, time_chunk = 24):
+    """
+    Colour limits of a channel, the same for every frame: from its sketch in color_stats if there is one, 
+    otherwise from a pass over the data (see plot_frames for the arguments).
+    """
+    if color_stats and channel in color_stats:
+        return sketch_limits(color_stats[channel], color_percentiles)
+    
+    if color_percentiles:
+        return sketch_limits(channel_stats(xr.Dataset({channel: da}), time_chunk)[channel], color_percentiles)
+    
+    limits = xr.Dataset({"lower": da.min(), "upper": da.max()}).compute() # one pass over the data, even if it is lazy
+    
+    return float(limits["lower"]), float(limits["upper"])
+
+def channel_cmap(channel, channel_metadata, default_cmap_name = "viridis"):
+    """
+    Colormap of a channel from channel_metadata, or default_cmap_name if it isn't listed there.
+    """
+    if channel in channel_metadata:
+        return channel_metadata[channel]["pref_cmap"] # if channel is not saved, can't plot until saved
+    
+    logging.warning(f"Channel {channel} not in channel_metadata - using default colormap {default_cmap_name}")
+    
+    return default_cmap_name
+
+def render_pool(workers):
+    """
+    Pool of `workers` processes to render frames with, see render_blocks.
+    """
+    # spawn rather than fork, so workers don't inherit the stdin pipes of ffmpeg processes started by open_frame_stream
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+@instrumented
+def plot_frames(ds, output_dir, channel_metadata, border_color, plot_metadata, metadata_pos, default_cmap_name = "viridis", stream_dir = None, fps = 24, renderer = "matplotlib", workers = 1, time_chunk = 24, color_stats = None, color_percentiles = None, encode_params = None, preview_factor = 1, interp_steps = 0, interp_method = "linear", frame_offset = 0, skip_frames = 0, streams = None, pool = None):
+    """
+    Plot frames of video for each channel and time.
+    
+    in channel_metadata, pref_cmap is the colormap to use for the channel. 
+    units is the units of the channel. In this program, units won't be used unless
+    you modify the program to show the cbar and label.
+    Set the pref_cmap to False to use the default colormap, which is viridis.
+    Here's a link to some colormaps: https://matplotlib.org/stable/tutorials/colors/colormaps.html
+    border_color is the color of the border above & below the image. Use plt colors.
+    
+    If stream_dir is given, frames are not saved as pngs. Instead, the raw RGBA frames of each channel are piped 
+    straight into ffmpeg, which writes {stream_dir}/{channel}.mp4 (see video_path) while the remaining frames are rendered.
+    
+    Png frames are only rendered if they are missing or stale (see render_stale_frames), so re-running with the
+    same dataset and settings, or with a few more days of data, only renders what changed. Streamed frames are always rendered.
+    
+    Frames are rendered time_chunk at a time, so a lazily loaded (dask) dataset is only read one chunk at a time. If workers > 1, each chunk is split across a pool of processes
+    that read it from a memory-mapped file instead of having the data pickled to them.
+    
+    output_dir: pathlib.Path - directory to save frames to
+    channel_metadata: dict - see above
+    border_color: str - color of border above & below image
+    plot_metadata: bool - whether to plot metadata (time, channel, etc.) on the image
+    default_cmap_name: str - default colormap to use if channel not in channel_metadata
+    metadata_pos: str - where to plot metadata (upper-right, upper-left, lower-right, lower-left)
+    stream_dir: pathlib.Path - directory to stream videos to, or None to save png frames to output_dir
+    fps: int - framerate of the streamed videos (only used if stream_dir is given)
+    renderer: str - "matplotlib" to draw each frame as a figure, or "fast" to rasterize it directly with numpy (see rasterize_frame)
+    workers: int - number of processes to render frames with (1 renders in this process)
+    time_chunk: int - number of timesteps loaded and rendered at once
+    color_stats: dict - channel sketches from read_channel_stats, used for colour limits so the data isn't read an extra time;
+        channels missing from it get their limits from a pass over the data
+    color_percentiles: tuple[float, float] - use these (lower, upper) percentiles as colour limits instead of min/max, 
+        e.g. (1, 99) so a few outlier pixels don't wash out the colour scale
+    encode_params: dict - codec, preset, crf and threads of the streamed videos, see encoder_args
+    preview_factor: int - shrink frames by this factor (e.g. when plotting a coarsened dataset, see build_pyramid)
+    interp_steps: int - number of interpolated frames to insert between consecutive timesteps, see frame_blocks
+    interp_method: str - "linear" or "flow", see interpolate_pair
+    frame_offset: int - number the png frames from frame_offset + 1 instead of 1, e.g. after the frames of earlier shards (see run_shards)
+    skip_frames: int - number of leading frames not to render, see frame_blocks
+    streams: dict - {channel: (ffmpeg process, video path)} of streams to keep adding frames to, e.g. from an earlier call 
+        with the previous day (see run_pipelined). Streams this call opens are added to it and left open, for the caller 
+        to close with close_frame_stream. None to open and close a stream per channel here.
+    pool: concurrent.futures.ProcessPoolExecutor - pool of `workers` processes to render with (see render_pool), kept by 
+        the caller across calls (see run_pipelined). None to start one here if workers > 1
+    
+    Returns the list of channels whose frames changed (every channel if streaming).
+    """
+    # deriving some useful items
+    ds = drop_pole_row(ds)
+    channels = dict(iter_channels(ds))
+    times = ds.time.values
+    img_size_in = FRAME_SIZE_IN
+    dpi = max(1, FRAME_DPI // preview_factor)
+    frame_size = (img_size_in[1] * dpi, img_size_in[0] * dpi) # (height, width) of each frame in pixels
+    stream_encode = stream_encode_args(encode_params)
+    time_fmt = frame_time_fmt(interp_steps)
+    
+    with contextlib.ExitStack() as stack:
+        tmp_dir = None
+        if workers > 1:
+            output_dir.mkdir(parents=True, exist_ok=True)
+            if pool is None:
+                pool = stack.enter_context(render_pool(workers))
+                
+            tmp_dir = pathlib.Path(stack.enter_context(tempfile.TemporaryDirectory(prefix="blocks_", dir=output_dir))) # memory-mapped blocks shared with the workers
+            logging.info(f"Rendering frames with {workers} worker processes")
+
+        changed_channels = []
+        for channel_idx, (channel, da) in enumerate(channels.items()):
+            cbar_lower, cbar_upper = channel_limits(channel, da, color_stats, color_percentiles, time_chunk) # ensure colors are consistent across frames
+            logging.info(f"Generating frames for channel {channel} ({channel_idx+1}/{len(channels)})")
+            cmap_name = channel_cmap(channel, channel_metadata, default_cmap_name)
+        
+            style = dict(
+                channel=channel, cmap_name=cmap_name, vmin=cbar_lower, vmax=cbar_upper, border_color=border_color, 
+                plot_metadata=plot_metadata, metadata_pos=metadata_pos, img_size_in=img_size_in, dpi=dpi, renderer=renderer, time_fmt=time_fmt,
+            )
+            source_blocks = (
+                (da.isel(time=slice(start, start + time_chunk)).values, times[start:start + time_chunk]) 
+                for start in range(0, len(times), time_chunk)
+            )
+            blocks = frame_blocks(source_blocks, interp_steps, interp_method, time_chunk, skip=skip_frames)
+            latencies = [] # seconds per frame, for the run report
+            if stream_dir:
+                stream_dir.mkdir(parents=True, exist_ok=True)
+                vid_output_path = video_path(stream_dir, channel, stream_encode.get("codec", "x264"))
+                if streams is not None and channel in streams:
+                    proc, vid_output_path = streams[channel]
+                    
+                else:
+                    proc = open_frame_stream(vid_output_path, frame_size, fps, **stream_encode)
+                    
+                blocks = ((block, block_times, None) for block, block_times in blocks)
+                for frames in render_blocks(blocks, style, pool=pool, workers=workers, tmp_dir=tmp_dir, latencies=latencies):
+                    for frame in frames:
+                        write_frame(proc, frame)
+                        
+                if streams is None:
+                    close_frame_stream(proc, vid_output_path)
+                    
+                else:
+                    streams[channel] = (proc, vid_output_path)
+                    
+                changed_channels.append(channel)
+            
+            else:
+                channel_dir = output_dir / f"var_{channel}"
+                channel_dir.mkdir(parents=True, exist_ok=True)
+                n_frames = interpolated_length(len(times), interp_steps) - skip_frames
+                if render_stale_frames(blocks, n_frames, channel_dir, style, pool=pool, workers=workers, tmp_dir=tmp_dir, frame_offset=frame_offset, latencies=latencies):
+                    changed_channels.append(channel)
+                    
+            record_frame_latencies(channel, latencies)
+            
+    logging.info("Completed generating frames for all channels.")
+    
+    return changed_channels
+    
+@instrumented
+def plot_dashboard(
+    ds, output_path, channel_metadata, border_color, plot_metadata, metadata_pos, channels = None, columns = 2, dpi = None,
+    default_cmap_name = "viridis", fps = 24, renderer = "matplotlib", time_chunk = 24, color_stats = None, color_percentiles = None, 
+    encode_params = None, preview_factor = 1, interp_steps = 0, interp_method = "linear", skip_frames = 0, streams = None,
+    ):
+    """
+    Render several channels side by side in a grid, under one shared time label, and stream them into a single video.
+    
+    Each chunk of timesteps is loaded once for all channels (one read of a lazy dataset instead of one per channel), 
+    every timestep is fanned out to the panels, and there is a single ffmpeg encode instead of one per channel. 
+    Panels are laid out like the frames of plot_frames, with the channel name in each panel's border.
+    
+    output_path: pathlib.Path - where to save the video, see video_path
+    channels: list[str] - channels to show, in order (left to right, then top to bottom); None for all of them
+    columns: int - number of panels per row
+    dpi: int - resolution of each panel; None to scale panels so the grid is as wide as a single frame of plot_frames
+    preview_factor, interp_steps, interp_method, skip_frames - see plot_frames
+    encode_params: dict - codec, preset, crf and threads of the video, see encoder_args
+    streams: dict - like in plot_frames, with the dashboard stream under the key "dashboard"
+    other arguments - see plot_frames
+    """
+    ds = drop_pole_row(ds)
+    all_channels = dict(iter_channels(ds))
+    channels = list(channels or all_channels)
+    missing = [channel for channel in channels if channel not in all_channels]
+    if missing:
+        raise ValueError(f"Dashboard channels {missing} are not in the dataset (channels: {list(all_channels)})")
+    
+    times = ds.time.values
+    data_dims = (ds.sizes["latitude"], ds.sizes["longitude"])
+    img_size_in = FRAME_SIZE_IN
+    dpi = max(1, (dpi or FRAME_DPI // columns) // preview_factor)
+    panel_h, panel_w = img_size_in[1] * dpi, img_size_in[0] * dpi
+    header_h = int(2 * METADATA_FONTSIZE * dpi / 72) if plot_metadata else 0 # band for the shared time label
+    n_rows = -(-len(channels) // columns)
+    frame_size = (header_h + n_rows * panel_h, columns * panel_w)
+    frame_size = (frame_size[0] + frame_size[0] % 2, frame_size[1] + frame_size[1] % 2) # yuv420p needs even dimensions
+    
+    styles = []
+    for channel in channels:
+        vmin, vmax = channel_limits(channel, all_channels[channel], color_stats, color_percentiles, time_chunk)
+        styles.append(dict(
+            channel=channel, cmap_name=channel_cmap(channel, channel_metadata, default_cmap_name), vmin=vmin, vmax=vmax, 
+            border_color=border_color, plot_metadata=False, metadata_pos=metadata_pos, img_size_in=img_size_in, dpi=dpi,
+        ))
+    time_fmt = frame_time_fmt(interp_steps)
+        
+    render = RENDERERS[renderer]
+    layout = frame_layout(data_dims, img_size_in, dpi)
+    img_top, img_h, img_left, img_w = layout["img_extent"]
+    label_color = (255, 255, 255) if border_color != 'white' else (0, 0, 0)
+    label_x, label_y = METADATA_POS_OPTIONS[metadata_pos]["channel"]
+    label_center = (img_top + (1 - label_y) * img_h, img_left + label_x * img_w) # where plot_frames puts the channel label
+    template = np.broadcast_to(frame_template((1, 1), border_color), (*frame_size, 4))
+    
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    stream_encode = stream_encode_args(encode_params)
+    if streams is not None and "dashboard" in streams:
+        proc, output_path = streams["dashboard"]
+        
+    else:
+        proc = open_frame_stream(output_path, frame_size, fps, **stream_encode)
+        
+    logging.info(f"Rendering a {n_rows}x{columns} dashboard of {channels} ({frame_size[1]}x{frame_size[0]} pixels) to {output_path}")
+    
+    # one read per chunk for all channels, stacked as (time, channel, latitude, longitude)
+    dashboard_ds = xr.Dataset({channel: all_channels[channel] for channel in channels})
+    source_blocks = (
+        (np.stack([block[channel].values for channel in channels], axis=1), times[start:start + time_chunk])
+        for start in range(0, len(times), time_chunk)
+        for block in [dashboard_ds.isel(time=slice(start, start + time_chunk)).load()]
+    )
+    n_frames, n_done = interpolated_length(len(times), interp_steps) - skip_frames, 0
+    latencies = [] # seconds per frame, for the run report
+    for block, block_times in frame_blocks(source_blocks, interp_steps, interp_method, time_chunk, skip=skip_frames):
+        for fields, t in zip(block, block_times):
+            frame_start = time.perf_counter()
+            frame = template.copy()
+            for panel_idx, (channel, style) in enumerate(zip(channels, styles)):
+                panel = render(fields[panel_idx], t=t, **style)
+                if plot_metadata:
+                    draw_label(panel, channel, label_center, label_color, METADATA_FONTSIZE, dpi)
+                    
+                top = header_h + (panel_idx // columns) * panel_h
+                left = (panel_idx % columns) * panel_w
+                frame[top:top + panel_h, left:left + panel_w] = panel
+                
+            if plot_metadata:
+                draw_label(frame, fmt_time_str(t, time_fmt), (header_h / 2, frame_size[1] / 2), label_color, METADATA_FONTSIZE, dpi)
+                
+            write_frame(proc, frame.tobytes())
+            latencies.append(time.perf_counter() - frame_start)
+            
+        n_done += len(block)
+        logging.info(f"Dashboard frames {n_done - len(block) + 1}-{n_done} of {n_frames} done")
+        
+    if streams is None:
+        close_frame_stream(proc, output_path)
+        
+    else:
+        streams["dashboard"] = (proc, output_path)
+        
+    record_frame_latencies("dashboard", latencies)
+
+@instrumented
+def dir2movie(
+    input_dir: pathlib.Path,
+    output_path: pathlib.Path,
+    input_fmt: str = r'%04d.png',
+    fps: int = 24,
+    codec: str = "x264",
+    preset: str = "medium",
+    crf: int = None,
+    threads: int = 0,
+    ):
+    """
+    Convert a directory of images to a movie, and check the result.
+    
+    The encode succeeded if ffmpeg exits with 0 and the output has as many frames as there are images 
+    (see probe_video); otherwise ffmpeg's error output is logged. The movie starts at the lowest numbered image,
+    which need not be 1 (see the frame_offset of plot_frames). If ffmpeg can't be found, you may need to 
+    replace "ffmpeg" in the command below with the full path to it.
+    
+    codec, preset, crf, threads - see encoder_args
+    
+    Returns a dict with the channel directory, output path, success, number of frames, encode seconds and 
+    throughput in frames per second.
+    """
+    frame_numbers = [int(path.stem) for path in input_dir.glob("*.png") if path.stem.isdigit()]
+    n_frames = len(frame_numbers)
+    output_path = pathlib.Path(output_path).resolve() # ffmpeg runs in input_dir
+    cmd = [
+        "ffmpeg", "-y", "-nostdin", "-loglevel", "error", 
+        "-framerate", f"{fps}", "-start_number", f"{min(frame_numbers, default=1)}", "-i", input_fmt, *encoder_args(codec, preset, crf, threads), f"{output_path}",
+    ]
+    logging.info(f"Using command: \n\t{' '.join(cmd)}")
+    
+    start = time.perf_counter()
+    result = subprocess.run(cmd, cwd=input_dir, capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    
+    encoded_frames = probe_video(output_path) if result.returncode == 0 else None
+    success = encoded_frames == n_frames
+    report = dict(
+        input_dir=f"{input_dir}", output_path=f"{output_path}", success=success, frames=n_frames, 
+        seconds=seconds, frames_per_second=n_frames / seconds if seconds else None,
+        size_mb=output_path.stat().st_size / 1e6 if success else None,
+    )
+    if success:
+        logging.info(f"Saved movie to {output_path}: {n_frames} frames in {seconds:.1f}s ({report['frames_per_second']:.1f} frames/s, {report['size_mb']:.1f} MB)")
+        
+    else:
+        logging.error(f"Encoding {input_dir} failed (ffmpeg exit code {result.returncode}, {encoded_frames} of {n_frames} frames in {output_path}):\n{result.stderr[-2000:]}")
+        
+    return report
+
+def probe_video(path):
+    """
+    Count the video frames in a movie by listing its packets (no decoding), or return None if it can't be read.
+    Uses ffmpeg itself rather than ffprobe, which is not always installed alongside it.
+    """
+    result = subprocess.run(
+        ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", f"{path}", "-map", "0:v:0", "-c", "copy", "-f", "framecrc", "-"], 
+        capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        return None
+    
+    return sum(1 for line in result.stdout.splitlines() if line and not line.startswith("#")) # one line per packet
+
+def available_cores():
+    """
+    Number of cores this process may run on (respects CPU affinity, e.g. in containers or batch jobs).
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    
+    return os.cpu_count() or 1
+
+@instrumented
+def encode_videos(jobs, fps, codec = "x264", preset = "medium", crf = None, threads = None, max_jobs = None):
+    """
+    Encode several channels' frames into movies concurrently (see dir2movie).
+    
+    Each ffmpeg process already runs in parallel, so by default as many encodes run at once as there are cores 
+    (or jobs, if fewer), and the cores are split evenly between them with -threads. 
+    
+    jobs: list[tuple[pathlib.Path, pathlib.Path]] - (frame directory, output path) of each movie
+    fps: int - framerate of the movies
+    codec, preset, crf - see encoder_args
+    threads: int - encoder threads per movie, None to split the available cores between concurrent encodes
+    max_jobs: int - maximum number of concurrent encodes, None to size it to the available cores
+    
+    Returns the dir2movie report of each job, in order.
+    """
+    if not jobs:
+        return []
+    
+    cores = available_cores()
+    max_jobs = max_jobs or min(len(jobs), cores)
+    threads = max(1, cores // max_jobs) if threads is None else threads
+    logging.info(f"Encoding {len(jobs)} movies with {codec} (preset {preset}), {max_jobs} at a time with {threads} threads each")
+    
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_jobs) as pool: # threads only wait on ffmpeg processes
+        reports = list(pool.map(
+            lambda job: dir2movie(input_dir=job[0], output_path=job[1], fps=fps, codec=codec, preset=preset, crf=crf, threads=threads), 
+            jobs,
+        ))
+        
+    seconds = time.perf_counter() - start
+    n_frames = sum(report["frames"] for report in reports)
+    failed = [report["input_dir"] for report in reports if not report["success"]]
+    logging.info(f"Encoded {len(reports) - len(failed)} of {len(reports)} movies ({n_frames} frames) in {seconds:.1f}s ({n_frames / seconds:.1f} frames/s overall)")
+    if failed:
+        logging.error(f"Failed to encode: {failed}")
+        
+    return reports
+
+@instrumented
+def concat_videos(segments, output_path):
+    """
+    Join movies end to end with ffmpeg's concat demuxer, without re-encoding (-c copy).
+    
+    The segments must have been encoded with the same codec and settings, e.g. the per-shard segments of run_shards.
+    The join succeeded if ffmpeg exits with 0 and the output has as many frames as the segments together (see probe_video).
+    
+    segments: list[pathlib.Path] - movies to join, in order
+    output_path: pathlib.Path - where to save the joined movie
+    
+    Returns True if the join succeeded.
+    """
+    output_path = pathlib.Path(output_path).resolve()
+    list_path = output_path.with_name(f"{output_path.stem}_segments.txt")
+    lines = []
+    for segment in segments: # a ' in a path is written as '\'' in the concat list
+        quoted = f"{pathlib.Path(segment).resolve()}".replace("'", "'\\''")
+        lines.append(f"file '{quoted}'\n")
+        
+    list_path.write_text("".join(lines))
+    cmd = ["ffmpeg", "-y", "-nostdin", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", f"{list_path}", "-c", "copy", f"{output_path}"]
+    logging.info(f"Using command: \n\t{' '.join(cmd)}")
+    
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    list_path.unlink()
+    expected = sum(probe_video(segment) or 0 for segment in segments)
+    joined = probe_video(output_path) if result.returncode == 0 else None
+    if joined != expected:
+        logging.error(f"Joining {len(segments)} segments into {output_path} failed (ffmpeg exit code {result.returncode}, {joined} of {expected} frames):\n{result.stderr[-2000:]}")
+        return False
+        
+    logging.info(f"Joined {len(segments)} segments into {output_path} ({expected} frames)")
+    
+    return True
+
+def month_shards(start_date, stop_date_inc):
+    """
+    Split a date range into calendar months.
+    
+    start_date, stop_date_inc: str - first and last day (or time) of the range, as YYYY-MM-DD or YYYY-MM-DDTHH:MM (inclusive)
+    
+    Returns a list of (shard_id, start, stop) with shard_id YYYYMM. The first and last shard keep the given start and stop,
+    the others run from the first to the last day of their month.
+    """
+    start, stop = (datetime.datetime.fromisoformat(date).date() for date in (start_date, stop_date_inc))
+    shards = []
+    month_start = start.replace(day=1)
+    while month_start <= stop:
+        next_month = (month_start + datetime.timedelta(days=32)).replace(day=1)
+        month_stop = next_month - datetime.timedelta(days=1)
+        shards.append((
+            f"{month_start:%Y%m}",
+            start_date if month_start <= start else f"{month_start}",
+            stop_date_inc if month_stop >= stop else f"{month_stop}",
+        ))
+        month_start = next_month
+        
+    return shards
+
+def shard_path(ds_path, shard_id):
+    """
+    Location of one shard of a dataset saved by run_shards, e.g. out_merged.nc -> out_merged_200508.nc
+    """
+    ds_path = pathlib.Path(ds_path)
+    
+    return ds_path.with_name(f"{ds_path.stem}_{shard_id}{ds_path.suffix}")
+
+def log_file():
+    """
+    File the root logger writes to (see setup_logger), or None, so worker processes can log to the same file.
+    """
+    return next((handler.baseFilename for handler in logging.getLogger().handlers if isinstance(handler, logging.FileHandler)), None)
+
+@instrumented
+def prepare_dataset(
+    data_params, use_ds, output_ds_path, rm_originals,
+    working_dir, output_stem, output_stem_explain,
+    download_params = None, cache_params = None, time_chunk = None, keep_levels = False, zarr_params = None, pyramid_factors = None,
+    derived_fields = None,
+    ):
+    """
+    Open use_ds, or pull the data from cdsapi (see fetch_data) and process it (see postprocessing).
+    
+    See main for the arguments.
+    
+    Returns the dataset and its channel statistics (see read_channel_stats), or None if they weren't saved.
+    """
+    if use_ds: # use a pre-existing dataset
+        ds = open_output(use_ds, chunks={"time": time_chunk} if time_chunk else None)
+        
+        return ds, read_channel_stats(stats_path(use_ds))
+        
+    # pull data
+    sfc_request, pl_request, time_range, drop_inputs = fetch_data(data_params, working_dir, output_stem, output_stem_explain, download_params, cache_params, derived_fields)
+    
+    # post process data
+    ds = postprocessing(sfc_request, pl_request, output_ds_path, rm_originals, time_chunk=time_chunk, keep_levels=keep_levels, zarr_params=zarr_params, pyramid_factors=pyramid_factors, time_range=time_range, derived_fields=derived_fields, drop_inputs=drop_inputs)
+    
+    return ds, read_channel_stats(stats_path(output_ds_path)) if output_ds_path else None
+
+def preview_dataset(ds, saved_path, preview_factor, time_chunk = None):
+    """
+    The preview_factor times coarsened copy of a dataset: its saved pyramid level (see build_pyramid) if there is one,
+    otherwise ds coarsened now.
+    """
+    if saved_path and pyramid_path(saved_path, preview_factor).exists():
+        ds.close()
+        
+        return open_output(pyramid_path(saved_path, preview_factor), chunks={"time": time_chunk} if time_chunk else None)
+        
+    logging.warning(f"No {preview_factor}x pyramid level saved (see pyramid_factors) - coarsening the dataset now")
+    
+    return coarsen_dataset(ds, preview_factor)
+
+@instrumented
+def render_dataset(
+    ds, color_stats, img_dir, vid_dir, channel_metadata, border_color, fps, plot_metadata, metadata_pos,
+    stream_frames = False, renderer = "matplotlib", workers = 1, time_chunk = None, color_percentiles = None,
+    encode_params = None, dashboard = None, preview_factor = None, interpolation = None, frame_offset = 0, skip_frames = 0, encode = True,
+    ):
+    """
+    Render the videos of a dataset into vid_dir: a dashboard, streamed videos, or png frames in img_dir that are
+    then encoded, re-encoding only the videos whose frames changed.
+    
+    frame_offset, skip_frames - see plot_frames
+    encode: bool - False to only save the png frames, to encode them later (see encode_frames); streamed videos are always encoded
+    
+    See main for the other arguments.
+    """
+    vid_dir.mkdir(parents=True, exist_ok=True)
+    interp = interp_args(interpolation)
+    if dashboard: # all channels in one video, frames go straight into ffmpeg
+        dashboard_path = video_path(vid_dir, "dashboard", (encode_params or {}).get("codec") or "x264")
+        plot_dashboard(ds, dashboard_path, channel_metadata, border_color, plot_metadata, metadata_pos, fps=fps, renderer=renderer, time_chunk=time_chunk or 24, color_stats=color_stats, color_percentiles=color_percentiles, encode_params=encode_params, preview_factor=preview_factor or 1, skip_frames=skip_frames, **interp, **dashboard)
+        logging.info("Dashboard streamed")
+        
+    elif stream_frames: # frames go straight into ffmpeg, so the videos are done once the frames are
+        plot_frames(ds, img_dir, channel_metadata, border_color, plot_metadata, metadata_pos=metadata_pos, stream_dir=vid_dir, fps=fps, renderer=renderer, workers=workers, time_chunk=time_chunk or 24, color_stats=color_stats, color_percentiles=color_percentiles, encode_params=encode_params, preview_factor=preview_factor or 1, skip_frames=skip_frames, **interp)
+        logging.info("Videos streamed")
+        
+    else:
+        # plot frames of video
+        changed_channels = plot_frames(ds, img_dir, channel_metadata, border_color, plot_metadata, metadata_pos=metadata_pos, renderer=renderer, workers=workers, time_chunk=time_chunk or 24, color_stats=color_stats, color_percentiles=color_percentiles, encode_params=encode_params, preview_factor=preview_factor or 1, frame_offset=frame_offset, skip_frames=skip_frames, **interp)
+        
+        # create video
+        if encode:
+            encode_frames(img_dir, vid_dir, fps, encode_params, changed_channels)
+
+def encode_frames(img_dir, vid_dir, fps, encode_params = None, changed_channels = None):
+    """
+    Encode the png frames that plot_frames saved in img_dir into one video per channel in vid_dir (see encode_videos).
+    
+    changed_channels: list[str] - only re-encode these channels if their video already exists, or None to encode every channel
+    """
+    logging.info("Creating videos")
+    
+    vid_dir.mkdir(parents=True, exist_ok=True)
+    encode_params = encode_params or {}
+    jobs = []
+    for dir in img_dir.glob("var_*"): # glob format set in plot_frames()
+        varname = dir.name.split("_", 1)[1] # channels like wind_direction500 have underscores too
+        vid_output_path = video_path(vid_dir, varname, encode_params.get("codec", "x264"))
+        if changed_channels is not None and varname not in changed_channels and vid_output_path.exists():
+            logging.info(f"Frames for {varname} unchanged - keeping {vid_output_path}")
+            continue
+            
+        jobs.append((dir, vid_output_path))
+        
+    encode_videos(jobs, fps, **encode_params) # input_fmt set in plot_frames()
+
+# prepare_dataset arguments that change what a saved shard contains, see shard_key
+SHARD_KEY_ARGS = ("time_chunk", "keep_levels", "zarr_params", "pyramid_factors", "derived_fields")
+
+def shard_key(shard_params, prepare_args):
+    """
+    Content address of a shard of run_shards: the sha256 of its data_params (dates, variables, levels, hours, area)
+    and the processing arguments in SHARD_KEY_ARGS, so a saved shard is only reused for the same data.
+    """
+    settings = dict(data_params=shard_params, **{name: prepare_args.get(name) for name in SHARD_KEY_ARGS})
+    
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+def prepare_shard(data_params, prepare_args, reuse = False, log_loc = None):
+    """
+    Pull and process one shard of run_shards in a worker process, unless reuse is set and it was saved by an earlier run.
+    
+    Returns the number of timesteps in the shard, and the stages recorded for the run report (see run_report_part).
+    """
+    if log_loc: # spawned processes start without the parent's logging setup
+        setup_logger(log_loc, filemode='a')
+        
+    reset_run_report() # workers are reused for several shards
+        
+    saved_path = prepare_args["output_ds_path"]
+    if reuse and saved_path.exists() and stats_path(saved_path).exists():
+        logging.info(f"Shard {saved_path} already processed - reusing it")
+        prepare_args = dict(prepare_args, use_ds=saved_path)
+        
+    ds, _ = prepare_dataset(data_params, **prepare_args)
+    n_times = ds.sizes["time"]
+    ds.close()
+    
+    return n_times, run_report_part()
+
+def render_shard(saved_path, lead_in_path, color_stats, img_dir, vid_dir, render_args, frame_offset, time_chunk = None, log_loc = None):
+    """
+    Render the videos of one shard of run_shards in a worker process.
+    
+    When interpolating, the last timestep of the previous shard (lead_in_path) is put in front of this one,
+    so the frames between the two shards are interpolated too; its own frame belongs to the previous shard and is skipped.
+    
+    Returns the stages recorded for the run report, see run_report_part.
+    """
+    if log_loc: # spawned processes start without the parent's logging setup
+        setup_logger(log_loc, filemode='a')
+        
+    reset_run_report() # workers are reused for several shards
+        
+    preview_factor = render_args.get("preview_factor")
+    
+    def open_shard(path):
+        ds = open_output(path, chunks={"time": time_chunk} if time_chunk else None)
+        
+        return preview_dataset(ds, path, preview_factor, time_chunk) if preview_factor else ds
+        
+    ds = open_shard(saved_path)
+    skip_frames = 0
+    if lead_in_path:
+        lead_in = open_shard(lead_in_path)
+        ds = xr.concat([lead_in.isel(time=[-1]).load(), ds], dim="time")
+        lead_in.close()
+        skip_frames = 1
+        
+    render_dataset(ds, color_stats, img_dir, vid_dir, **render_args, time_chunk=time_chunk, frame_offset=frame_offset, skip_frames=skip_frames)
+    ds.close()
+    
+    return run_report_part()
+
+@instrumented
+def run_shards(data_params, img_dir, vid_dir, prepare_args, render_args, max_workers = 1):
+    """
+    Build the videos of a long date range (data_params with start_date/stop_date_inc, e.g. a season or a decade)
+    as a batch of month-sized shards (see month_shards).
+    
+    1. Each shard is pulled and processed on its own (see prepare_shard), max_workers shards at a time in separate processes,
+       and saved next to output_ds_path (see shard_path). The date range and shard_key of every saved shard are recorded in 
+       {output stem}_shards.json, and shards saved by an earlier run for the same dates and settings are reused, so an 
+       interrupted or extended job only processes the missing (or extended) months, and a job with other variables, 
+       levels, hours, area or derived fields processes them all again.
+    2. The shards' channel statistics are merged (see merge_sketches), so colour limits are the same in every shard.
+    3. Each shard is rendered on its own (see render_shard) into a segment per video under vid_dir/segments/{shard_id},
+       with png frames under img_dir/{shard_id} numbered from where the previous shard's frames end.
+       Frames (and segments) are only re-rendered when they changed, as in main.
+    4. The segments of each video are joined into vid_dir without re-encoding (see concat_videos).
+    
+    prepare_args: dict - arguments of prepare_dataset (other than data_params)
+    render_args: dict - arguments of render_dataset (other than the dataset, statistics and directories)
+    max_workers: int - maximum number of shards processed or rendered at once; each renders with render_args["workers"] processes
+    """
+    if "start_date" not in data_params:
+        raise ValueError("Sharding needs a start_date/stop_date_inc range in data_params")
+        
+    if prepare_args["use_ds"]:
+        raise ValueError("Sharding pulls and processes each month separately, so it can't be used with use_ds")
+        
+    shards = month_shards(data_params["start_date"], data_params["stop_date_inc"])
+    base_path = pathlib.Path(prepare_args["output_ds_path"] or prepare_args["working_dir"] / f"{prepare_args['output_stem']}_merged.nc") # shards are always saved
+    saved_paths = [shard_path(base_path, shard_id) for shard_id, _, _ in shards]
+    manifest_path = base_path.with_name(f"{base_path.stem}_shards.json")
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+    time_chunk = prepare_args["time_chunk"]
+    log_loc = log_file()
+    shard_params = [dict(data_params, start_date=start, stop_date_inc=stop) for _, start, stop in shards]
+    entries = {shard_id: dict(dates=[start, stop], key=shard_key(params, prepare_args)) for (shard_id, start, stop), params in zip(shards, shard_params)}
+    logging.info(f"Running {len(shards)} shards ({shards[0][0]}-{shards[-1][0]}), {max_workers} at a time")
+    
+    # spawn rather than fork, as in render_pool
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [
+            pool.submit(
+                prepare_shard,
+                params,
+                dict(prepare_args, output_ds_path=saved_path, output_stem=f"{prepare_args['output_stem']}_{shard_id}"), # downloads of concurrent shards don't collide
+                manifest.get(shard_id) == entries[shard_id],
+                log_loc,
+            )
+            for (shard_id, _, _), params, saved_path in zip(shards, shard_params, saved_paths)
+        ]
+        shard_times = []
+        for future in futures:
+            n_times, report_part = future.result()
+            shard_times.append(n_times)
+            merge_run_report(report_part)
+            
+        manifest.update(entries)
+        manifest_path.write_text(json.dumps(manifest, indent=2))
+        
+        # colour limits and frame numbers of the whole range
+        shard_stats = [read_channel_stats(stats_path(saved_path)) for saved_path in saved_paths]
+        color_stats = {channel: merge_sketches([stats[channel] for stats in shard_stats if channel in stats]) for channel in shard_stats[0]}
+        steps = interp_args(render_args.get("interpolation")).get("interp_steps", 0)
+        lead_ins = [None] + saved_paths[:-1] if steps else [None] * len(shards)
+        shard_frames = [interpolated_length(n_times + bool(lead_in), steps) - bool(lead_in) for n_times, lead_in in zip(shard_times, lead_ins)]
+        frame_offsets = np.cumsum([0] + shard_frames[:-1])
+        logging.info(f"Shards have {shard_times} timesteps, {sum(shard_frames)} frames in all")
+        
+        futures = [
+            pool.submit(
+                render_shard, saved_path, lead_in, color_stats, img_dir / shard_id, vid_dir / "segments" / shard_id,
+                render_args, int(frame_offset), time_chunk, log_loc,
+            )
+            for (shard_id, _, _), saved_path, lead_in, frame_offset in zip(shards, saved_paths, lead_ins, frame_offsets)
+        ]
+        for future in futures:
+            merge_run_report(future.result())
+            
+    # join the segments of each video
+    segment_dirs = [vid_dir / "segments" / shard_id for shard_id, _, _ in shards]
+    names = sorted({path.name for segment_dir in segment_dirs for path in segment_dir.glob("*.*")})
+    for name in names:
+        segments = [segment_dir / name for segment_dir in segment_dirs]
+        missing = [f"{segment}" for segment in segments if not segment.exists()]
+        if missing:
+            logging.error(f"Not joining {name}: missing segments {missing}")
+            continue
+            
+        concat_videos(segments, vid_dir / name)
+
+def queue_worker(items, out_queue):
+    """
+    Iterate over items (e.g. a generator doing one stage of run_pipelined) in a thread, putting each item on out_queue, then None.
+    
+    With a bounded out_queue, the thread waits while the queue is full, so it can't run more than out_queue.maxsize items 
+    ahead of its consumer. An exception is put on the queue instead and re-raised by drain_queue in the consumer.
+    """
+    def run():
+        try:
+            for item in items:
+                out_queue.put(item)
+                
+        except BaseException as error:
+            out_queue.put(error)
+            
+        else:
+            out_queue.put(None)
+            
+    thread = threading.Thread(target=run, daemon=True) # a failed consumer doesn't wait for producers stuck on a full queue
+    thread.start()
+    
+    return thread
+
+def drain_queue(in_queue):
+    """
+    Yield the items a queue_worker puts on in_queue as they arrive, until it is done, re-raising its exception if it failed.
+    """
+    while True:
+        item = in_queue.get()
+        if item is None:
+            return
+        
+        if isinstance(item, BaseException):
+            raise item
+        
+        yield item
+
+@instrumented
+def run_pipelined(data_params, img_dir, vid_dir, prepare_args, render_args, queue_size = 2):
+    """
+    Download, process, render and encode a start_date/stop_date_inc range day by day, with the stages overlapping.
+    
+    1. A thread pulls one day after another (see pull_data_range).
+    2. A thread processes each downloaded day (see postprocessing) and appends it to output_ds_path, which must be
+       a zarr store (or None to keep nothing).
+    3. This thread renders each processed day's frames straight into one ffmpeg process per video (see plot_frames 
+       and plot_dashboard), which encodes them as they arrive.
+    The stages are connected by queues of at most queue_size days, so day N+1 downloads while day N is processed
+    and day N-1 rendered, the run takes about as long as its slowest stage instead of the sum of all of them, and
+    no more than a few days are held in memory. mp4 videos are written as fragmented mp4 (see open_frame_stream),
+    so they can be watched up to the last encoded frame while the run goes on.
+    
+    Frames are always streamed, so nothing is left in img_dir except the blocks shared with render workers.
+    Colour limits have to be fixed before the last day is downloaded: they come from the channel statistics saved 
+    with output_ds_path by an earlier run, if there are any, otherwise from the first day (so later days may clip).
+    
+    prepare_args, render_args - see run_shards
+    queue_size: int - maximum number of days waiting between two stages
+    """
+    if "start_date" not in data_params:
+        raise ValueError("Pipelining needs a start_date/stop_date_inc range in data_params")
+        
+    if prepare_args["use_ds"]:
+        raise ValueError("Pipelining pulls and processes each day separately, so it can't be used with use_ds")
+        
+    output_ds_path = prepare_args["output_ds_path"]
+    if output_ds_path and not is_zarr(output_ds_path):
+        raise ValueError(f"Pipelining appends each day to output_ds_path, so it must be a .zarr store or None, not {output_ds_path}")
+        
+    start, stop = (datetime.datetime.fromisoformat(date).date() for date in (data_params["start_date"], data_params["stop_date_inc"]))
+    days = [start + datetime.timedelta(days=i) for i in range(0, (stop - start).days + 1, data_params.get("step_day", 1))]
+    day_ranges = [ # the first and last day keep the hours of start_date and stop_date_inc, see postprocessing
+        (data_params["start_date"] if day == start else f"{day}", data_params["stop_date_inc"] if day == stop else f"{day}")
+        for day in days
+    ]
+    zarr_params = dict(prepare_args["zarr_params"] or {}, append=True) # each day is added to the days before it
+    derived_fields, drop_inputs = prepare_args["derived_fields"], None
+    if derived_fields:
+        data_params, drop_inputs = field_requests(data_params, derived_fields)
+        
+    
+    def download_days():
+        for day_start, day_stop in day_ranges:
+            requests = pull_data_range(
+                **dict(data_params, start_date=day_start, stop_date_inc=day_stop), **(prepare_args["download_params"] or {}),
+                target_loc=prepare_args["working_dir"], output_stem=f"{prepare_args['output_stem']}_{day_start[:10]}", 
+                output_stem_explain=prepare_args["output_stem_explain"], cache=prepare_args["cache_params"],
+            )
+            yield (day_start, day_stop), requests
+            
+    def process_days(downloaded):
+        for time_range, (sfc_request, pl_request) in downloaded:
+            with NETCDF_LOCK: # the download thread merges the next day's netcdf files meanwhile
+                ds = postprocessing(
+                    sfc_request, pl_request, output_ds_path, False, keep_levels=prepare_args["keep_levels"], 
+                    zarr_params=zarr_params, pyramid_factors=prepare_args["pyramid_factors"], time_range=time_range,
+                    derived_fields=derived_fields, drop_inputs=drop_inputs,
+                )
+                day_ds = ds.sel(time=slice(*time_range)).load() # in memory, so rendering doesn't read the store while the next day is appended
+                ds.close()
+                
+            if prepare_args["rm_originals"]:
+                for request in (sfc_request, pl_request):
+                    request["target"].unlink(missing_ok=True)
+                    
+            yield day_ds
+            
+    downloads, processed = queue.Queue(maxsize=queue_size), queue.Queue(maxsize=queue_size)
+    queue_worker(download_days(), downloads)
+    queue_worker(process_days(drain_queue(downloads)), processed)
+    logging.info(f"Pipelining {len(days)} days ({day_ranges[0][0]} to {day_ranges[-1][1]}), up to {queue_size} days queued between stages")
+    
+    vid_dir.mkdir(parents=True, exist_ok=True)
+    preview_factor = render_args.get("preview_factor")
+    interp = interp_args(render_args.get("interpolation"))
+    encode_params = dict(render_args.get("encode_params") or {}, fragmented=True)
+    style_args = dict(
+        channel_metadata=render_args["channel_metadata"], border_color=render_args["border_color"], plot_metadata=render_args["plot_metadata"], 
+        metadata_pos=render_args["metadata_pos"], fps=render_args["fps"], renderer=render_args["renderer"], 
+        color_percentiles=render_args["color_percentiles"], encode_params=encode_params, preview_factor=preview_factor or 1, **interp,
+    )
+    color_stats = read_channel_stats(stats_path(output_ds_path)) if output_ds_path and stats_path(output_ds_path).exists() else {}
+    streams = {}
+    previous = None
+    pool = render_pool(render_args["workers"]) if render_args["workers"] > 1 and not render_args["dashboard"] else None # started once, not every day
+    try:
+        for day_ds in drain_queue(processed):
+            if preview_factor:
+                day_ds = coarsen_dataset(day_ds, preview_factor)
+                
+            missing = [channel for channel, _ in iter_channels(day_ds) if channel not in color_stats]
+            if missing: # fixed now, so every day of a video has the same colours
+                logging.warning(f"No saved statistics for channels {missing} - using the colour limits of the first day, later days may clip")
+                day_stats = channel_stats(day_ds)
+                color_stats.update({channel: day_stats[channel] for channel in missing})
+                
+            ds, skip_frames = day_ds, 0
+            if previous is not None and interp.get("interp_steps"): # interpolate across midnight too, see render_shard
+                ds, skip_frames = xr.concat([previous.isel(time=[-1]), day_ds], dim="time"), 1
+                
+            if render_args["dashboard"]:
+                dashboard_path = video_path(vid_dir, "dashboard", encode_params.get("codec") or "x264")
+                plot_dashboard(ds, dashboard_path, time_chunk=ds.sizes["time"], color_stats=color_stats, skip_frames=skip_frames, streams=streams, **style_args, **render_args["dashboard"])
+                
+            else:
+                plot_frames(ds, img_dir, stream_dir=vid_dir, workers=render_args["workers"], time_chunk=ds.sizes["time"], color_stats=color_stats, skip_frames=skip_frames, streams=streams, pool=pool, **style_args)
+                
+            logging.info(f"Day {day_ds.time.values[0]} rendered - videos in {vid_dir} are playable up to here")
+            previous = day_ds
+            
+    finally:
+        if pool is not None:
+            pool.shutdown()
+            
+        failed = []
+        for proc, path in streams.values(): # close every stream, even if one of them fails
+            try:
+                close_frame_stream(proc, path)
+                
+            except RuntimeError as error:
+                failed.append(error)
+                
+    if failed:
+        raise failed[0]
+
+ERA5_GRID_DEG = 0.25 # ERA5 grid spacing, in degrees
+PNG_BYTES_PER_PIXEL = 1.5 # size of a saved frame, measured on noisy synthetic fields (see benchmark.py), so on the high side for real data
+VIDEO_BYTES_PER_PIXEL = 0.01 # size of each encoded frame at the default quality, same caveat
+
+def grid_shape(area = None):
+    """
+    (latitude, longitude) size of the ERA5 grid of an area ([north, west, south, east], or None for the whole globe).
+    """
+    if not area:
+        return (int(180 / ERA5_GRID_DEG) + 1, int(360 / ERA5_GRID_DEG))
+    
+    north, west, south, east = area
+    
+    return (round((north - south) / ERA5_GRID_DEG) + 1, round(((east - west) % 360) / ERA5_GRID_DEG) + 1)
+
+def output_channels(data_params, derived_fields = None, keep_levels = False):
+    """
+    Names of the channels (one video each) that postprocessing will produce from data_params and derived_fields, 
+    worked out without downloading anything, in the order iter_channels gives them for the processed dataset: 
+    single level variables, then pressure level ones (see postprocessing), less the inputs only requested for 
+    derived_fields, then the derived fields (see derive_fields), with pressure level channels after all the others 
+    unless keep_levels is set (see flatten_levels).
+    """
+    fetched_params, drop_inputs = field_requests(data_params, derived_fields) if derived_fields else (data_params, {})
+    dropped_levels = {int(level) for level in drop_inputs.get("levels", [])}
+    levels = [int(level) for level in fetched_params["pl_levels"] or [] if int(level) not in dropped_levels]
+    variables = [(file_variable(variable) or variable, False) for variable in fetched_params["sfc_vars"] or []] # (name, has levels)
+    variables += [(file_variable(variable) or variable, True) for variable in fetched_params["pl_vars"] or []]
+    variables = [(name, per_level) for name, per_level in variables if name not in drop_inputs.get("variables", [])]
+    for field in derived_fields or []:
+        order, raw = resolve_fields([field])
+        per_level = any(RAW_VARIABLES[name][0] == "pl" for name in raw) and not any(DERIVED_FIELDS[name].get("levels") for name in order)
+        variables.append((field, per_level))
+        
+    if keep_levels:
+        return [channel for name, per_level in variables for channel in ([f"{name}{level}" for level in levels] if per_level else [name])]
+    
+    channels = [name for name, per_level in variables if not per_level]
+    channels += [f"{name}{level}" for level in levels for name, per_level in variables if per_level]
+    
+    return channels
+
+def plan_run(
+    data_params, working_dir, output_stem, download_params = None, derived_fields = None, keep_levels = False,
+    stream_frames = False, dashboard = None, preview_factor = None, interpolation = None, pyramid_factors = None, pipeline_params = None,
+    ):
+    """
+    What a run of main with these arguments would do, without downloading, processing or rendering anything:
+    the exact requests sent to the CDS (see data_requests), the timesteps, channels and frames, and a rough estimate
+    of the disk space it needs. Estimates assume uncompressed (netcdf) datasets and the default video quality.
+    
+    See main for the arguments.
+    
+    Returns a dict that can be printed as JSON.
+    """
+    fetched_params, _ = field_requests(data_params, derived_fields) if derived_fields else (data_params, None)
+    _, _, chunks = data_requests(fetched_params, working_dir, output_stem, download_params)
+    times = request_times(data_params)
+    channels = output_channels(data_params, derived_fields, keep_levels)
+    steps = interp_args(interpolation).get("interp_steps", 0)
+    n_frames = interpolated_length(len(times), steps)
+    grid = grid_shape(data_params.get("area"))
+    frame_pixels = FRAME_SIZE_IN[0] * FRAME_SIZE_IN[1] * (FRAME_DPI // (preview_factor or 1))**2
+    videos = ["dashboard"] if dashboard else channels
+    video_pixels = frame_pixels * (len(dashboard.get("channels") or channels) if dashboard else 1) # roughly, panels shrink with more columns
+    
+    def download_bytes(chunk):
+        request = chunk["request"]
+        values = len(request["variable"]) * len(request.get("pressure_level") or [None]) * len(canonical_request(chunk["name"], request)["datetimes"])
+        
+        return values * grid[0] * grid[1] * 2 # the CDS packs values as int16
+    
+    dataset_bytes = len(times) * len(channels) * grid[0] * grid[1] * 4 # float32
+    streamed = stream_frames or dashboard or pipeline_params
+    disk_mb = dict(
+        downloads=sum(download_bytes(chunk) for chunk in chunks) / 1e6,
+        dataset=dataset_bytes / 1e6,
+        pyramid=sum(dataset_bytes / factor**2 for factor in pyramid_factors or ()) / 1e6,
+        frames=0 if streamed else n_frames * len(channels) * frame_pixels * PNG_BYTES_PER_PIXEL / 1e6,
+        videos=n_frames * len(videos) * video_pixels * VIDEO_BYTES_PER_PIXEL / 1e6,
+    )
+    
+    return dict(
+        requests=[dict(chunk, target=f"{chunk['target']}") for chunk in chunks],
+        timesteps=dict(count=len(times), first=f"{times[0]}" if times else None, last=f"{times[-1]}" if times else None),
+        grid=list(grid),
+        channels=channels,
+        videos=videos,
+        frames_per_video=n_frames,
+        frames=n_frames * (len(channels) if not dashboard else 1),
+        estimated_disk_mb={key: round(value, 1) for key, value in disk_mb.items()},
+    )
+
+def main(
+    data_params, vid_dir, img_dir, use_ds,
+    output_ds_path, rm_originals, rm_images,
+    channel_metadata,
+    border_color, fps, plot_metadata, metadata_pos,
+    output_stem_explain, working_dir, output_stem,
+    stream_frames = False, renderer = "matplotlib", workers = 1,
+    download_params = None, cache_params = None, time_chunk = None,
+    color_percentiles = None, keep_levels = False, zarr_params = None, encode_params = None,
+    dashboard = None, pyramid_factors = None, preview_factor = None, interpolation = None, shard_params = None,
+    chrome_trace = False, pipeline_params = None, derived_fields = None,
+    ):
+    reset_run_report()
+    data_params, derived_fields = legacy_derived_fields(data_params, derived_fields)
+    if preview_factor: # keep previews apart from the full resolution frames and videos
+        img_dir, vid_dir = img_dir / f"preview_x{preview_factor}", vid_dir / f"preview_x{preview_factor}"
+        
+    # prepare home dir and output dirs
+    vid_dir.mkdir(parents=True, exist_ok=True)
+    img_dir.mkdir(parents=True, exist_ok=True)
+    
+    prepare_args = dict(
+        use_ds=use_ds, output_ds_path=output_ds_path, rm_originals=rm_originals,
+        working_dir=working_dir, output_stem=output_stem, output_stem_explain=output_stem_explain,
+        download_params=download_params, cache_params=cache_params, time_chunk=time_chunk, keep_levels=keep_levels,
+        zarr_params=zarr_params, pyramid_factors=pyramid_factors, derived_fields=derived_fields,
+    )
+    render_args = dict(
+        channel_metadata=channel_metadata, border_color=border_color, fps=fps, plot_metadata=plot_metadata, metadata_pos=metadata_pos,
+        stream_frames=stream_frames, renderer=renderer, workers=workers, color_percentiles=color_percentiles,
+        encode_params=encode_params, dashboard=dashboard, preview_factor=preview_factor, interpolation=interpolation,
+    )
+    
+    if shard_params and pipeline_params:
+        raise ValueError("Use either shard_params or pipeline_params, not both")
+        
+    if pipeline_params: # a date range, day by day, downloading, processing and rendering at once
+        run_pipelined(data_params, img_dir, vid_dir, prepare_args, render_args, **pipeline_params)
+        
+    elif shard_params: # a long date range, month by month
+        run_shards(data_params, img_dir, vid_dir, prepare_args, render_args, **shard_params)
+        
+    else:
+        # load dataset, or pull data from cdsapi and process it
+        ds, color_stats = prepare_dataset(data_params, **prepare_args)
+        
+        if preview_factor: # render from a coarsened copy; colour limits stay those of the full resolution data
+            ds = preview_dataset(ds, use_ds or output_ds_path, preview_factor, time_chunk)
+            
+        if use_ds and data_params.get("area"): # downloads are already cut to the area by the CDS
+            ds = subset_area(ds, data_params["area"])
+            
+        render_dataset(ds, color_stats, img_dir, vid_dir, **render_args, time_chunk=time_chunk)
+        ds.close()
+        
+    # delete images
+    if rm_images:
+        shutil.rmtree(img_dir)
+        logging.info("Deleted all frames")
+        
+    # where the time went, next to the log
+    write_run_report(pathlib.Path(log_file()).parent if log_file() else working_dir, chrome_trace)
     
     logging.info("Program execution complete")
     print("Program execution complete")
@@ -336,7 +3082,7 @@ if __name__=="__main__":
     # data params
     data_params = dict( 
         year = "2023",
-        month = "06", # only works within one month of one year
+        month = "06", # only works within one month of one year; for longer ranges, replace year/month/days with start_date = "YYYY-MM-DD[THH:MM]", stop_date_inc = "YYYY-MM-DD[THH:MM]" and see shard_params
         start_day_inc = "1",
         stop_day_inc = "7",
         step_day = 1,
@@ -344,8 +3090,9 @@ if __name__=="__main__":
         stop_hour_inc = "23", # 00-23
         step_hour = 1,
         sfc_vars = ["total_column_water_vapour", "surface_pressure"],
-        pl_vars = ["geopotential", "temperature", "u_component_of_wind", "v_component_of_wind", "divergence"],
-        pl_levels = [500, 850, 1000]
+        pl_vars = ["geopotential", "temperature", "divergence"],
+        pl_levels = [500, 850, 1000],
+        area = None, # [north, west, south, east] bounding box in degrees to download and plot, e.g. [35, -100, 15, -75] for the Gulf of Mexico, or None for the whole globe
     )
     
     # Where to save the data, images, and videos. Please provide an absolute path, not a relative path.
@@ -361,10 +3108,23 @@ if __name__=="__main__":
     working_dir = working_dir,
     output_stem = output_stem,
     output_stem_explain = r"yYYYY_mMM_diDD_djDD_hmHH_hnHH_{pl,sfc,merged}.nc, where YYYY is the year, MM is the month, DD is the day (a=start, b=stop) inclusive, HH is the hour (a=start, b=stop) inclusive, final tag indicates whether using pl (pressure level data) or sfc (surface data) or merged (combined pl and sfc).",
-    output_ds_path = working_dir / f'{output_stem}_merged.nc', # save the output dataset to a netcdf file or False / None to not save
+    output_ds_path = working_dir / f'{output_stem}_merged.nc', # save the output dataset to a netcdf file (or a zarr store, if the path ends in .zarr) or False / None to not save
+    zarr_params = dict(compressor = dict(cname = "zstd", clevel = 3), append = True), # compression of a .zarr output_ds_path, and whether to append new timesteps to an existing store
     use_ds = False, # provide a path to a dataset to use instead of pulling data from cdsapi, or False to pull data from cdsapi
+    download_params = dict(chunk_by = "day", max_workers = 4), # how to split and parallelize downloads, if data_params has a start_date/stop_date_inc range instead of year/month
+    pipeline_params = None, # e.g. dict(queue_size = 2) to download, process, render and encode a start_date/stop_date_inc range day by day with the stages overlapping, so videos grow while the run goes on (needs a .zarr or no output_ds_path, frames are always streamed), or None
+    shard_params = None, # e.g. dict(max_workers = 2) to split a long start_date/stop_date_inc range (a season, a decade) into months that are downloaded, processed and rendered separately, 2 at a time, and joined into one video per channel, or None
+    cache_params = dict(cache_dir = working_dir.parent / 'era5_cache', max_gb = 50), # keep downloads in a local cache so repeated requests skip the CDS, or None to always download
     rm_originals = True, # delete the original .nc files after merging and processing
+    time_chunk = None, # open datasets lazily (requires dask) in chunks of this many timesteps, so memory is bounded by the chunk size instead of the dataset size, or None to load everything
+    derived_fields = ["wind"], # fields to compute from the downloaded variables, e.g. ["wind", "wind_direction", "vort", "thickness", "t2m_c"] (see DERIVED_FIELDS); the variables they need are downloaded too, and only kept if they are in sfc_vars/pl_vars
+    keep_levels = False, # keep pressure level variables as one variable with a level dimension (e.g. t) instead of one variable per level (e.g. t500, t850)
+    pyramid_factors = None, # e.g. (2, 4, 8) to also save coarsened copies of the output dataset for quick previews, or None
     rm_images = True, # delete the images after creating the video
+    stream_frames = False, # pipe frames straight into ffmpeg instead of saving them as images first
+    dashboard = None, # e.g. dict(channels = ["t2m", "wind500"], columns = 2) to render these channels side by side into a single dashboard video instead of one video per channel
+    preview_factor = None, # e.g. 4 to render a quick preview from the 4x coarsened dataset (smaller frames, saved under preview_x4/), or None for full resolution
+    interpolation = None, # e.g. dict(steps = 3, method = "linear") to insert 3 interpolated frames between hourly timesteps for smoother, longer videos ("flow" follows the motion, requires opencv), or None
     img_dir = working_dir / 'frames', # directory to save images to
     vid_dir = working_dir / 'videos', # directory to save videos to
     
@@ -384,22 +3144,14 @@ if __name__=="__main__":
     },
     border_color = 'black',
     fps = '18', # frames per second for the video, as a string,
+    encode_params = dict(codec = "x264", preset = "medium", crf = None, threads = None, max_jobs = None), # codec ("x264", "x265" or "vp9"), speed preset, quality (None for the codec default), threads per encode and concurrent encodes (None to size them to the available cores)
     plot_metadata = True,
     metadata_pos = "upper-right", # if plot_metadata is True, where to plot the metadata (upper-right, upper-left, lower-right, lower-left)
+    renderer = "matplotlib", # "matplotlib" to draw each frame as a figure, or "fast" to rasterize frames directly with numpy
+    color_percentiles = None, # (lower, upper) percentiles to use as colour limits, e.g. (1, 99), or None to use the min and max of each channel
+    workers = 1, # number of processes to render frames with
+    chrome_trace = False, # also save the timeline of the run as run_trace.json next to pipeline.log, to open in chrome://tracing or https://ui.perfetto.dev (run_report.json is always saved)
     
-    # random params
-    lookup_variables = dict(
-        potential_vorticity = "pv",
-        geopotential = "z",
-        temperature = "t",
-        u_component_of_wind = "u",
-        v_component_of_wind = "v",
-        specific_humidity = "q",
-        vertical_velocity = "w",
-        divergence = "d",
-        relative_humidity = "r",
-        fraction_of_cloud_cover = "cc",
-    ),
     # end paramdict
     )
     
@@ -8,7 +8,7 @@ from pipeline import main, setup_logger
 # data params
 data_params = dict( 
     year = "2005",
-    month = "08", # only works within one month of one year (can't download June-July data, for example)
+    month = "08", # only works within one month of one year (can't download June-July data, for example); for longer ranges, replace year/month/days with start_date = "YYYY-MM-DD[THH:MM]", stop_date_inc = "YYYY-MM-DD[THH:MM]" and see shard_params
     start_day_inc = "04",
     stop_day_inc = "30",
     step_day = 1,
@@ -16,8 +16,9 @@ data_params = dict(
     stop_hour_inc = "23", # 00-23
     step_hour = 1,
     sfc_vars = [], # "total_column_water_vapour", "total_cloud_cover", "mean_total_precipitation_rate"
-    pl_vars = ["u_component_of_wind", "v_component_of_wind", "geopotential"], # 
-    pl_levels = [500, 850, 1000] # 500, 1000
+    pl_vars = ["geopotential"], # u and v are downloaded for the wind in derived_fields
+    pl_levels = [500, 850, 1000], # 500, 1000
+    area = None, # [north, west, south, east] bounding box in degrees to download and plot, e.g. [35, -100, 15, -75] for the Gulf of Mexico, or None for the whole globe
 )
 
 # Where to save the data, images, and videos. Please provide an absolute path, not a relative path.
@@ -33,10 +34,23 @@ data_params = data_params,
 working_dir = working_dir,
 output_stem = output_stem,
 output_stem_explain = r"yYYYY_mMM_diDD_djDD_hmHH_hnHH_{pl,sfc,merged}.nc, where YYYY is the year, MM is the month, DD is the day (a=start, b=stop) inclusive, HH is the hour (a=start, b=stop) inclusive, final tag indicates whether using pl (pressure level data) or sfc (surface data) or merged (combined pl and sfc).",
-output_ds_path = working_dir / f'{output_stem}_merged.nc', # save the output dataset to a netcdf file or False / None to not save
-use_ds = "katrina/y2005_m08_da01_db30_ha00_hb23_sfc.nc", # provide a path to a dataset to use instead of pulling data from cdsapi, or False to pull data from cdsapi
+output_ds_path = working_dir / f'{output_stem}_merged.nc', # save the output dataset to a netcdf file (or a zarr store, if the path ends in .zarr) or False / None to not save
+zarr_params = dict(compressor = dict(cname = "zstd", clevel = 3), append = True), # compression of a .zarr output_ds_path, and whether to append new timesteps to an existing store
+use_ds = False, # provide a path to a dataset to use instead of pulling data from cdsapi, or False to pull data from cdsapi
+download_params = dict(chunk_by = "day", max_workers = 4), # how to split and parallelize downloads, if data_params has a start_date/stop_date_inc range instead of year/month
+pipeline_params = None, # e.g. dict(queue_size = 2) to download, process, render and encode a start_date/stop_date_inc range day by day with the stages overlapping, so videos grow while the run goes on (needs a .zarr or no output_ds_path, frames are always streamed), or None
+shard_params = None, # e.g. dict(max_workers = 2) to split a long start_date/stop_date_inc range (a season, a decade) into months that are downloaded, processed and rendered separately, 2 at a time, and joined into one video per channel, or None
+cache_params = dict(cache_dir = working_dir.parent / 'era5_cache', max_gb = 50), # keep downloads in a local cache so repeated requests skip the CDS, or None to always download
 rm_originals = True, # delete the original .nc files after merging and processing
+time_chunk = None, # open datasets lazily (requires dask) in chunks of this many timesteps, so memory is bounded by the chunk size instead of the dataset size, or None to load everything
+derived_fields = ["wind"], # fields to compute from the downloaded variables, e.g. ["wind", "wind_direction", "vort", "thickness", "t2m_c"] (see DERIVED_FIELDS); the variables they need are downloaded too, and only kept if they are in sfc_vars/pl_vars
+keep_levels = False, # keep pressure level variables as one variable with a level dimension (e.g. t) instead of one variable per level (e.g. t500, t850)
+pyramid_factors = None, # e.g. (2, 4, 8) to also save coarsened copies of the output dataset for quick previews, or None
 rm_images = True, # delete the images after creating the video
+stream_frames = False, # pipe frames straight into ffmpeg instead of saving them as images first
+dashboard = None, # e.g. dict(channels = ["t2m", "wind500"], columns = 2) to render these channels side by side into a single dashboard video instead of one video per channel
+preview_factor = None, # e.g. 4 to render a quick preview from the 4x coarsened dataset (smaller frames, saved under preview_x4/), or None for full resolution
+interpolation = None, # e.g. dict(steps = 3, method = "linear") to insert 3 interpolated frames between hourly timesteps for smoother, longer videos ("flow" follows the motion, requires opencv), or None
 img_dir = working_dir / 'frames', # directory to save images to
 vid_dir = working_dir / 'videos', # directory to save videos to
 
@@ -51,22 +65,14 @@ channel_metadata = {
 },
 border_color = 'black',
 fps = '18', # frames per second for the video, as a string,
+encode_params = dict(codec = "x264", preset = "medium", crf = None, threads = None, max_jobs = None), # codec ("x264", "x265" or "vp9"), speed preset, quality (None for the codec default), threads per encode and concurrent encodes (None to size them to the available cores)
 plot_metadata = True,
 metadata_pos = "upper-right", # if plot_metadata is True, where to plot the metadata (upper-right, upper-left, lower-right, lower-left)
+renderer = "matplotlib", # "matplotlib" to draw each frame as a figure, or "fast" to rasterize frames directly with numpy
+color_percentiles = None, # (lower, upper) percentiles to use as colour limits, e.g. (1, 99), or None to use the min and max of each channel
+workers = 1, # number of processes to render frames with
+chrome_trace = False, # also save the timeline of the run as run_trace.json next to pipeline.log, to open in chrome://tracing or https://ui.perfetto.dev (run_report.json is always saved)
 
-# random params
-lookup_variables = dict(
-    potential_vorticity = "pv",
-    geopotential = "z",
-    temperature = "t",
-    u_component_of_wind = "u",
-    v_component_of_wind = "v",
-    specific_humidity = "q",
-    vertical_velocity = "w",
-    divergence = "d",
-    relative_humidity = "r",
-    fraction_of_cloud_cover = "cc",
-),
 # end paramdict
 )
 
@@ -74,13 +80,14 @@ lookup_variables = dict(
 
 ### BEGIN EXECUTION ###
 
-# ensure working_dir exists
-working_dir.mkdir(parents=True, exist_ok=True)
+if __name__ == "__main__": # guard so worker processes (workers > 1) can import this file without re-running the pipeline
+    # ensure working_dir exists
+    working_dir.mkdir(parents=True, exist_ok=True)
 
-# set up logger
-setup_logger(log_loc = working_dir / 'pipeline.log',)
+    # set up logger
+    setup_logger(log_loc = working_dir / 'pipeline.log',)
 
-# run main
-main(**config)
+    # run main
+    main(**config)
 
 ### END EXECUTION ###
\ No newline at end of file
@@ -0,0 +1,5 @@
+import sys
+import pathlib
+
+# the pipeline is a set of scripts rather than a package, so tests import them from the repository root
+sys.path.insert(0, f"{pathlib.Path(__file__).resolve().parent.parent}")
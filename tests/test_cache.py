@@ -0,0 +1,51 @@
+import xarray as xr
+import pipeline
+from benchmark import SyntheticClient
+
+
+class CountingClient(SyntheticClient):
+    """
+    SyntheticClient on a small grid that counts its downloads.
+    """
+    calls = []
+
+    def __init__(self):
+        super().__init__(shape=(19, 36))
+
+    def retrieve(self, name, request, target):
+        CountingClient.calls.append(request["variable"])
+        super().retrieve(name, request, target)
+
+
+def sfc_request(variables, days = ("01",)):
+    return dict(product_type="reanalysis", format="netcdf", variable=list(variables), year="2005", month="08", day=list(days), time=["00:00", "12:00"])
+
+
+def retrieve(tmp_path, request, target):
+    cache = dict(cache_dir=tmp_path / "cache", max_gb=None)
+    pipeline.cached_retrieve(CountingClient(), "reanalysis-era5-single-levels", request, tmp_path / target, cache)
+
+    return tmp_path / target
+
+
+def test_single_level_request_is_subset_from_a_cached_superset(tmp_path):
+    CountingClient.calls = []
+    retrieve(tmp_path, sfc_request(["total_column_water_vapour", "2m_temperature"], ["01", "02"]), "both.nc")
+    subset = retrieve(tmp_path, sfc_request(["2m_temperature"], ["02"]), "t2m.nc")
+    assert len(CountingClient.calls) == 1
+
+    with xr.open_dataset(subset) as ds:
+        assert list(ds.data_vars) == ["t2m"]
+        assert ds.sizes["time"] == 2
+
+
+def test_cache_hit_with_a_deleted_file_downloads_again(tmp_path):
+    CountingClient.calls = []
+    retrieve(tmp_path, sfc_request(["2m_temperature"]), "first.nc")
+    for path in (tmp_path / "cache").glob("*.nc"):
+        path.unlink()
+
+    again = retrieve(tmp_path, sfc_request(["2m_temperature"]), "again.nc")
+    assert len(CountingClient.calls) == 2
+    assert again.exists()
+    assert len(pipeline.read_cache_index(tmp_path / "cache")) == 1
@@ -0,0 +1,14 @@
+import pytest
+import pipeline
+from benchmark import synthetic_download
+
+
+@pytest.mark.parametrize("keep_levels", [False, True])
+@pytest.mark.parametrize("derived_fields", [None, ["wind", "thickness", "t2m_c", "wind10"]])
+def test_planned_channels_match_the_processed_dataset(tmp_path, keep_levels, derived_fields):
+    data_params = dict(sfc_vars=["total_cloud_cover", "2m_temperature"], pl_vars=["temperature", "u_component_of_wind"], pl_levels=[850, 300])
+    fetched_params, drop_inputs = pipeline.field_requests(data_params, derived_fields) if derived_fields else (data_params, None)
+    sfc_request, pl_request = synthetic_download(tmp_path, 2, (19, 36), fetched_params["sfc_vars"], fetched_params["pl_vars"], fetched_params["pl_levels"])
+    ds = pipeline.postprocessing(sfc_request, pl_request, None, False, keep_levels=keep_levels, derived_fields=derived_fields, drop_inputs=drop_inputs)
+
+    assert pipeline.output_channels(data_params, derived_fields, keep_levels) == [channel for channel, _ in pipeline.iter_channels(ds)]
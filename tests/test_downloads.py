@@ -0,0 +1,39 @@
+import pipeline
+
+
+class CountingClient:
+    """
+    Stands in for cdsapi.Client: writes the request it was given to target and counts the calls.
+    """
+    calls = []
+
+    def retrieve(self, name, request, target):
+        CountingClient.calls.append(request)
+        with open(target, "w") as f:
+            f.write(f"{request}")
+
+
+def download(tmp_path, pl_levels, chunk_by = "day"):
+    _, _, chunks = pipeline.range_requests(
+        "2005-08-01", "2005-08-02", "00", "23", 12, [], ["temperature"], pl_levels, tmp_path, "job", chunk_by=chunk_by,
+    )
+    pipeline.retrieve_chunks(chunks, tmp_path / "job_manifest.json", 2, CountingClient)
+
+    return chunks
+
+
+def test_resumed_download_skips_completed_chunks(tmp_path):
+    CountingClient.calls = []
+    download(tmp_path, [500])
+    assert len(CountingClient.calls) == 2 # one chunk per day
+
+    download(tmp_path, [500])
+    assert len(CountingClient.calls) == 2
+
+
+def test_resumed_download_with_other_levels_downloads_again(tmp_path):
+    CountingClient.calls = []
+    download(tmp_path, [500])
+    chunks = download(tmp_path, [500, 850]) # same chunk ids, different requests
+    assert len(CountingClient.calls) == 4
+    assert all("850" in chunk["target"].read_text() for chunk in chunks)
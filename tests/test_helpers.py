@@ -0,0 +1,165 @@
+import datetime
+import logging
+import numpy as np
+import pytest
+import pipeline
+
+
+def test_canonical_request_ignores_how_a_request_is_written():
+    a = pipeline.canonical_request("reanalysis-era5-single-levels", dict(
+        variable=["2m_temperature", "total_column_water_vapour"], year="2005", month="08", day=["02", "01"], time=["06:00", "00:00"],
+    ))
+    b = pipeline.canonical_request("reanalysis-era5-single-levels", dict(
+        variable=["total_column_water_vapour", "2m_temperature"], year=["2005"], month=["08"], day=["01", "02"], time=["00:00", "06:00"],
+    ))
+    assert a == b
+    assert pipeline.request_key(a) == pipeline.request_key(b)
+    assert a["datetimes"] == ["2005-08-01T00:00:00", "2005-08-01T06:00:00", "2005-08-02T00:00:00", "2005-08-02T06:00:00"]
+
+
+def test_canonical_request_skips_days_a_month_does_not_have():
+    canonical = pipeline.canonical_request("reanalysis-era5-single-levels", dict(variable=["2m_temperature"], year="2005", month="09", day=["30", "31"], time="00:00"))
+    assert canonical["datetimes"] == ["2005-09-30T00:00:00"]
+
+
+def test_canonical_request_keeps_area_order():
+    canonical = pipeline.canonical_request("reanalysis-era5-single-levels", dict(variable=["2m_temperature"], year="2005", month="08", day="01", time="00:00", area=[60, -30, 20, 40]))
+    assert canonical["area"] == [60.0, -30.0, 20.0, 40.0]
+
+
+def split_dates(chunk_by):
+    request = dict(variable=["2m_temperature", "total_column_water_vapour"], time=["00:00"], dates=[
+        datetime.date(2005, 8, 30), datetime.date(2005, 8, 31), datetime.date(2005, 9, 1),
+    ])
+    return pipeline.split_request(request, chunk_by)
+
+
+def test_split_request_by_month():
+    chunks = split_dates([])
+    assert [request["month"] for _, request in chunks] == ["08", "09"]
+    assert [request["day"] for _, request in chunks] == [["30", "31"], ["01"]]
+    assert all(request["variable"] == ["2m_temperature", "total_column_water_vapour"] for _, request in chunks)
+
+
+def test_split_request_by_day_and_variable():
+    chunks = split_dates(["day", "variable"])
+    assert len(chunks) == 6
+    assert len({chunk_id for chunk_id, _ in chunks}) == 6
+    assert all(len(request["day"]) == 1 and len(request["variable"]) == 1 for _, request in chunks)
+    assert [chunk_id for chunk_id, _ in split_dates(["day", "variable"])] == [chunk_id for chunk_id, _ in chunks] # stable across runs
+
+
+def cache_entry(variables, days, levels = None, area = None, size = 1):
+    request = dict(variable=variables, year="2005", month="08", day=days, time=["00:00", "12:00"])
+    name = "reanalysis-era5-single-levels"
+    if levels:
+        request["pressure_level"] = levels
+        name = "reanalysis-era5-pressure-levels"
+
+    if area:
+        request["area"] = area
+
+    return {"request": pipeline.canonical_request(name, request), "size": size, "last_used": 0}
+
+
+def test_find_cached_superset():
+    index = {
+        "small": cache_entry(["temperature", "geopotential"], ["01", "02"], ["500", "850"], size=1),
+        "large": cache_entry(["temperature", "geopotential"], ["01", "02", "03"], ["500", "850"], size=2),
+        "other_levels": cache_entry(["temperature"], ["01"], ["300"]),
+    }
+    wanted = cache_entry(["temperature"], ["02"], ["500"])["request"]
+    assert pipeline.find_cached_superset(index, wanted) == "small" # the smallest file that covers it
+    assert pipeline.find_cached_superset(index, cache_entry(["temperature"], ["04"], ["500"])["request"]) is None
+    assert pipeline.find_cached_superset(index, cache_entry(["temperature"], ["01"], ["1000"])["request"]) is None
+
+
+def test_find_cached_superset_needs_a_covering_area():
+    index = {"europe": cache_entry(["temperature"], ["01"], ["500"], area=[70, -20, 30, 40])}
+    inside = cache_entry(["temperature"], ["01"], ["500"], area=[60, 0, 40, 20])["request"]
+    outside = cache_entry(["temperature"], ["01"], ["500"], area=[60, 0, 20, 20])["request"]
+    assert pipeline.find_cached_superset(index, inside) == "europe"
+    assert pipeline.find_cached_superset(index, outside) is None
+
+
+def test_merge_sketches_matches_quantiles_of_all_values():
+    rng = np.random.default_rng(0)
+    blocks = [rng.normal(loc, 1, size=5000) for loc in (0, 2, 5)]
+    merged = pipeline.merge_sketches([pipeline.block_sketch(block) for block in blocks])
+    values = np.concatenate(blocks)
+    assert merged["count"] == values.size
+    assert merged["min"] == values.min() and merged["max"] == values.max()
+    np.testing.assert_allclose(pipeline.sketch_limits(merged, (1, 99)), np.percentile(values, (1, 99)), atol=0.05)
+
+
+def test_merge_sketches_ignores_empty_blocks():
+    sketch = pipeline.block_sketch([1.0, 2.0, np.nan])
+    merged = pipeline.merge_sketches([pipeline.block_sketch([np.nan]), sketch])
+    assert merged["count"] == 2
+    assert pipeline.merge_sketches([pipeline.block_sketch([])])["count"] == 0
+
+
+def test_month_shards():
+    assert pipeline.month_shards("2005-08-20T06:00", "2005-10-03") == [
+        ("200508", "2005-08-20T06:00", "2005-08-31"),
+        ("200509", "2005-09-01", "2005-09-30"),
+        ("200510", "2005-10-01", "2005-10-03"),
+    ]
+    assert pipeline.month_shards("2004-02-01", "2004-02-29") == [("200402", "2004-02-01", "2004-02-29")]
+
+
+def test_resolve_fields_computes_shared_inputs_once():
+    order, raw = pipeline.resolve_fields(["ke", "wind"])
+    assert order == ["wind_speed_sq", "ke", "wind"]
+    assert raw == {"u", "v"}
+
+
+def test_resolve_fields_rejects_unknown_names_and_cycles(monkeypatch):
+    with pytest.raises(ValueError, match="Unknown field"):
+        pipeline.resolve_fields(["no_such_field"])
+
+    monkeypatch.setitem(pipeline.DERIVED_FIELDS, "a", dict(inputs=("b",), compute=None))
+    monkeypatch.setitem(pipeline.DERIVED_FIELDS, "b", dict(inputs=("a",), compute=None))
+    with pytest.raises(ValueError, match="cycle"):
+        pipeline.resolve_fields(["a"])
+
+
+def test_field_requests_adds_only_missing_inputs():
+    data_params = dict(sfc_vars=[], pl_vars=["u_component_of_wind"], pl_levels=[850])
+    params, drop_inputs = pipeline.field_requests(data_params, ["wind", "thickness"])
+    assert params["pl_vars"] == ["u_component_of_wind", "v_component_of_wind", "geopotential"]
+    assert params["pl_levels"] == [850, 500, 1000]
+    assert drop_inputs == dict(variables=["v", "z"], levels=[500, 1000])
+
+
+def test_legacy_derived_fields(caplog):
+    data_params = dict(sfc_vars=[], pl_vars=["temperature", "u_component_of_wind", "v_component_of_wind"], pl_levels=[500])
+    with caplog.at_level(logging.WARNING):
+        params, derived_fields = pipeline.legacy_derived_fields(data_params, None)
+
+    assert derived_fields == ["wind"]
+    assert params["pl_vars"] == ["temperature"]
+    assert "derived_fields" in caplog.text
+    assert pipeline.legacy_derived_fields(data_params, []) == (data_params, []) # explicitly no derived fields
+    assert pipeline.legacy_derived_fields(data_params, ["vort"]) == (data_params, ["vort"])
+    only_u = dict(data_params, pl_vars=["u_component_of_wind"])
+    assert pipeline.legacy_derived_fields(only_u, None) == (only_u, None)
+
+
+def test_grid_shape():
+    assert pipeline.grid_shape() == (721, 1440)
+    assert pipeline.grid_shape([60, -30, 20, 40]) == (161, 281) # across the Greenwich meridian
+    assert pipeline.grid_shape([60, 350, 20, 10]) == (161, 81)
+
+
+def test_shard_key_changes_with_the_data_not_the_paths():
+    data_params = dict(start_date="2005-08-01", stop_date_inc="2005-08-31", start_hour_inc="00", stop_hour_inc="23", step_hour=1,
+                       sfc_vars=["2m_temperature"], pl_vars=["temperature"], pl_levels=[500])
+    prepare_args = dict(working_dir="/tmp/a", output_stem="job", keep_levels=False, derived_fields=["wind"], time_chunk=24)
+    key = pipeline.shard_key(data_params, prepare_args)
+    assert pipeline.shard_key(data_params, dict(prepare_args, working_dir="/tmp/b", output_stem="other")) == key
+    assert pipeline.shard_key(dict(data_params, pl_levels=[500, 850]), prepare_args) != key
+    assert pipeline.shard_key(dict(data_params, area=[60, -30, 20, 40]), prepare_args) != key
+    assert pipeline.shard_key(dict(data_params, start_hour_inc="06"), prepare_args) != key
+    assert pipeline.shard_key(data_params, dict(prepare_args, derived_fields=["wind", "vort"])) != key
+    assert pipeline.shard_key(data_params, dict(prepare_args, keep_levels=True)) != key
@@ -0,0 +1,17 @@
+import numpy as np
+import pipeline
+
+
+def frame_args(field, channel):
+    return (field, channel, np.datetime64("2005-08-01T00"), "viridis", 0, 1, "black", True, "upper-right", pipeline.FRAME_SIZE_IN, pipeline.FRAME_DPI)
+
+
+def test_fast_labels_are_not_changed_by_matplotlib_text():
+    field = np.random.default_rng(0).random((91, 180)).astype(np.float32)
+    pipeline.rasterize_frame(*frame_args(field, "t2m")) # fills the glyph cache
+    pipeline.render_frame(*frame_args(field, "t2m")) # matplotlib draws text with its own fonts
+    after_matplotlib = pipeline.rasterize_frame(*frame_args(field, "wind500"))
+
+    pipeline.glyph_cache.cache_clear()
+    fresh = pipeline.rasterize_frame(*frame_args(field, "wind500"))
+    np.testing.assert_array_equal(after_matplotlib, fresh)
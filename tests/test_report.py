@@ -0,0 +1,17 @@
+import subprocess
+import sys
+import pipeline
+
+
+def test_child_memory_is_given_only_to_the_stage_it_ran_in():
+    pipeline.reset_run_report()
+    with pipeline.stage("child"):
+        subprocess.run([sys.executable, "-c", "x = bytearray(200_000_000)"], check=True)
+
+    with pipeline.stage("after"):
+        pass
+
+    child, after = pipeline.RUN_REPORT["stages"]
+    assert child["child_peak_rss_mb"] >= 200
+    assert after["child_peak_rss_mb"] is None
+    assert after["peak_rss_mb"] < child["child_peak_rss_mb"]
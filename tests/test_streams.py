@@ -0,0 +1,30 @@
+import shutil
+import numpy as np
+import pytest
+import pipeline
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+
+FRAME_SIZE = (64, 96)
+
+
+def stream(tmp_path, frames):
+    output_path = tmp_path / "stream.mp4"
+    proc = pipeline.open_frame_stream(output_path, FRAME_SIZE, 24, preset="ultrafast")
+    for frame in frames:
+        pipeline.write_frame(proc, frame)
+
+    pipeline.close_frame_stream(proc, output_path)
+
+    return output_path
+
+
+def test_streamed_video_has_every_frame(tmp_path):
+    frames = [np.full((*FRAME_SIZE, 4), value, dtype=np.uint8).tobytes() for value in range(0, 250, 50)]
+    assert pipeline.probe_video(stream(tmp_path, frames)) == len(frames)
+
+
+def test_truncated_stream_raises(tmp_path):
+    frame = np.zeros((*FRAME_SIZE, 4), dtype=np.uint8).tobytes()
+    with pytest.raises(RuntimeError, match="4 of 5 frames"):
+        stream(tmp_path, [frame] * 4 + [frame[:len(frame) // 2]]) # the last frame is cut off